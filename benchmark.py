@@ -0,0 +1,501 @@
+"""Офлайн-бенчмарк горячих путей BOlauncher: скачивание (HTTP/FTP/SMB), распаковка и правка конфига.
+
+Создает синтетический архив в структуре дистрибутива BackOffice (тысячи мелких файлов и несколько
+больших), поднимает локальные HTTP-сервер (с поддержкой Range) и FTP-сервер, а каталог на диске
+использует как SMB-источник. Каждый замер повторяется --repeat раз; результаты пишутся в JSON,
+который можно сравнить с предыдущим запуском через --compare.
+
+Пример:
+    python benchmark.py --output bench_new.json --compare bench_old.json
+"""
+import argparse
+import configparser
+import contextlib
+import functools
+import http.server
+import json
+import os
+import platform
+import posixpath
+import random
+import shutil
+import socket
+import socketserver
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+import main
+
+
+APP_TYPE = 'iikoRMS'
+VERSION = '999' # Форматированная версия синтетического дистрибутива (RMSOffice999.zip)
+SEED = 20240601 # Фиксированное зерно: архив одинаков от запуска к запуску
+
+
+# --- Синтетический дистрибутив ---
+
+_WORDS = [b'BackOffice', b'Resto', b'iiko', b'Syrve', b'assembly', b'resource', b'culture', b'version',
+          b'PublicKeyToken', b'System', b'Runtime', b'Serialization', b'xml', b'config', b'server']
+
+
+def _text_payload(rng, size):
+    """Сжимаемые данные, похожие на ресурсы и конфиги дистрибутива."""
+    parts = []
+    total = 0
+    while total < size:
+        word = rng.choice(_WORDS)
+        parts.append(word)
+        total += len(word) + 1
+    return b' '.join(parts)[:size]
+
+
+def build_archive(archive_path, small_files, large_files, large_mb):
+    """Создает ZIP в структуре дистрибутива: BackOffice/ с BackOffice.exe, мелкими и крупными файлами.
+       Возвращает описание набора данных.
+    """
+    rng = random.Random(SEED)
+    members = 0
+    with zipfile.ZipFile(archive_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
+        zf.writestr('BackOffice/BackOffice.exe', b'MZ' + rng.randbytes(256 * 1024))
+        members += 1
+        for index in range(small_files):
+            # Мелкие файлы: ресурсы по каталогам культур, 1-32 КБ
+            name = f"BackOffice/Resources/{index % 40:02d}/Resource{index:05d}.dll"
+            zf.writestr(name, _text_payload(rng, rng.randint(1024, 32 * 1024)))
+            members += 1
+        for index in range(large_files):
+            # Крупные файлы: половина несжимаемая, половина сжимаемая
+            half = large_mb * 1024 * 1024 // 2
+            zf.writestr(f"BackOffice/Large{index}.dll", rng.randbytes(half) + _text_payload(rng, half))
+            members += 1
+    return {'members': members, 'small_files': small_files, 'large_files': large_files,
+            'large_mb': large_mb, 'archive_bytes': os.path.getsize(archive_path), 'seed': SEED}
+
+
+def build_config_xml(path):
+    """Создает backclient.config.xml, похожий на тот, что пишет BackOffice при первом запуске."""
+    rng = random.Random(SEED)
+    lines = ['<?xml version="1.0" encoding="utf-8"?>', '<config>',
+             '  <ServersList>', '    <ServerAddr>localhost</ServerAddr>', '    <ServerSubUrl>/resto</ServerSubUrl>',
+             '    <Port>8080</Port>', '    <Protocol>http</Protocol>', '    <IsPresent>false</IsPresent>', '  </ServersList>']
+    for index in range(300):
+        lines.append(f'  <Setting name="Option{index}">{_text_payload(rng, 48).decode()}</Setting>')
+    lines.append('</config>')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines))
+
+
+# --- Локальные серверы ---
+
+class _RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Статический HTTP-сервер с одиночными Range-запросами (206), ETag и Last-Modified."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None
+        st = os.stat(path)
+        size = st.st_size
+        etag = f'"{st.st_mtime_ns:x}-{size:x}"'
+        f = open(path, 'rb')
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if range_header and range_header.startswith('bytes=') and if_range in (None, etag, self.date_time_string(st.st_mtime)):
+            start_str, _, end_str = range_header[len('bytes='):].partition('-')
+            start = int(start_str)
+            end = min(int(end_str) if end_str else size - 1, size - 1)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            f.seek(start)
+            self._remaining = end - start + 1
+        else:
+            self.send_response(200)
+            self._remaining = size
+        self.send_header('Content-Length', str(self._remaining))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(st.st_mtime))
+        self.end_headers()
+        return f
+
+    def copyfile(self, source, outputfile):
+        remaining = self._remaining
+        while remaining > 0:
+            chunk = source.read(min(256 * 1024, remaining))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            remaining -= len(chunk)
+
+
+def start_http_server(directory):
+    """Запускает HTTP-сервер на свободном порту. Возвращает (сервер, порт)."""
+    handler = functools.partial(_RangeRequestHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.server_address[1]
+
+
+class _FtpRequestHandler(socketserver.StreamRequestHandler):
+    """Минимальный FTP-сервер (только чтение, пассивный режим) - ровно то, что использует ftplib в main.py:
+       USER/PASS, PWD/CWD, TYPE, SIZE, MDTM, REST, PASV, RETR, NOOP, QUIT.
+    """
+    root = None # Задается при запуске сервера
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('utf-8'))
+
+    def _local_path(self, ftp_path):
+        ftp_path = posixpath.normpath(posixpath.join(self.cwd, ftp_path))
+        return ftp_path, os.path.join(self.root, ftp_path.lstrip('/'))
+
+    def handle(self):
+        self.cwd = '/'
+        self.rest = 0
+        self.pasv_socket = None
+        self.reply('220 BOlauncher benchmark FTP')
+        try:
+            for raw_line in self.rfile:
+                command, _, argument = raw_line.decode('utf-8').strip().partition(' ')
+                handler = getattr(self, 'ftp_' + command.upper(), None)
+                if handler is None:
+                    self.reply('502 Command not implemented')
+                elif handler(argument) is False:
+                    break
+        finally:
+            if self.pasv_socket is not None:
+                self.pasv_socket.close()
+
+    def ftp_USER(self, argument):
+        self.reply('331 Password required')
+
+    def ftp_PASS(self, argument):
+        self.reply('230 Logged in')
+
+    def ftp_PWD(self, argument):
+        self.reply(f'257 "{self.cwd}"')
+
+    def ftp_CWD(self, argument):
+        ftp_path, local_path = self._local_path(argument)
+        if os.path.isdir(local_path):
+            self.cwd = ftp_path
+            self.reply('250 OK')
+        else:
+            self.reply('550 No such directory')
+
+    def ftp_TYPE(self, argument):
+        self.reply('200 Type set')
+
+    def ftp_NOOP(self, argument):
+        self.reply('200 OK')
+
+    def ftp_SIZE(self, argument):
+        _, local_path = self._local_path(argument)
+        if os.path.isfile(local_path):
+            self.reply(f'213 {os.path.getsize(local_path)}')
+        else:
+            self.reply('550 No such file')
+
+    def ftp_MDTM(self, argument):
+        _, local_path = self._local_path(argument)
+        if os.path.isfile(local_path):
+            self.reply('213 ' + time.strftime('%Y%m%d%H%M%S', time.gmtime(os.path.getmtime(local_path))))
+        else:
+            self.reply('550 No such file')
+
+    def ftp_REST(self, argument):
+        self.rest = int(argument)
+        self.reply(f'350 Restarting at {self.rest}')
+
+    def ftp_PASV(self, argument):
+        if self.pasv_socket is not None:
+            self.pasv_socket.close()
+        self.pasv_socket = socket.create_server(('127.0.0.1', 0))
+        port = self.pasv_socket.getsockname()[1]
+        self.reply(f'227 Entering Passive Mode (127,0,0,1,{port >> 8},{port & 0xFF})')
+
+    def ftp_RETR(self, argument):
+        _, local_path = self._local_path(argument)
+        if self.pasv_socket is None or not os.path.isfile(local_path):
+            self.reply('550 No such file')
+            return
+        offset, self.rest = self.rest, 0
+        self.reply('150 Opening data connection')
+        data_socket, _ = self.pasv_socket.accept()
+        self.pasv_socket.close()
+        self.pasv_socket = None
+        try:
+            with data_socket, open(local_path, 'rb') as f:
+                data_socket.sendfile(f, offset)
+        except OSError:
+            self.reply('426 Transfer aborted')
+            return
+        self.reply('226 Transfer complete')
+
+    def ftp_QUIT(self, argument):
+        self.reply('221 Bye')
+        return False
+
+
+def start_ftp_server(directory):
+    """Запускает FTP-сервер на свободном порту. Возвращает (сервер, порт)."""
+    handler = type('_BenchFtpHandler', (_FtpRequestHandler,), {'root': directory})
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.server_address[1]
+
+
+# --- Замеры ---
+
+def make_config(env, overrides=None):
+    """Конфиг лаунчера, в котором все источники указывают на локальные серверы бенчмарка."""
+    config = configparser.ConfigParser()
+    for section, values in main.DEFAULT_CONFIG.items():
+        config[section] = dict(values)
+    config['Settings']['InstallerRoot'] = env['installer_root']
+    config['Settings']['DebugLogging'] = 'False'
+    config['HttpSource']['Url'] = f"http://127.0.0.1:{env['http_port']}/"
+    config['FtpSource'].update({'Host': '127.0.0.1', 'Port': str(env['ftp_port']), 'Username': 'bench',
+                                'Password': 'bench', 'Directory': '/'})
+    config['SmbSource'].update({'Enabled': 'True', 'Path': env['source_dir']})
+    for (section, key), value in (overrides or {}).items():
+        config[section][key] = value
+    return config
+
+
+def _quiet_status(message, level="INFO"):
+    pass
+
+
+def _quiet_progress(value, transfer=None):
+    pass
+
+
+def _clear_temp_archive(temp_archive_path):
+    """Удаляет скачанный архив и частичные файлы всех источников, чтобы каждый замер качал с нуля."""
+    for source_type in ('http', 'ftp', 'smb'):
+        partial_path = main._partial_archive_path(temp_archive_path, source_type)
+        for path in (partial_path, main._resume_state_path(partial_path)):
+            if os.path.exists(path):
+                os.remove(path)
+    if os.path.exists(temp_archive_path):
+        os.remove(temp_archive_path)
+
+
+def _timed_download(env, download_function, overrides=None):
+    config = make_config(env, overrides)
+    temp_archive_path = env['temp_archive_path']
+    _clear_temp_archive(temp_archive_path)
+    started = time.perf_counter()
+    result = download_function(config, APP_TYPE, VERSION, env['installer_name'], temp_archive_path, _quiet_status, _quiet_progress, 0, 100)
+    elapsed = time.perf_counter() - started
+    if not result:
+        raise RuntimeError(f"{download_function.__name__} не скачал архив")
+    return elapsed, env['dataset']['archive_bytes']
+
+
+def bench_http_single(env):
+    return _timed_download(env, main._download_from_http, {('HttpSource', 'Segments'): '1'})
+
+
+def bench_http_segmented(env):
+    return _timed_download(env, main._download_from_http, {('HttpSource', 'Segments'): '4', ('HttpSource', 'SegmentMinSizeMb'): '1'})
+
+
+def bench_ftp(env):
+    return _timed_download(env, main._download_from_ftp)
+
+
+def bench_smb(env):
+    return _timed_download(env, main._download_from_smb)
+
+
+def _timed_extract(env, workers):
+    dest_root = os.path.join(env['work_dir'], 'extract')
+    shutil.rmtree(dest_root, ignore_errors=True)
+    os.makedirs(dest_root)
+    started = time.perf_counter()
+    main._extract_archive_direct(env['archive_path'], dest_root, _quiet_progress, 0, 100, workers=workers)
+    elapsed = time.perf_counter() - started
+    if not os.path.exists(os.path.join(dest_root, 'BackOffice.exe')):
+        raise RuntimeError("Распаковка не создала BackOffice.exe")
+    return elapsed, env['dataset']['archive_bytes']
+
+
+def bench_extract_single(env):
+    return _timed_extract(env, 1)
+
+
+def bench_extract_parallel(env):
+    return _timed_extract(env, main._get_extract_workers(make_config(env)))
+
+
+def _timed_install(env, overrides):
+    """Полный путь find_or_download_installer: скачивание, распаковка, проверка, индекс кэша."""
+    config = make_config(env, overrides)
+    shutil.rmtree(env['installer_root'], ignore_errors=True)
+    _clear_temp_archive(os.path.join(tempfile.gettempdir(), env['installer_name'] + '.zip'))
+    started = time.perf_counter()
+    installer_path = main.find_or_download_installer(config, APP_TYPE, VERSION, 'iiko', _quiet_status, _quiet_progress)
+    elapsed = time.perf_counter() - started
+    if installer_path is None:
+        raise RuntimeError("find_or_download_installer не подготовил дистрибутив")
+    return elapsed, env['dataset']['archive_bytes']
+
+
+def bench_install_http_streaming(env):
+    return _timed_install(env, {('SourcePriority', 'Order'): 'http', ('SourcePriority', 'Mode'): 'sequential',
+                                ('HttpSource', 'Segments'): '1', ('Settings', 'StreamingExtraction'): 'True'})
+
+
+def bench_install_smb(env):
+    return _timed_install(env, {('SourcePriority', 'Order'): 'smb', ('SourcePriority', 'Mode'): 'sequential'})
+
+
+def bench_edit_config(env, iterations=200):
+    config_path = os.path.join(env['work_dir'], 'backclient.config.xml')
+    build_config_xml(config_path)
+    started = time.perf_counter()
+    for index in range(iterations):
+        if not main.edit_config_file(config_path, f"server{index}.example", 443, 'https', _quiet_status):
+            raise RuntimeError("edit_config_file вернул ошибку")
+    return (time.perf_counter() - started) / iterations, None
+
+
+BENCHMARKS = {
+    'download_http_single': bench_http_single,
+    'download_http_segmented': bench_http_segmented,
+    'download_ftp': bench_ftp,
+    'download_smb': bench_smb,
+    'extract_direct_1_worker': bench_extract_single,
+    'extract_direct_parallel': bench_extract_parallel,
+    'install_http_streaming': bench_install_http_streaming,
+    'install_smb': bench_install_smb,
+    'edit_config_file': bench_edit_config,
+}
+
+
+def run_benchmarks(env, names, repeat):
+    """Выполняет замеры. Первый прогон каждого замера - прогрев, он не учитывается."""
+    results = {}
+    with open(os.devnull, 'w') as devnull:
+        for name in names:
+            runs = []
+            size_bytes = None
+            for attempt in range(repeat + 1):
+                # Журнал лаунчера не нужен в выводе бенчмарка (ошибки по-прежнему идут в stderr)
+                with contextlib.redirect_stdout(devnull):
+                    elapsed, size_bytes = BENCHMARKS[name](env)
+                if attempt > 0:
+                    runs.append(elapsed)
+            median = statistics.median(runs)
+            results[name] = {
+                'runs_sec': [round(value, 6) for value in runs],
+                'min_sec': round(min(runs), 6),
+                'median_sec': round(median, 6),
+                'mb_per_sec': round(size_bytes / median / (1024 * 1024), 2) if size_bytes else None
+            }
+            print(f"{name:<28} медиана {median * 1000:>10.1f} мс"
+                  + (f"  {results[name]['mb_per_sec']:>8.1f} МБ/с" if size_bytes else ""), flush=True)
+    return results
+
+
+def print_comparison(baseline, current, threshold_percent):
+    """Сравнивает медианы с прошлым результатом. Замедление больше порога помечается как регрессия."""
+    print(f"\n{'Замер':<28} {'было, мс':>10} {'стало, мс':>10} {'изменение':>10}")
+    regressions = 0
+    for name, result in current['results'].items():
+        previous = baseline.get('results', {}).get(name)
+        if previous is None:
+            print(f"{name:<28} {'-':>10} {result['median_sec'] * 1000:>10.1f} {'новый':>10}")
+            continue
+        change = (result['median_sec'] - previous['median_sec']) / previous['median_sec'] * 100
+        mark = ''
+        if change > threshold_percent:
+            mark = '  <- регрессия'
+            regressions += 1
+        elif change < -threshold_percent:
+            mark = '  <- ускорение'
+        print(f"{name:<28} {previous['median_sec'] * 1000:>10.1f} {result['median_sec'] * 1000:>10.1f} {change:>+9.1f}%{mark}")
+    if baseline.get('meta', {}).get('dataset') != current['meta']['dataset']:
+        print("Внимание: наборы данных различаются, сравнение может быть некорректным.")
+    return regressions
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк скачивания, распаковки и правки конфига BOlauncher.")
+    parser.add_argument('--output', default='benchmark_results.json', help="Файл результатов JSON (по умолчанию benchmark_results.json)")
+    parser.add_argument('--compare', help="Файл результатов прошлого запуска для сравнения")
+    parser.add_argument('--threshold', type=float, default=10.0, help="Порог регрессии/ускорения медианы, %% (по умолчанию 10)")
+    parser.add_argument('--repeat', type=int, default=3, help="Число учитываемых повторов каждого замера (по умолчанию 3)")
+    parser.add_argument('--small-files', type=int, default=3000, help="Число мелких файлов в архиве (по умолчанию 3000)")
+    parser.add_argument('--large-files', type=int, default=3, help="Число крупных файлов в архиве (по умолчанию 3)")
+    parser.add_argument('--large-mb', type=int, default=32, help="Размер крупного файла, МБ (по умолчанию 32)")
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help="Выполнить только указанные замеры")
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix='bolauncher_bench_')
+    try:
+        source_dir = os.path.join(work_dir, 'source')
+        os.makedirs(source_dir)
+        archive_path = os.path.join(source_dir, f"RMSOffice{VERSION}.zip")
+        print("Создание синтетического дистрибутива...", flush=True)
+        dataset = build_archive(archive_path, args.small_files, args.large_files, args.large_mb)
+        print(f"Архив: {dataset['members']} файлов, {dataset['archive_bytes'] / (1024 * 1024):.1f} МБ", flush=True)
+
+        http_server, http_port = start_http_server(source_dir)
+        ftp_server, ftp_port = start_ftp_server(source_dir)
+        env = {
+            'work_dir': work_dir,
+            'source_dir': source_dir,
+            'archive_path': archive_path,
+            'installer_root': os.path.join(work_dir, 'installers'),
+            'installer_name': main.DEFAULT_CONFIG['LocalInstallerNames'][APP_TYPE] + VERSION,
+            'temp_archive_path': os.path.join(work_dir, 'download', f"RMSOffice{VERSION}.zip"),
+            'http_port': http_port,
+            'ftp_port': ftp_port,
+            'dataset': dataset,
+        }
+        os.makedirs(os.path.dirname(env['temp_archive_path']))
+        main.init_http_session(make_config(env))
+
+        results = run_benchmarks(env, args.only or list(BENCHMARKS), args.repeat)
+        http_server.shutdown()
+        ftp_server.shutdown()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'repeat': args.repeat,
+            'dataset': dataset,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты записаны в {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        print_comparison(baseline, report, args.threshold)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -1,10 +1,15 @@
-import tkinter as tk
-from tkinter import ttk, messagebox
-from tkinter import scrolledtext
+try:
+    import tkinter as tk
+    from tkinter import ttk, messagebox
+    from tkinter import scrolledtext
+except ImportError: # Python без Tk (серверная сборка) - доступен только консольный режим --headless
+    tk = ttk = messagebox = scrolledtext = None
 import configparser
 import os
 import sys
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
 import threading
 import subprocess
@@ -15,34 +20,87 @@ import re
 import json
 import urllib.parse
 import tempfile
+import io
+import queue
+import atexit
+import select
+import socket
+import concurrent.futures
+import hashlib
+import struct
+import contextlib
+import uuid
+import zlib
+import mmap
 
 # Объявляем глобальную переменную для отладочного логирования на уровне модуля
 # Инициализируем ее значением по умолчанию. Реальное значение будет загружено из конфига.
 global_debug_logging = False
+global_log_to_stderr = False # В консольном режиме stdout занят результатами (JSON), журнал пишется в stderr
 
 
 # --- Конфигурация ---
 CONFIG_FILE = "config.ini"
 LOG_FILE_NAME = "debug_log.log"
+SERVER_INFO_CACHE_FILE = "server_info_cache.json" # Кэш ответов getServerMonitoringInfo.jsp
+SERVER_ENDPOINTS_FILE = "server_endpoints.json" # Запомненные схема и порт серверов
+CONFIG_TEMPLATES_DIR = "config_templates" # Шаблоны backclient.config.xml по типу приложения и версии
+LAUNCH_TRACE_FILE = "launch_trace.jsonl" # Трассы запусков (по строке JSON на запуск)
 
 # Значения конфигурации по умолчанию
 DEFAULT_CONFIG = {
     'Settings': {
         'HttpRequestTimeoutSec': '15',
+        'HttpPoolSize': '16', # Максимум соединений к одному хосту в общем пуле HTTP-сессии
+        'HttpRetries': '3', # Повторы HTTP-запроса при ошибках подключения и ответах 502/503/504
+        'HttpRetryBackoffSec': '0.5', # Базовая пауза между повторами (растет экспоненциально)
+        'ServerInfoCacheTtlSec': '60', # Сколько секунд ответ сервера о версии считается свежим (0 - не кэшировать)
         'InstallerRoot': 'C:\\iiko_Distr', # Корневой каталог для ЛОКАЛЬНЫХ дистрибутивов
         'ConfigFileWaitTimeoutSec': '60',
         'ConfigFileCheckIntervalMs': '100',
+        'ConfigFileWatcher': 'auto', # auto - события файловой системы (inotify / Windows), poll - только опрос
+        'PreseedConfig': 'True', # Готовить backclient.config.xml из шаблона до запуска (без первого запуска и перезапуска)
+        'MaxConcurrentLaunches': '3', # Сколько запусков из окна выполняются одновременно (остальные ждут очереди)
+        'LaunchTrace': 'True', # Записывать длительность шагов каждого запуска в launch_trace.jsonl
+        'LaunchTraceMaxSizeMb': '10', # Размер launch_trace.jsonl, после которого он переименовывается в launch_trace.jsonl.1 (0 - без ограничения)
+        'StreamingExtraction': 'True', # Распаковывать архив параллельно со скачиванием по HTTP (режим sequential)
+        'ArchivePrecheck': 'True', # До скачивания проверять производителя и версию BackOffice.exe в архиве (HTTP Range, SMB)
+        'ArchivePrecheckMaxMb': '64', # Не проверять заранее, если BackOffice.exe в архиве больше этого размера (сжатый)
+        'DeltaMaxChangedPercent': '50', # Обновление по разнице, только если скачать нужно не больше этой доли байт версии
+        # Общий лимит скорости фоновых передач (предзагрузка) со всех источников, КБ/с (0 - без ограничения).
+        # Одновременные процессы предзагрузки с общим InstallerRoot делят его поровну.
+        'RateLimitKBps': '0',
+        'ForegroundRateLimitKBps': '0', # Лимит скорости передач для запусков из окна и консоли, КБ/с (0 - без ограничения)
+        # Фоновые передачи приостанавливаются, пока идет скачивание для запуска в любом процессе лаунчера (отметки в InstallerRoot/.transfers)
+        'BackgroundYieldToForeground': 'True',
+        'ExtractWorkers': '0', # Число потоков распаковки архива (0 - по числу ядер процессора, не более 8)
+        'LogMaxSizeMb': '10', # Размер debug_log.log, после которого он переименовывается в debug_log.log.1
+        'LogBackupCount': '3', # Сколько старых файлов журнала хранить (debug_log.log.1 ... .N)
         'DebugLogging': 'False' # Включить подробное логирование в консоль
     },
     # Определяем ПРИОРИТЕТ источников. Перечислять через запятую.
     # Скрипт будет проверять источники в указанном порядке.
     'SourcePriority': {
-        'Order': 'smb, http, ftp'
+        'Order': 'smb, http, ftp',
+        # Режим выбора источника: sequential - по очереди в порядке Order,
+        # race - все включенные источники проверяются одновременно (HEAD / SIZE / stat)
+        'Mode': 'sequential',
+        # Для режима race: first - качать с первого ответившего, fastest - с самого быстрого по замеру скорости
+        'RaceSelect': 'first',
+        'ProbeTimeoutSec': '5', # Таймаут проверки наличия архива на источнике
+        'RaceGraceMs': '500', # Сколько ждать остальных источников после первого ответа
+        'RaceMeasureSec': '3' # Длительность замера скорости в режиме fastest
     },
     # Настройки для SMB источника
     'SmbSource': {
         'Enabled': 'False', # Включить этот источник?
         'Path': '\\\\10.25.100.5\\sharedisk\\iikoBacks', # UNC-путь к корневой папке на SMB
+        # Файл контрольных сумм SHA-256 рядом с архивами (например SHA256SUMS). Пусто - не проверять.
+        'ChecksumManifest': '',
+        # Манифест файлов версии рядом с архивом для обновления по разнице ({name} - имя архива без .zip,
+        # например {name}.files.json); сами файлы - в папке {name}. Пусто - качать только архивы целиком.
+        'FileManifest': '',
+        'RateLimitKBps': '0', # Лимит скорости фоновых передач с этого источника, КБ/с (0 - без ограничения)
         # Шаблоны имен архивов на SMB. {version} будет заменено на форматированную версию.
         # {vendor_subdir} будет заменено на "Syrve/" для Syrve и "" для iiko.
         # Важно: эти шаблоны относятся к именам ZIP-АРХИВОВ на SMB.
@@ -55,6 +113,15 @@ DEFAULT_CONFIG = {
     'HttpSource': {
         'Enabled': 'True', # Включить этот источник?
         'Url': 'https://f.serty.top/iikoBacks', # Базовый URL директории с архивами
+        # Число параллельных соединений (Range-запросов) при скачивании архива. 1 - обычное скачивание одним потоком.
+        'Segments': '4',
+        'SegmentMinSizeMb': '16', # Архивы меньше этого размера качаются одним потоком
+        # Файл контрольных сумм SHA-256 рядом с архивами (например SHA256SUMS). Пусто - не проверять.
+        'ChecksumManifest': '',
+        # Манифест файлов версии рядом с архивом для обновления по разнице ({name} - имя архива без .zip,
+        # например {name}.files.json); сами файлы - в папке {name}. Пусто - качать только архивы целиком.
+        'FileManifest': '',
+        'RateLimitKBps': '0', # Лимит скорости фоновых передач с этого источника, КБ/с (0 - без ограничения)
         # Шаблоны имен архивов на HTTP. {version} будет заменено на форматированную версию.
         # {vendor_subdir} будет заменено на "Syrve/" для Syrve и "" для iiko.
         'iikoRMS_ArchiveName': 'RMSOffice{version}.zip',
@@ -70,6 +137,12 @@ DEFAULT_CONFIG = {
         'Username': 'ftpuser',
         'Password': '11', # Внимание: хранение паролей в конфиге небезопасно!
         'Directory': '/iikoBacks', # Путь к директории с архивами на FTP сервере
+        # Файл контрольных сумм SHA-256 рядом с архивами (например SHA256SUMS). Пусто - не проверять.
+        'ChecksumManifest': '',
+        # Манифест файлов версии рядом с архивом для обновления по разнице ({name} - имя архива без .zip,
+        # например {name}.files.json); сами файлы - в папке {name}. Пусто - качать только архивы целиком.
+        'FileManifest': '',
+        'RateLimitKBps': '0', # Лимит скорости фоновых передач с этого источника, КБ/с (0 - без ограничения)
         # Шаблоны имен архивов на FTP. {version} будет заменено на форматированную версию.
         # {vendor_subdir} будет заменено на "Syrve/" для Syrve и "" для iiko.
         'iikoRMS_ArchiveName': 'RMSOffice{version}.zip',
@@ -77,6 +150,15 @@ DEFAULT_CONFIG = {
         'SyrveRMS_ArchiveName': 'Syrve/RMSSOffice{version}.zip', # Указываем подпапку Syrve
         'SyrveChain_ArchiveName': 'Syrve/ChainSOffice{version}.zip' # Указываем подпапку Syrve
     },
+    # Управление локальным кэшем дистрибутивов в InstallerRoot (индекс cache_index.json)
+    'Cache': {
+        'MaxSizeGb': '0', # Максимальный суммарный размер дистрибутивов (0 - без ограничения)
+        'MaxVersions': '0', # Максимальное количество версий (0 - без ограничения)
+        # Папки, которые никогда не вытесняются (через запятую), например: RMSOffice887, ChainOffice887
+        'PinnedVersions': '',
+        # Хранить одинаковые файлы разных версий один раз (InstallerRoot/.objects, жесткие ссылки)
+        'Deduplicate': 'True'
+    },
     # Определяем ФОРМАТ имен ПАПОК для ЛОКАЛЬНОГО хранения дистрибутивов.
     # Это ИМЯ КАТАЛОГА, а не архива.
     'LocalInstallerNames': {
@@ -182,48 +264,191 @@ def get_config_value(config, section, key, default=None, type_cast=str):
         return default
 
 
-def log_message(message, level="INFO"):
-    """Выводит сообщение в консоль с временной меткой и уровнем."""
-    # Объявляем, что используем глобальную переменную
-    global global_debug_logging
+# Запись журнала в файл: вызывающие потоки кладут строки в очередь, один поток-писатель
+# пишет их пачками в постоянно открытый файл и переименовывает его при превышении размера.
+_log_queue = queue.Queue()
+_log_writer_thread = None
+_log_writer_lock = threading.Lock()
+_log_max_bytes = 10 * 1024 * 1024
+_log_backup_count = 3
+_LOG_BATCH_MAX_LINES = 1000 # Больше строк за одну запись не берем, чтобы не задерживать ротацию
+
+
+def init_logging(config):
+    """Применяет настройки журнала из конфига: DebugLogging, LogMaxSizeMb, LogBackupCount."""
+    global global_debug_logging, _log_max_bytes, _log_backup_count
+    _log_max_bytes = max(0, get_config_value(config, 'Settings', 'LogMaxSizeMb', default=10, type_cast=int)) * 1024 * 1024
+    _log_backup_count = max(0, get_config_value(config, 'Settings', 'LogBackupCount', default=3, type_cast=int))
+    global_debug_logging = get_config_value(config, 'Settings', 'DebugLogging', default=False, type_cast=bool)
+
 
-    timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-    formatted_message = f"[{timestamp}] [{level}] {message}"
+def _rotate_log_files(log_path, backup_count):
+    """Сдвигает debug_log.log -> .1 -> .2 ... (старейший удаляется). Без резервных копий файл просто обнуляется."""
+    if backup_count <= 0:
+        open(log_path, 'w').close()
+        return
+    for index in range(backup_count - 1, 0, -1):
+        older = f"{log_path}.{index}"
+        if os.path.exists(older):
+            os.replace(older, f"{log_path}.{index + 1}")
+    os.replace(log_path, f"{log_path}.1")
+
+
+def _log_writer_loop():
+    """Поток-писатель журнала: забирает из очереди все накопившиеся строки и пишет их одной операцией."""
+    log_file = None
+    try:
+        while True:
+            line = _log_queue.get()
+            stop = line is None
+            batch = [] if stop else [line]
+            while not stop and len(batch) < _LOG_BATCH_MAX_LINES:
+                try:
+                    line = _log_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if line is None:
+                    stop = True
+                else:
+                    batch.append(line)
 
-    # Проверяем уровень отладки перед выводом сообщения
+            if batch:
+                data = ''.join(batch).encode('utf-8') # Двоичный режим: размер для ротации считается в байтах
+                try:
+                    if log_file is None:
+                        log_file = open(LOG_FILE_NAME, 'ab')
+                    if _log_max_bytes and log_file.tell() > 0 and log_file.tell() + len(data) > _log_max_bytes:
+                        log_file.close()
+                        log_file = None
+                        _rotate_log_files(LOG_FILE_NAME, _log_backup_count)
+                        log_file = open(LOG_FILE_NAME, 'ab')
+                    log_file.write(data)
+                    log_file.flush()
+                except Exception as e:
+                    # Важно: не используем log_message здесь, чтобы избежать рекурсии при ошибке записи лога.
+                    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] [ERROR] Ошибка записи в лог-файл '{LOG_FILE_NAME}': {e}", file=sys.stderr)
+                    if log_file is not None:
+                        log_file.close()
+                        log_file = None
+            if stop:
+                break
+    finally:
+        if log_file is not None:
+            log_file.close()
+
+
+def _ensure_log_writer():
+    """Запускает поток-писатель журнала при первой записи в файл."""
+    global _log_writer_thread
+    with _log_writer_lock:
+        if _log_writer_thread is None or not _log_writer_thread.is_alive():
+            _log_writer_thread = threading.Thread(target=_log_writer_loop, name="log-writer", daemon=True)
+            _log_writer_thread.start()
+
+
+def flush_logging(timeout_sec=5.0):
+    """Дописывает очередь журнала в файл и останавливает поток-писатель (вызывается при выходе)."""
+    global _log_writer_thread
+    with _log_writer_lock:
+        writer = _log_writer_thread
+        _log_writer_thread = None
+    if writer is not None and writer.is_alive():
+        _log_queue.put(None)
+        writer.join(timeout_sec)
+
+
+atexit.register(flush_logging)
+
+
+def log_message(message, *args, level="INFO"):
+    """Выводит сообщение в консоль с временной меткой и уровнем.
+       Если переданы args, сообщение - шаблон для message % args: на частых вызовах строка
+       собирается только после проверки уровня, а не f-строкой у вызывающего.
+    """
+    # Отладочные сообщения отбрасываем до форматирования строки, если они выключены
     if level == "DEBUG" and not global_debug_logging:
-        pass # Пропускаем отладочные сообщения, если не включено
-    else:
-        print(formatted_message, file=sys.stdout if level != "ERROR" else sys.stderr)
-    
+        return
+    if args:
+        message = message % args
+
+    formatted_message = f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] [{level}] {message}"
+    print(formatted_message, file=sys.stdout if level != "ERROR" and not global_log_to_stderr else sys.stderr)
+
     if global_debug_logging:
-        try:
-            # Открываем файл в режиме добавления ('a'), создаем его, если не существует.
-            # Используем кодировку UTF-8 для поддержки русских символов.
-            with open(LOG_FILE_NAME, 'a', encoding='utf-8') as log_file:
-                log_file.write(formatted_message + '\n')
-        except Exception as e:
-            # Если запись в лог-файл не удалась, выводим ошибку в консоль.
-            # Важно: не используем log_message здесь, чтобы избежать рекурсии при ошибке записи лога.
-            print(f"[{timestamp}] [ERROR] Ошибка записи в лог-файл '{LOG_FILE_NAME}': {e}", file=sys.stderr)
+        # Файл пишет отдельный поток; здесь только постановка строки в очередь
+        if _log_writer_thread is None:
+            _ensure_log_writer()
+        _log_queue.put(formatted_message + os.linesep)
+
+
+# Общая HTTP-сессия процесса: пул соединений с keep-alive для серверов iiko/Syrve и сервера дистрибутивов
+http_session = None
+_http_session_lock = threading.Lock()
+
+
+def init_http_session(config):
+    """Создает (или пересоздает) общую HTTP-сессию с пулом соединений и политикой повторов из конфига."""
+    global http_session
+    pool_size = get_config_value(config, 'Settings', 'HttpPoolSize', default=16, type_cast=int)
+    retries = get_config_value(config, 'Settings', 'HttpRetries', default=3, type_cast=int)
+    backoff = get_config_value(config, 'Settings', 'HttpRetryBackoffSec', default=0.5, type_cast=float)
+
+    retry_policy = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=backoff,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(['HEAD', 'GET']), # Повторяем только идемпотентные запросы
+        raise_on_status=False # После исчерпания повторов вернуть последний ответ, а не RetryError
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry_policy)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    with _http_session_lock:
+        old_session = http_session
+        http_session = session
+    if old_session is not None:
+        old_session.close()
+    log_message(f"DEBUG: HTTP-сессия создана (пул {pool_size} соединений на хост, повторов {retries}, пауза {backoff} сек).", level="DEBUG")
+    return session
+
+
+def get_http_session():
+    """Возвращает общую HTTP-сессию процесса (при первом обращении создается с настройками по умолчанию)."""
+    with _http_session_lock:
+        session = http_session
+    if session is None:
+        default_config = configparser.ConfigParser()
+        default_config.read_dict(DEFAULT_CONFIG)
+        session = init_http_session(default_config)
+    return session
 
 
 def parse_target_string(input_string):
     """Парсит входную строку (URL или IP:Port)."""
-    log_message(f"DEBUG: Начат парсинг строки: '{input_string}'")
+    log_message(f"DEBUG: Начат парсинг строки: '{input_string}'", level="DEBUG")
     if not input_string or not input_string.strip():
         log_message("Входная строка для парсинга пуста.", level="ERROR")
         return None
 
     url_or_ip = None
     port = 443 # Порт по умолчанию
+    port_explicit = False # Был ли порт указан во входной строке
     is_ip_address = False
 
+    # Явно указанная схема используется как подсказка при определении протокола сервера
+    scheme_match = re.match(r"^(https?)://", input_string.strip(), flags=re.IGNORECASE)
+    scheme = scheme_match.group(1).lower() if scheme_match else None
+
     # Удаляем потенциальную схему и символы авторизации (@) для упрощения парсинга хоста/порта
     temp_input = re.sub(r"^(https?|ftp|ftps)://", "", input_string, flags=re.IGNORECASE)
     temp_input = re.sub(r"^[^@]+@", "", temp_input) # Удаляем user:pass@ если есть
 
-    log_message(f"DEBUG: Строка после удаления схемы/авторизации: '{temp_input}'")
+    log_message(f"DEBUG: Строка после удаления схемы/авторизации: '{temp_input}'", level="DEBUG")
 
     # Разделяем хост и порт. Ищем последнее двоеточие, которое не является частью IPv6 адреса.
     # Для простоты пока ищем двоеточие, за которым следуют цифры до конца строки или слэша.
@@ -231,15 +456,17 @@ def parse_target_string(input_string):
     if port_match:
         try:
             port = int(port_match.group(1))
-            log_message(f"DEBUG: Порт '{port}' извлечен из исходной строки.")
+            port_explicit = True
+            log_message(f"DEBUG: Порт '{port}' извлечен из исходной строки.", level="DEBUG")
             # Удаляем часть с портом из строки для парсинга хоста
             temp_input_for_host = temp_input[:port_match.start()]
         except ValueError:
             log_message(f"DEBUG: Не удалось распарсить порт из '{port_match.group(1)}', используется порт по умолчанию 443.", level="WARNING")
             temp_input_for_host = temp_input # Используем исходную строку без удаления порта
             port = 443
+            port_explicit = False
     else:
-         log_message("DEBUG: Явный порт не найден, используется порт по умолчанию 443.")
+         log_message("DEBUG: Явный порт не найден, используется порт по умолчанию 443.", level="DEBUG")
          temp_input_for_host = temp_input # Нет порта для удаления
 
 
@@ -253,23 +480,25 @@ def parse_target_string(input_string):
          octets = url_or_ip.split('.')
          if len(octets) == 4 and all(0 <= int(octet) <= 255 for octet in octets):
              is_ip_address = True
-             log_message("DEBUG: Хост определен как IP-адрес IPv4.")
+             log_message("DEBUG: Хост определен как IP-адрес IPv4.", level="DEBUG")
          else:
              log_message(f"DEBUG: Хост '{url_or_ip}' выглядит как IP, но октеты неверны или их количество не 4.", level="WARNING")
     # Можно добавить проверку на IPv6, но для простоты пока ограничимся IPv4
 
-    log_message(f"DEBUG: Парсинг завершен: Хост/IP: '{url_or_ip}', Порт: {port}, IsIpAddress: {is_ip_address}")
+    log_message(f"DEBUG: Парсинг завершен: Хост/IP: '{url_or_ip}', Порт: {port}, IsIpAddress: {is_ip_address}", level="DEBUG")
 
     return {
         'UrlOrIp': url_or_ip,
         'Port': port,
+        'PortExplicit': port_explicit,
+        'Scheme': scheme,
         'IsIpAddress': is_ip_address
     }
 
 
 def format_version(version_string):
     """Форматирует строку версии, возвращая только первые цифры из трёх первых частей."""
-    log_message(f"DEBUG: Форматирование версии: '{version_string}'")
+    log_message(f"DEBUG: Форматирование версии: '{version_string}'", level="DEBUG")
     if not version_string:
         log_message("Входная строка версии пуста.", level="WARNING")
         return ""
@@ -295,13 +524,13 @@ def format_version(version_string):
         log_message(f"Не удалось извлечь первые цифры из первых трех частей версии '{version_string}'. Возвращаем исходную строку.", level="WARNING")
         return version_string # Возвращаем исходную строку
 
-    log_message(f"DEBUG: Форматированная версия: '{result}'")
+    log_message(f"DEBUG: Форматированная версия: '{result}'", level="DEBUG")
     return result
 
 
 def determine_app_type(input_string, edition):
     """Определяет тип приложения и производителя на основе входной строки и edition."""
-    log_message(f"DEBUG: Определение типа приложения для строки '{input_string}' и edition '{edition}'")
+    log_message(f"DEBUG: Определение типа приложения для строки '{input_string}' и edition '{edition}'", level="DEBUG")
     vendor = "iiko" # По умолчанию
     # Проверяем входную строку на наличие "syrve" (без учета регистра)
     if "syrve" in input_string.lower():
@@ -323,7 +552,7 @@ def determine_app_type(input_string, edition):
         log_message(f"Значение 'edition' из ответа сервера пустое или отсутствует. Не удалось автоматически определить тип приложения.", level="WARNING")
         return None # Требуется выбор пользователя, так как edition не определен
 
-    log_message(f"DEBUG: Определен тип приложения: '{app_type}' (Производитель: '{vendor}')")
+    log_message(f"DEBUG: Определен тип приложения: '{app_type}' (Производитель: '{vendor}')", level="DEBUG")
     return {
         'AppType': app_type,
         'Vendor': vendor
@@ -331,7 +560,7 @@ def determine_app_type(input_string, edition):
 
 def get_expected_installer_name(config, app_type, version_formatted):
     """Формирует ожидаемое имя ЛОКАЛЬНОГО каталога дистрибутива на основе конфига."""
-    log_message(f"DEBUG: Формирование имени ЛОКАЛЬНОГО каталога дистрибутива для типа '{app_type}' и версии '{version_formatted}'")
+    log_message(f"DEBUG: Формирование имени ЛОКАЛЬНОГО каталога дистрибутива для типа '{app_type}' и версии '{version_formatted}'", level="DEBUG")
 
     # Читаем базовое имя из конфига LocalInstallerNames
     base_name = get_config_value(config, 'LocalInstallerNames', app_type, default=None, type_cast=str)
@@ -341,12 +570,12 @@ def get_expected_installer_name(config, app_type, version_formatted):
         return None
 
     result_name = f"{base_name}{version_formatted}"
-    log_message(f"DEBUG: Ожидаемое имя ЛОКАЛЬНОГО каталога дистрибутива: '{result_name}'")
+    log_message(f"DEBUG: Ожидаемое имя ЛОКАЛЬНОГО каталога дистрибутива: '{result_name}'", level="DEBUG")
     return result_name
 
 def sanitize_for_path(input_string):
     """Очищает строку для использования в пути к файлу, удаляя или заменяя недопустимые символы."""
-    log_message(f"DEBUG: Санитизация строки для пути: '{input_string}'")
+    log_message(f"DEBUG: Санитизация строки для пути: '{input_string}'", level="DEBUG")
     # Заменяем двоеточие на тире (часто используется в URL:порт)
     sanitized = input_string.replace(':', '-')
     # Удаляем недопустимые символы Windows
@@ -362,273 +591,1233 @@ def sanitize_for_path(input_string):
     if not sanitized:
         sanitized = "default_name"
         log_message(f"Внимание: Строка стала пустой после санитизации. Используется имя по умолчанию: '{sanitized}'", level="WARNING")
-    log_message(f"DEBUG: Санитизированная строка: '{sanitized}'")
+    log_message(f"DEBUG: Санитизированная строка: '{sanitized}'", level="DEBUG")
     return sanitized
 
 import ctypes
 import ctypes.wintypes
 
-def get_file_company_name(filepath):
-    """Получает CompanyName из свойств файла через WinAPI (только для Windows)."""
-    # Проверяем, что мы на Windows
-    if os.name != 'nt':
-        log_message(f"DEBUG: get_file_company_name через WinAPI доступна только на Windows. Текущая ОС: {os.name}", level="DEBUG")
-        return None # Возвращаем None, если не на Windows
-
-    log_message(f"DEBUG: Попытка чтения CompanyName из файла через WinAPI: '{filepath}'")
+# --- Чтение ресурса версии (VS_VERSIONINFO) из PE-файла ---
+
+_RT_VERSION = 16 # Тип ресурса "версия" в каталоге ресурсов PE
+_VS_FIXEDFILEINFO_SIGNATURE = 0xFEEF04BD
+_version_info_cache = {} # Путь -> (mtime_ns, размер, сведения о версии)
+_version_info_cache_lock = threading.Lock()
+
+
+class _InvalidPEFile(Exception):
+    """Файл не является корректным PE или его ресурсы повреждены."""
+    pass
+
+
+def _align4(offset):
+    return (offset + 3) & ~3
+
+
+def _pe_rva_to_offset(sections, rva):
+    """Переводит RVA в смещение в файле по таблице секций."""
+    for virtual_address, virtual_size, raw_pointer, raw_size in sections:
+        if virtual_address <= rva < virtual_address + max(virtual_size, raw_size):
+            return raw_pointer + (rva - virtual_address)
+    raise _InvalidPEFile(f"RVA 0x{rva:x} не попадает ни в одну секцию")
+
+
+def _pe_first_resource_entry(data, resource_offset, directory_offset, wanted_id=None):
+    """Возвращает поле OffsetToData записи каталога ресурсов (с нужным ID или первой по порядку)."""
+    named_count, id_count = struct.unpack_from('<HH', data, resource_offset + directory_offset + 12)
+    entries_offset = resource_offset + directory_offset + 16
+    for index in range(named_count + id_count):
+        name, offset_to_data = struct.unpack_from('<II', data, entries_offset + index * 8)
+        if wanted_id is None or (not name & 0x80000000 and name == wanted_id):
+            return offset_to_data
+    return None
+
+
+def _find_version_resource(data):
+    """Находит блок VS_VERSIONINFO в отображенном PE-файле. Возвращает (смещение, размер) или None."""
+    if data[:2] != b'MZ':
+        raise _InvalidPEFile("нет сигнатуры MZ")
+    pe_offset = struct.unpack_from('<I', data, 0x3C)[0]
+    if data[pe_offset:pe_offset + 4] != b'PE\0\0':
+        raise _InvalidPEFile("нет сигнатуры PE")
+    section_count = struct.unpack_from('<H', data, pe_offset + 6)[0]
+    optional_header_size = struct.unpack_from('<H', data, pe_offset + 20)[0]
+    optional_header = pe_offset + 24
+    magic = struct.unpack_from('<H', data, optional_header)[0]
+    if magic == 0x10B: # PE32
+        directories_count_offset = optional_header + 92
+    elif magic == 0x20B: # PE32+
+        directories_count_offset = optional_header + 108
+    else:
+        raise _InvalidPEFile(f"неизвестный формат заголовка 0x{magic:x}")
+    if struct.unpack_from('<I', data, directories_count_offset)[0] <= 2:
+        return None # Каталога ресурсов нет
+    resource_rva, resource_size = struct.unpack_from('<II', data, directories_count_offset + 4 + 2 * 8)
+    if not resource_rva or not resource_size:
+        return None
 
-    if not os.path.isfile(filepath):
+    sections = []
+    section_table = optional_header + optional_header_size
+    for index in range(section_count):
+        virtual_size, virtual_address, raw_size, raw_pointer = struct.unpack_from('<IIII', data, section_table + index * 40 + 8)
+        sections.append((virtual_address, virtual_size, raw_pointer, raw_size))
+    resource_offset = _pe_rva_to_offset(sections, resource_rva)
+
+    # Три уровня каталога: тип (RT_VERSION) -> имя (первое) -> язык (первый)
+    entry = _pe_first_resource_entry(data, resource_offset, 0, _RT_VERSION)
+    for _ in range(2):
+        if entry is None or not entry & 0x80000000:
+            return None
+        entry = _pe_first_resource_entry(data, resource_offset, entry & 0x7FFFFFFF)
+    if entry is None or entry & 0x80000000:
+        return None
+    data_rva, data_size = struct.unpack_from('<II', data, resource_offset + entry)
+    return _pe_rva_to_offset(sections, data_rva), data_size
+
+
+def _parse_version_block(block, offset, limit):
+    """Разбирает узел дерева VS_VERSIONINFO. Возвращает (ключ, тип значения, значение, дочерние узлы, конец узла)."""
+    length, value_length, value_type = struct.unpack_from('<HHH', block, offset)
+    if length < 6:
+        raise _InvalidPEFile("узел ресурса версии нулевой длины")
+    end = min(offset + length, limit)
+    key_end = offset + 6
+    while key_end + 1 < end and block[key_end:key_end + 2] != b'\0\0':
+        key_end += 2
+    key = block[offset + 6:key_end].decode('utf-16-le', errors='replace')
+    position = _align4(key_end + 2)
+    if value_type == 1:
+        # Текстовое значение: длина указана в символах, но не все компиляторы ресурсов пишут ее одинаково - читаем до нуля
+        value = ''
+        if value_length:
+            text = block[position:end].decode('utf-16-le', errors='replace')
+            value = text.split('\0', 1)[0]
+            position = end
+    else:
+        value = block[position:position + value_length]
+        position = _align4(position + value_length)
+    children = []
+    while position + 6 <= end:
+        child = _parse_version_block(block, position, end)
+        children.append(child)
+        position = _align4(child[4])
+    return key, value_type, value, children, end
+
+
+def _parse_version_info(block):
+    """Извлекает строки StringFileInfo и FileVersion/ProductVersion из VS_FIXEDFILEINFO."""
+    key, _, fixed_info, children, _ = _parse_version_block(block, 0, len(block))
+    if key != 'VS_VERSION_INFO':
+        raise _InvalidPEFile(f"неожиданный ключ корневого узла '{key}'")
+    info = {}
+    if len(fixed_info) >= 24 and struct.unpack_from('<I', fixed_info, 0)[0] == _VS_FIXEDFILEINFO_SIGNATURE:
+        file_ms, file_ls, product_ms, product_ls = struct.unpack_from('<IIII', fixed_info, 8)
+        info['FileVersion'] = f"{file_ms >> 16}.{file_ms & 0xFFFF}.{file_ls >> 16}.{file_ls & 0xFFFF}"
+        info['ProductVersion'] = f"{product_ms >> 16}.{product_ms & 0xFFFF}.{product_ls >> 16}.{product_ls & 0xFFFF}"
+
+    string_tables = {}
+    translations = []
+    for child_key, _, _, grandchildren, _ in children:
+        if child_key == 'StringFileInfo':
+            for table_key, _, _, strings, _ in grandchildren:
+                string_tables[table_key.lower()] = {name: value.strip() for name, _, value, _, _ in strings}
+        elif child_key == 'VarFileInfo':
+            for var_key, _, var_value, _, _ in grandchildren:
+                if var_key == 'Translation':
+                    for index in range(0, len(var_value) - 3, 4):
+                        language, codepage = struct.unpack_from('<HH', var_value, index)
+                        translations.append(f'{language:04x}{codepage:04x}')
+    # Как и VerQueryValue: таблица первого перевода из VarFileInfo, иначе первая имеющаяся
+    table = next((string_tables[name] for name in translations if name in string_tables), None)
+    if table is None and string_tables:
+        table = next(iter(string_tables.values()))
+    for name in ('CompanyName', 'FileVersion', 'ProductVersion'):
+        if table and table.get(name):
+            info[name] = table[name]
+    return info
+
+
+def _read_version_info_from_file(f):
+    """Читает сведения о версии из открытого PE-файла, отображая его в память."""
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        location = _find_version_resource(data)
+        if location is None:
+            return {}
+        block_offset, block_size = location
+        return _parse_version_info(bytes(data[block_offset:block_offset + block_size]))
+
+
+def get_file_version_info(filepath):
+    """Читает CompanyName, FileVersion и ProductVersion из ресурса версии PE-файла.
+       Файл отображается в память, читаются только заголовки и сам ресурс. Результат кэшируется
+       по пути, времени изменения и размеру файла. Возвращает словарь (возможно пустой) или None при ошибке.
+    """
+    try:
+        stat_result = os.stat(filepath)
+    except OSError:
         log_message(f"Ошибка: Файл не найден для чтения метаданных: '{filepath}'", level="ERROR")
         return None
+    cache_key = os.path.abspath(filepath)
+    stamp = (stat_result.st_mtime_ns, stat_result.st_size)
+    with _version_info_cache_lock:
+        cached = _version_info_cache.get(cache_key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    log_message(f"DEBUG: Чтение ресурса версии из файла: '{filepath}'", level="DEBUG")
+    try:
+        with open(filepath, 'rb') as f:
+            info = _read_version_info_from_file(f)
+    except (_InvalidPEFile, struct.error, ValueError, OSError) as e:
+        log_message(f"Ошибка при чтении ресурса версии из файла '{filepath}': {e}", level="WARNING")
+        return None
+    if not info:
+        log_message(f"DEBUG: Информация о версии отсутствует в файле '{filepath}'.", level="DEBUG")
+    log_message(f"DEBUG: Сведения о версии '{filepath}': {info}", level="DEBUG")
+    with _version_info_cache_lock:
+        _version_info_cache[cache_key] = (stamp, info)
+    return info
+
+
+def get_file_company_name(filepath):
+    """Получает CompanyName из ресурса версии файла (None, если его нет или файл не читается)."""
+    info = get_file_version_info(filepath)
+    if not info or not info.get('CompanyName'):
+        log_message(f"CompanyName не найдено в метаданных файла '{filepath}' (или ошибка чтения).", level="WARNING")
+        return None
+    return info['CompanyName']
+
+
+class OperationCancelled(Exception):
+    """Операция прервана по запросу (проигравший в гонке источников, отмена пользователем)."""
+    pass
+
+
+# Соответствие коротких имен источников и секций конфига
+SOURCE_SECTIONS = {
+    'smb': 'SmbSource',
+    'http': 'HttpSource',
+    'ftp': 'FtpSource'
+}
 
+
+def _partial_archive_path(temp_archive_path, source_type):
+    """Возвращает путь к частично скачанному архиву для конкретного источника."""
+    # У каждого источника свой частичный файл: при гонке источников передачи не мешают друг другу,
+    # а в temp_archive_path попадает только полностью скачанный архив.
+    return f"{temp_archive_path}.{source_type}.part"
+
+
+def _remove_file_quietly(filepath):
+    """Удаляет файл, если он существует, не выбрасывая исключений."""
     try:
-        # Получаем размер блока версии
-        size = ctypes.windll.version.GetFileVersionInfoSizeW(filepath, None)
-        if size == 0:
-            log_message(f"DEBUG: Информация о версии отсутствует в файле '{filepath}'.", level="DEBUG")
-            return None
+        if os.path.exists(filepath):
+            os.remove(filepath)
+            log_message("DEBUG: Удален файл '%s'.", filepath, level="DEBUG")
+    except Exception as e:
+        log_message(f"Внимание: Не удалось удалить файл '{filepath}': {e}", level="WARNING")
 
-        # Читаем блок версии
-        res = ctypes.create_string_buffer(size)
-        # Внимание: GetFileVersionInfoW может вернуть 0 при ошибке, но ctypes.windll не генерирует исключение по умолчанию.
-        # Для более надежной обработки ошибок WinAPI можно использовать check_last_error=True
-        if ctypes.windll.version.GetFileVersionInfoW(filepath, 0, size, res) == 0:
-             last_error = ctypes.GetLastError()
-             log_message(f"Ошибка WinAPI GetFileVersionInfoW для файла '{filepath}': Код ошибки {last_error}", level="ERROR")
-             return None
-
-
-        # Получаем список переводов (язык + кодировка)
-        lplpBuffer = ctypes.c_void_p()
-        puLen = ctypes.wintypes.UINT()
-        # Внимание: VerQueryValueW может вернуть 0 при ошибке
-        if ctypes.windll.version.VerQueryValueW(res, r'\\VarFileInfo\\Translation', ctypes.byref(lplpBuffer), ctypes.byref(puLen)) == 0:
-             last_error = ctypes.GetLastError()
-             log_message(f"Ошибка WinAPI VerQueryValueW (Translation) для файла '{filepath}': Код ошибки {last_error}", level="ERROR")
-             # Попробуем использовать стандартный перевод 040904b0 (английский) если список переводов недоступен
-             log_message("DEBUG: Не удалось получить список переводов. Попытка использовать стандартный перевод 040904b0.", level="DEBUG")
-             lang_codepage = '040904b0' # Английский (США) + Unicode
-        else:
-             # Извлекаем первый перевод
-             translation = ctypes.cast(lplpBuffer, ctypes.POINTER(ctypes.c_ushort * 2)).contents
-             lang_codepage = f'{translation[0]:04x}{translation[1]:04x}'
-             log_message(f"DEBUG: Найден перевод: {lang_codepage}", level="DEBUG")
+
+@contextlib.contextmanager
+def _atomic_replace(path):
+    """Дает путь временного файла рядом с path, который после блока атомарно заменяет path.
+       Имя временного файла уникально (mkstemp): параллельные потоки и процессы лаунчера
+       не пишут в один и тот же .tmp. При ошибке временный файл удаляется.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=os.path.basename(path) + '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    except BaseException:
+        _remove_file_quietly(temp_path)
+        raise
 
 
-        # Формируем путь к нужному значению
-        sub_block = f'\\StringFileInfo\\{lang_codepage}\\CompanyName'
+_CANCEL_CHECK_SEC = 0.1 # Как часто ожидания проверяют флаг отмены
 
-        # Получаем строку производителя
-        lplpBuffer = ctypes.c_wchar_p() # Используем c_wchar_p для строк WinAPI (UTF-16)
-        puLen = ctypes.wintypes.UINT()
-        # Внимание: VerQueryValueW может вернуть 0 при ошибке
-        if ctypes.windll.version.VerQueryValueW(res, sub_block, ctypes.byref(lplpBuffer), ctypes.byref(puLen)) == 0:
-             last_error = ctypes.GetLastError()
-             log_message(f"DEBUG: Ошибка WinAPI VerQueryValueW (CompanyName) для файла '{filepath}': Код ошибки {last_error}", level="DEBUG")
-             log_message(f"CompanyName не найдено в метаданных файла '{filepath}' (или ошибка чтения).", level="WARNING")
-             return None
 
+def _check_cancelled(cancel_event):
+    """Выбрасывает OperationCancelled, если установлен флаг отмены."""
+    if cancel_event is not None and cancel_event.is_set():
+        raise OperationCancelled("Операция отменена.")
 
-        company_name = lplpBuffer.value
-        log_message(f"DEBUG: Извлечено CompanyName: '{company_name}'", level="DEBUG")
-        return company_name.strip() if company_name else None
 
+@contextlib.contextmanager
+def _close_on_cancel(cancel_event, close):
+    """Пока выполняется блок, следит за флагом отмены и при его установке вызывает close() из другого потока:
+       чтение, заблокированное на медленном или зависшем соединении, прерывается сразу, а не по таймауту.
+       Ошибка чтения или преждевременный конец данных после такого разрыва выбрасываются как OperationCancelled.
+    """
+    if cancel_event is None:
+        yield
+        return
+    finished = threading.Event()
+
+    def watch():
+        while not finished.is_set():
+            if cancel_event.wait(_CANCEL_CHECK_SEC):
+                if not finished.is_set():
+                    try:
+                        close()
+                    except Exception as e:
+                        log_message("DEBUG: Ошибка при разрыве соединения после отмены: %s", e, level="DEBUG")
+                return
+
+    threading.Thread(target=watch, daemon=True).start()
+    try:
+        yield
+        _check_cancelled(cancel_event) # Разорванное соединение могло выглядеть как обычный конец данных
     except Exception as e:
-        log_message(f"Ошибка при извлечении CompanyName через WinAPI для файла '{filepath}': {e}", level="ERROR")
+        if cancel_event.is_set() and not isinstance(e, OperationCancelled):
+            raise OperationCancelled("Операция отменена.") from e
+        raise
+    finally:
+        finished.set()
+
+
+def _shutdown_socket(sock):
+    """Разрывает соединение в обе стороны; заблокированный в recv поток сразу получает ошибку/EOF."""
+    if sock is not None:
+        sock.shutdown(socket.SHUT_RDWR)
+
+
+def _shutdown_http_response(response):
+    """Разрывает соединение, по которому читается тело ответа requests (stream=True)."""
+    _shutdown_socket(getattr(getattr(response.raw, 'connection', None), 'sock', None))
+
+
+# --- Ограничение скорости передач ---
+
+_RATE_BURST_SEC = 0.5 # Запас ведра маркеров: сколько секунд передачи на полной скорости допускается пачкой
+_BACKGROUND_KEEPALIVE_SEC = 5.0 # Уступая канал, фоновая передача все же получает блок раз в столько секунд (чтобы сервер не разорвал соединение)
+
+# Отметки передач: окно, консольные запуски и предзагрузка - разные процессы, и узнают о передачах
+# друг друга по файлам <вид>.<секция источника>.<PID> в InstallerRoot/.transfers, которые идущая передача
+# периодически обновляет
+TRANSFER_MARKS_DIR_NAME = ".transfers"
+_TRANSFER_MARK_INTERVAL_SEC = 0.5 # Как часто передача обновляет свою отметку (и сколько кэшируется список отметок)
+_TRANSFER_MARK_FRESH_SEC = 2.0 # Отметка старше - передача завершилась или процесс остановлен
+_TRANSFER_MARK_CLEANUP_SEC = 3600 # Отметки старше удаляются при чтении списка
+
+_rate_buckets = {}
+_rate_buckets_lock = threading.Lock()
+_transfer_marks = {} # Папка отметок -> (время чтения, список свежих отметок)
+_transfer_marks_touched = {} # Путь отметки этого процесса -> время последнего обновления
+_transfer_marks_lock = threading.Lock()
+
+
+class _TokenBucket:
+    """Ведро маркеров: пропускает в среднем rate байт в секунду, допуская пачку до запаса ведра.
+       Одно ведро делят все передачи, на которые распространяется лимит (потокобезопасно).
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(rate * _RATE_BURST_SEC, 64 * 1024)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, size):
+        """Списывает size байт и возвращает паузу в секундах, которую нужно выдержать перед следующим блоком.
+           Маркеры уходят в долг: блок больше запаса проходит сразу, а следующие блоки всех передач ждут дольше.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= size
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+
+def _get_rate_bucket(name, rate_kbps):
+    """Возвращает общее ведро маркеров для лимита name или None, если лимит не задан (0).
+       При изменении лимита в конфиге ведро создается заново.
+    """
+    if rate_kbps <= 0:
         return None
+    rate = rate_kbps * 1024
+    with _rate_buckets_lock:
+        bucket = _rate_buckets.get(name)
+        if bucket is None or bucket.rate != rate:
+            bucket = _rate_buckets[name] = _TokenBucket(rate)
+        return bucket
+
+
+def _sleep_unless_cancelled(delay_sec, cancel_event):
+    """Пауза, прерываемая флагом отмены (выбрасывает OperationCancelled)."""
+    if cancel_event is None:
+        time.sleep(delay_sec)
+    elif cancel_event.wait(delay_sec):
+        _check_cancelled(cancel_event)
+
+
+def _touch_transfer_mark(marks_dir, kind, section):
+    """Обновляет отметку передачи этого процесса (не чаще _TRANSFER_MARK_INTERVAL_SEC)."""
+    path = os.path.join(marks_dir, f"{kind}.{section}.{os.getpid()}")
+    now = time.monotonic()
+    with _transfer_marks_lock:
+        if now - _transfer_marks_touched.get(path, float('-inf')) < _TRANSFER_MARK_INTERVAL_SEC:
+            return
+        _transfer_marks_touched[path] = now
+    try:
+        os.makedirs(marks_dir, exist_ok=True)
+        with open(path, 'a'):
+            pass
+        os.utime(path, None)
+    except OSError as e:
+        log_message("DEBUG: Не удалось обновить отметку передачи '%s': %s", path, e, level="DEBUG")
 
 
-def _download_from_http(config, app_type, version_formatted, expected_installer_name, temp_archive_path, update_status, update_progress_callback, base_progress, progress_range):
-    """Скачивает архив дистрибутива по HTTP."""
-    log_message(f"DEBUG: Попытка скачивания с HTTP.")
-    http_enabled = get_config_value(config, 'HttpSource', 'Enabled', default=False, type_cast=bool)
-    if not http_enabled:
-        log_message("DEBUG: HTTP источник отключен в конфиге.", level="DEBUG")
-        return False # Источник отключен
+def _fresh_transfer_marks(marks_dir):
+    """Возвращает свежие отметки передач всех процессов: список (вид, секция источника, PID).
+       Список кэшируется на _TRANSFER_MARK_INTERVAL_SEC, давно заброшенные отметки удаляются.
+    """
+    now = time.monotonic()
+    with _transfer_marks_lock:
+        cached = _transfer_marks.get(marks_dir)
+        if cached is not None and now - cached[0] < _TRANSFER_MARK_INTERVAL_SEC:
+            return cached[1]
+    try:
+        names = os.listdir(marks_dir)
+    except OSError:
+        names = []
+    marks = []
+    wall_now = time.time()
+    for name in names:
+        path = os.path.join(marks_dir, name)
+        try:
+            age = wall_now - os.path.getmtime(path)
+        except OSError:
+            continue
+        if age > _TRANSFER_MARK_CLEANUP_SEC:
+            _remove_file_quietly(path)
+        elif age <= _TRANSFER_MARK_FRESH_SEC and name.count('.') == 2:
+            marks.append(tuple(name.split('.')))
+    with _transfer_marks_lock:
+        _transfer_marks[marks_dir] = (now, marks)
+    return marks
+
+
+class _TransferThrottle:
+    """Ограничитель скорости одной передачи: вызов throttle(size) после каждого полученного блока выдерживает
+       паузу, нужную по лимитам. Пока приемник стоит на паузе, TCP сам притормаживает отправителя.
+       Фоновая передача (предзагрузка) ограничена общим лимитом и лимитом своего источника и уступает канал
+       передачам для запусков; передачи для запусков ограничены только ForegroundRateLimitKBps.
+       Процессы лаунчера с общим InstallerRoot видят передачи друг друга по отметкам в marks_dir: лимит
+       фоновых передач делится поровну между процессами, которые сейчас его используют.
+    """
+
+    def __init__(self, buckets, section, background, yield_to_foreground, marks_dir, cancel_event):
+        self._buckets = buckets # [(ведро, секция источника - для лимита источника, None - для общего)]
+        self._section = section
+        self._background = background
+        self._yield = background and yield_to_foreground
+        self._marks_dir = marks_dir
+        self._cancel_event = cancel_event
+
+    @property
+    def limited(self):
+        """Задан ли для передачи лимит скорости."""
+        return bool(self._buckets)
+
+    def __call__(self, size):
+        if self._marks_dir is not None:
+            _touch_transfer_mark(self._marks_dir, 'background' if self._background else 'foreground', self._section)
+            if self._yield:
+                self._yield_to_foreground()
+        delay = max((bucket.reserve(size * self._sharing_processes(scope)) for bucket, scope in self._buckets), default=0.0)
+        deadline = time.monotonic() + delay
+        while delay > 0:
+            _sleep_unless_cancelled(min(delay, _CANCEL_CHECK_SEC), self._cancel_event)
+            delay = deadline - time.monotonic()
+
+    def _sharing_processes(self, scope):
+        # Ведро у каждого процесса свое: при N процессах каждый блок списывается N раз, и вместе они укладываются в лимит
+        if self._marks_dir is None:
+            return 1
+        pids = {pid for kind, section, pid in _fresh_transfer_marks(self._marks_dir)
+                if kind == 'background' and (scope is None or section == scope)}
+        pids.add(str(os.getpid()))
+        return len(pids)
+
+    def _foreground_active(self):
+        return any(kind == 'foreground' for kind, _, _ in _fresh_transfer_marks(self._marks_dir))
+
+    def _yield_to_foreground(self):
+        # Ждем, пока передачи для запусков (в любом процессе) не затихнут, но не дольше _BACKGROUND_KEEPALIVE_SEC подряд
+        paused_at = time.monotonic()
+        while self._foreground_active():
+            if time.monotonic() - paused_at >= _BACKGROUND_KEEPALIVE_SEC:
+                return
+            _sleep_unless_cancelled(_CANCEL_CHECK_SEC, self._cancel_event)
+
+
+def _transfer_throttle(config, section, background=False, cancel_event=None):
+    """Создает ограничитель скорости передачи с источника section.
+       background - фоновая передача (предзагрузка), иначе передача для запуска из окна или консоли.
+    """
+    if background:
+        buckets = [(_get_rate_bucket('background', get_config_value(config, 'Settings', 'RateLimitKBps', default=0, type_cast=float)), None),
+                   (_get_rate_bucket(f'background:{section}', get_config_value(config, section, 'RateLimitKBps', default=0, type_cast=float)), section)]
+    else:
+        buckets = [(_get_rate_bucket('foreground', get_config_value(config, 'Settings', 'ForegroundRateLimitKBps', default=0, type_cast=float)), None)]
+    buckets = [(bucket, scope) for bucket, scope in buckets if bucket is not None]
+    if buckets:
+        log_message("DEBUG: Скорость %sпередачи с '%s' ограничена %.0f КБ/с.", 'фоновой ' if background else '', section,
+                    min(bucket.rate for bucket, _ in buckets) / 1024, level="DEBUG")
+    installer_root = get_config_value(config, 'Settings', 'InstallerRoot', default='D:\\Backs')
+    marks_dir = os.path.join(installer_root, TRANSFER_MARKS_DIR_NAME) if installer_root else None
+    yield_to_foreground = get_config_value(config, 'Settings', 'BackgroundYieldToForeground', default=True, type_cast=bool)
+    return _TransferThrottle(buckets, section, background, yield_to_foreground, marks_dir, cancel_event)
 
-    http_url_base = get_config_value(config, 'HttpSource', 'Url', default=None, type_cast=str)
-    if not http_url_base:
-        log_message("Ошибка: Не указан URL для HTTP источника в конфиге.", level="ERROR")
-        return False # Не настроен
 
-    # Определяем имя архива для HTTP источника
-    archive_name_template = get_config_value(config, 'HttpSource', f'{app_type}_ArchiveName', default=None, type_cast=str)
+def _get_archive_name(config, section, app_type, version_formatted):
+    """Формирует имя архива (возможно, с подпапкой) по шаблону из секции источника."""
+    archive_name_template = get_config_value(config, section, f'{app_type}_ArchiveName', default=None, type_cast=str)
     if not archive_name_template:
-         log_message(f"Ошибка: Не указан шаблон имени архива для типа '{app_type}' в разделе HttpSource конфига.", level="ERROR")
-         return False # Не настроен
+         log_message(f"Ошибка: Не указан шаблон имени архива для типа '{app_type}' в разделе {section} конфига.", level="ERROR")
+         return None # Не настроен
 
     # Заменяем {version} на форматированную версию
-    archive_name = archive_name_template.replace('{version}', version_formatted)
+    return archive_name_template.replace('{version}', version_formatted)
+
+
+def _get_http_archive_url(config, app_type, version_formatted):
+    """Возвращает полный URL архива на HTTP источнике или None, если источник не настроен."""
+    http_url_base = get_config_value(config, 'HttpSource', 'Url', default=None, type_cast=str)
+    if not http_url_base:
+        log_message("Ошибка: Не указан URL для HTTP источника в конфиге.", level="ERROR")
+        return None # Не настроен
+
+    archive_name = _get_archive_name(config, 'HttpSource', app_type, version_formatted)
+    if archive_name is None:
+        return None
 
     # Соединяем базовый URL и имя архива. Используем urljoin для корректной обработки путей.
-    http_full_url = urllib.parse.urljoin(http_url_base.rstrip('/') + '/', archive_name)
+    return urllib.parse.urljoin(http_url_base.rstrip('/') + '/', archive_name)
 
-    update_status(f"Скачивание с HTTP: {os.path.basename(http_full_url)}...")
-    log_message(f"Попытка скачивания с HTTP: '{http_full_url}' в '{temp_archive_path}'.")
 
+def _get_ftp_archive_location(config, app_type, version_formatted):
+    """Возвращает словарь с параметрами подключения и расположением архива на FTP или None."""
+    ftp_host = get_config_value(config, 'FtpSource', 'Host', default=None, type_cast=str)
+    ftp_port = get_config_value(config, 'FtpSource', 'Port', default=21, type_cast=int)
+    ftp_username = get_config_value(config, 'FtpSource', 'Username', default='anonymous', type_cast=str)
+    ftp_password = get_config_value(config, 'FtpSource', 'Password', default='', type_cast=str)
+    ftp_directory = get_config_value(config, 'FtpSource', 'Directory', default=None, type_cast=str)
+
+    if not ftp_host or not ftp_directory:
+        log_message("Ошибка: Не указаны Host или Directory для FTP источника в конфиге.", level="ERROR")
+        return None # Не настроен
+
+    archive_name = _get_archive_name(config, 'FtpSource', app_type, version_formatted)
+    if archive_name is None:
+        return None
+
+    # Если archive_name_template включал подпапку (например "Syrve/"),
+    # то archive_name будет "Syrve/RMSSOffice887.zip" и в нее нужно перейти отдельно.
+    return {
+        'Host': ftp_host,
+        'Port': ftp_port,
+        'Username': ftp_username,
+        'Password': ftp_password,
+        'Directory': ftp_directory,
+        'ArchiveName': archive_name,
+        'ArchiveDir': os.path.dirname(archive_name),
+        'ArchiveFile': os.path.basename(archive_name),
+        # Соединяем директорию и имя архива на FTP (только для логов)
+        'FullPath': f"{ftp_directory.rstrip('/')}/{archive_name}"
+    }
+
+
+def _get_smb_archive_path(config, app_type, version_formatted):
+    """Возвращает полный путь к архиву на SMB ресурсе или None, если источник не настроен."""
+    smb_path_base = get_config_value(config, 'SmbSource', 'Path', default=None, type_cast=str)
+    if not smb_path_base:
+        log_message("Ошибка: Не указан Path для SMB источника в конфиге.", level="ERROR")
+        return None # Не настроен
+
+    archive_name = _get_archive_name(config, 'SmbSource', app_type, version_formatted)
+    if archive_name is None:
+        return None
+
+    # os.path.join может некорректно работать с UNC путями и подпапками типа "Syrve/":
+    # os.path.join(r"\\server\share", "Syrve/file.zip") даст r"\\server\share\Syrve/file.zip".
+    # Поэтому склеиваем вручную, учитывая слеши.
+    smb_full_path = f"{smb_path_base.rstrip('/\\')}{os.sep}{archive_name.replace('/', os.sep).replace('\\', os.sep)}"
+    return smb_full_path
+
+
+def _ftp_connect(location, timeout=None):
+    """Подключается к FTP, выполняет вход и переходит в каталог архива."""
+    from ftplib import FTP
+    ftp = FTP(timeout=timeout) if timeout else FTP()
+    try:
+        ftp.connect(location['Host'], location['Port'])
+        ftp.login(location['Username'], location['Password'])
+        log_message(f"DEBUG: FTP логин успешен. Текущая директория: {ftp.pwd()}", level="DEBUG")
+
+        # Переходим в нужную директорию
+        ftp.cwd(location['Directory'])
+        log_message(f"DEBUG: FTP смена директории на '{location['Directory']}' успешна. Текущая директория: {ftp.pwd()}", level="DEBUG")
+
+        archive_dir = location['ArchiveDir']
+        if archive_dir and archive_dir != '.': # Если есть подпапка в имени архива
+            try:
+                ftp.cwd(archive_dir)
+                log_message(f"DEBUG: FTP смена директории на подпапку '{archive_dir}' успешна. Текущая директория: {ftp.pwd()}", level="DEBUG")
+            except Exception as e:
+                raise FileNotFoundError(f"Не удалось сменить директорию на '{archive_dir}': {e}")
+        return ftp
+    except Exception:
+        ftp.close()
+        raise
+
+
+def _ftp_close(ftp, graceful=True):
+    """Закрывает FTP соединение. При отмене соединение рвется сразу, без ожидания ответа на QUIT."""
+    try:
+        if graceful:
+            ftp.quit()
+    except Exception as e:
+        log_message(f"DEBUG: Ошибка при завершении FTP сессии: {e}", level="DEBUG")
+    finally:
+        ftp.close()
+
+
+class _RangeNotSupported(Exception):
+    """Сервер не выполнил запрос с заголовком Range (ответил не 206)."""
+    pass
+
+
+# --- Проверка контрольных сумм архивов ---
+
+class _ChecksumMismatch(Exception):
+    """SHA-256 скачанного архива не совпадает со значением из файла контрольных сумм источника."""
+    pass
+
+
+def _parse_checksum_manifest(text):
+    """Разбирает файл контрольных сумм в формате sha256sum ("<hash>  <имя>" или "<hash> *<имя>")
+       и BSD ("SHA256 (<имя>) = <hash>"). Возвращает словарь {имя файла: hash в нижнем регистре}.
+    """
+    checksums = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        bsd_match = re.match(r'^SHA256\s*\((.+)\)\s*=\s*([0-9a-fA-F]{64})$', line)
+        if bsd_match:
+            checksums[bsd_match.group(1)] = bsd_match.group(2).lower()
+            continue
+        gnu_match = re.match(r'^([0-9a-fA-F]{64})\s+\*?(.+)$', line)
+        if gnu_match:
+            checksums[gnu_match.group(2).strip()] = gnu_match.group(1).lower()
+    return checksums
+
+
+def _get_expected_sha256(config, section, archive_name, fetch_manifest):
+    """Возвращает ожидаемый SHA-256 архива из файла контрольных сумм источника или None,
+       если файл не настроен (ChecksumManifest), недоступен или не содержит архива.
+       fetch_manifest(имя файла) возвращает текст файла, лежащего рядом с архивом.
+    """
+    manifest_name = get_config_value(config, section, 'ChecksumManifest', default='', type_cast=str).strip()
+    if not manifest_name:
+        return None
+    try:
+        checksums = _parse_checksum_manifest(fetch_manifest(manifest_name))
+    except Exception as e:
+        log_message(f"Внимание: Не удалось получить файл контрольных сумм '{manifest_name}' ({section}): {e}. Архив не будет проверен.", level="WARNING")
+        return None
+    archive_file = archive_name.replace('\\', '/').rsplit('/', 1)[-1]
+    expected = checksums.get(archive_file) or checksums.get(archive_name.replace('\\', '/'))
+    if expected is None:
+        log_message(f"Внимание: В файле контрольных сумм '{manifest_name}' ({section}) нет записи для '{archive_file}'. Архив не будет проверен.", level="WARNING")
+        return None
+    log_message("DEBUG: Ожидаемый SHA-256 архива '%s': %s", archive_file, expected, level="DEBUG")
+    return expected
+
+
+def _hash_file_prefix(hasher, filepath, size, buffer_size=1024 * 1024, start=0, stream_consumer=None):
+    """Добавляет в hasher первые size байт файла (уже скачанную при прошлой попытке часть),
+       а если задан start - size байт начиная с этой позиции. stream_consumer получает те же байты.
+    """
+    with open(filepath, 'rb') as f:
+        f.seek(start)
+        while size > 0:
+            buffer = f.read(min(buffer_size, size))
+            if not buffer:
+                raise EOFError(f"Файл '{filepath}' короче ожидаемого.")
+            hasher.update(buffer)
+            if stream_consumer is not None:
+                stream_consumer.feed(buffer)
+            size -= len(buffer)
+
+
+def _archive_result(archive_sha256, expected_sha256, source_type):
+    """Сверяет SHA-256 скачанного архива с ожидаемым и возвращает сведения о скачанном архиве.
+       При несовпадении выбрасывает _ChecksumMismatch.
+    """
+    if expected_sha256 is not None and archive_sha256 != expected_sha256:
+        raise _ChecksumMismatch(f"SHA-256 архива с источника '{source_type}' ({archive_sha256}) не совпадает с ожидаемым ({expected_sha256}).")
+    if expected_sha256 is not None:
+        log_message(f"Контрольная сумма архива с источника '{source_type}' совпадает с файлом контрольных сумм.")
+    return {'sha256': archive_sha256, 'verified': expected_sha256 is not None}
+
+
+# --- Докачка: служебный файл рядом с частичным архивом ---
+
+def _resume_state_path(partial_path):
+    """Путь к служебному файлу с параметрами докачки (ETag/Last-Modified/размер)."""
+    return f"{partial_path}.json"
+
+
+def _load_resume_state(partial_path):
+    """Читает параметры докачки. Возвращает словарь или None, если докачка невозможна."""
+    state_path = _resume_state_path(partial_path)
+    if not os.path.exists(partial_path) or not os.path.exists(state_path):
+        return None
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        log_message(f"Внимание: Не удалось прочитать параметры докачки '{state_path}': {e}", level="WARNING")
+        return None
+
+
+def _save_resume_state(partial_path, state):
+    """Атомарно сохраняет параметры докачки рядом с частичным архивом."""
+    state_path = _resume_state_path(partial_path)
     try:
-        # Используем stream=True для скачивания больших файлов по частям
-        response = requests.get(http_full_url, stream=True, timeout=get_config_value(config, 'Settings', 'HttpRequestTimeoutSec', default=15, type_cast=int))
+        with open(state_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(state_path + '.tmp', state_path)
+    except Exception as e:
+        log_message(f"Внимание: Не удалось сохранить параметры докачки '{state_path}': {e}", level="WARNING")
+
+
+def _discard_partial(partial_path):
+    """Удаляет частичный архив вместе с параметрами докачки."""
+    _remove_file_quietly(partial_path)
+    _remove_file_quietly(_resume_state_path(partial_path))
+
+
+def _http_validators(headers):
+    """Извлекает из заголовков ответа валидаторы для If-Range."""
+    etag = headers.get('ETag')
+    if etag and etag.startswith('W/'):
+        # Слабый ETag нельзя использовать в If-Range (RFC 9110)
+        etag = None
+    return {'etag': etag, 'last_modified': headers.get('Last-Modified')}
+
+
+def _http_if_range(state):
+    """Значение заголовка If-Range из сохраненных валидаторов (или None)."""
+    return state.get('etag') or state.get('last_modified')
+
+
+def _http_probe_ranges(http_full_url, http_timeout):
+    """Выполняет HEAD-запрос к архиву.
+       Возвращает (итоговый URL после редиректов, размер в байтах, поддерживает ли сервер Range, валидаторы).
+    """
+    try:
+        response = get_http_session().head(http_full_url, allow_redirects=True, timeout=http_timeout)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        # HEAD может быть запрещен на сервере - это не повод отказываться от обычного GET
+        log_message("DEBUG: HEAD-запрос к '%s' не удался: %s", http_full_url, e, level="DEBUG")
+        return http_full_url, 0, False, {}
+
+    total_size = int(response.headers.get('content-length', 0))
+    accepts_ranges = response.headers.get('accept-ranges', '').strip().lower() == 'bytes'
+    return response.url or http_full_url, total_size, accepts_ranges, _http_validators(response.headers)
+
+
+def _download_http_single(http_full_url, partial_path, http_timeout, report_progress, cancel_event=None, stream_consumer=None, throttle=None):
+    """Скачивает архив по HTTP одним потоком, докачивая ранее полученную часть через Range/If-Range.
+       stream_consumer (_StreamingZipExtractor) получает байты архива по мере скачивания, если архив качается с начала.
+       throttle (_TransferThrottle) выдерживает паузы по лимиту скорости после каждого блока.
+       Возвращает SHA-256 архива, посчитанный по ходу скачивания.
+    """
+    offset = 0
+    headers = {}
+    resume_state = _load_resume_state(partial_path)
+    if resume_state and resume_state.get('mode') == 'single' and resume_state.get('url') == http_full_url and _http_if_range(resume_state):
+        offset = os.path.getsize(partial_path)
+        if offset > 0:
+            headers = {'Range': f'bytes={offset}-', 'If-Range': _http_if_range(resume_state)}
+            log_message(f"Найден частично скачанный архив ({offset} байт). Попытка докачки с '{http_full_url}'.")
+
+    # Используем stream=True для скачивания больших файлов по частям
+    with get_http_session().get(http_full_url, headers=headers, stream=True, timeout=http_timeout) as response:
+        if response.status_code == 416 and offset and offset == resume_state.get('size'):
+            # Частичный файл уже содержит архив целиком (обрыв пришелся на самый конец)
+            log_message("DEBUG: Частичный архив уже скачан полностью.", level="DEBUG")
+            hasher = hashlib.sha256()
+            _hash_file_prefix(hasher, partial_path, offset)
+            return hasher.hexdigest()
+        if response.status_code == 416:
+            # Сохраненная часть больше не соответствует файлу на сервере - начинаем заново
+            log_message("Сервер отклонил диапазон докачки (416). Архив будет скачан заново.", level="WARNING")
+            _discard_partial(partial_path)
+            return _download_http_single(http_full_url, partial_path, http_timeout, report_progress, cancel_event, stream_consumer, throttle)
         response.raise_for_status() # Генерирует исключение для плохих кодов статуса (4xx или 5xx)
 
-        total_size = int(response.headers.get('content-length', 0))
-        downloaded_size = 0
-        buffer_size = 8192 # Размер буфера для чтения/записи
+        content_length = int(response.headers.get('content-length', 0))
+        if offset and response.status_code == 206:
+            log_message(f"Сервер подтвердил докачку с позиции {offset}.")
+            file_mode = 'r+b'
+        else:
+            if offset:
+                # If-Range не совпал: файл на сервере изменился, сервер прислал его целиком
+                log_message("Архив на сервере изменился с момента прошлой попытки. Скачивание начинается заново.", level="WARNING")
+            offset = 0
+            file_mode = 'wb'
+        total_size = offset + content_length if content_length else 0
+
+        if stream_consumer is not None:
+            if offset:
+                # Потоковой распаковке нужен архив с первого байта
+                stream_consumer.abandon("архив докачивается с середины")
+            else:
+                stream_consumer.start()
+
+        state = {'mode': 'single', 'url': http_full_url, 'size': total_size}
+        state.update(_http_validators(response.headers))
+        if not _http_if_range(state) and resume_state and offset:
+            # При 206 сервер может не повторить валидаторы - сохраняем прежние
+            state.update({'etag': resume_state.get('etag'), 'last_modified': resume_state.get('last_modified')})
+        _save_resume_state(partial_path, state)
 
-        with open(temp_archive_path, 'wb') as f_dst:
+        downloaded_size = offset
+        buffer_size = 8192 # Размер буфера для чтения/записи
+        # Хэш считается по ходу скачивания; при докачке - сначала по уже полученной части
+        hasher = hashlib.sha256()
+        if offset:
+            _hash_file_prefix(hasher, partial_path, offset)
+
+        with open(partial_path, file_mode) as f_dst, _close_on_cancel(cancel_event, lambda: _shutdown_http_response(response)):
+            f_dst.seek(offset)
+            f_dst.truncate()
             for chunk in response.iter_content(chunk_size=buffer_size):
+                _check_cancelled(cancel_event)
                 if chunk: # filter out keep-alive new chunks
                     f_dst.write(chunk)
+                    hasher.update(chunk)
+                    if stream_consumer is not None:
+                        stream_consumer.feed(chunk)
                     downloaded_size += len(chunk)
-                    # Обновление прогресса
-                    if total_size > 0:
-                         progress_value = base_progress + (downloaded_size / total_size) * progress_range
-                         update_progress_callback(progress_value)
+                    report_progress(downloaded_size, total_size)
+                    if throttle is not None:
+                        throttle(len(chunk))
+
+        if total_size and downloaded_size != total_size:
+            raise requests.exceptions.ChunkedEncodingError(f"Архив получен не полностью ({downloaded_size} из {total_size} байт).")
+        if stream_consumer is not None:
+            stream_consumer.finish_input()
+        return hasher.hexdigest()
+
+
+def _split_ranges(total_size, segment_count):
+    """Делит [0, total_size) на segment_count диапазонов (start, end) с включительной правой границей."""
+    segment_size = -(-total_size // segment_count) # Округление вверх
+    return [(start, min(start + segment_size, total_size) - 1) for start in range(0, total_size, segment_size)]
+
+
+def _download_http_segmented(http_full_url, partial_path, total_size, segment_count, validators, http_timeout, report_progress, cancel_event=None, throttle=None, stream_consumer=None):
+    """Скачивает архив по HTTP в несколько соединений: каждый сегмент запрашивается с заголовком Range
+       и пишется в свою область заранее выделенного файла. Прогресс сегментов сохраняется для докачки.
+       Возвращает SHA-256 архива: сегмент, до которого дошла непрерывная от начала файла хэшированная часть,
+       хэширует свои блоки прямо в памяти по мере записи. С диска перечитываются только байты, полученные
+       с опережением (сегментами дальше этой части или при прошлой попытке), когда хэш доходит до них.
+       При равной скорости сегментов это около (N-1)/N архива: они читаются повторно, обычно из кэша ОС.
+       stream_consumer (_StreamingZipExtractor) получает ту же непрерывную часть в порядке байтов архива.
+    """
+    state = None
+    resume_state = _load_resume_state(partial_path)
+    if (resume_state and resume_state.get('mode') == 'segmented' and resume_state.get('url') == http_full_url
+            and resume_state.get('size') == total_size and os.path.getsize(partial_path) == total_size
+            and _http_if_range(validators) and resume_state.get('etag') == validators.get('etag')
+            and resume_state.get('last_modified') == validators.get('last_modified')):
+        state = resume_state
+        already = sum(done for _, _, done in state['segments'])
+        log_message(f"Найден частично скачанный архив ({already} из {total_size} байт). Докачка {len(state['segments'])} сегментов.")
+    else:
+        if resume_state:
+            log_message("Сохраненная часть архива не соответствует файлу на сервере. Скачивание начинается заново.", level="WARNING")
+        state = {'mode': 'segmented', 'url': http_full_url, 'size': total_size,
+                 'segments': [[start, end, 0] for start, end in _split_ranges(total_size, segment_count)]}
+        state.update(validators)
+        # Заранее выделяем файл нужного размера, чтобы потоки писали каждый в свою область
+        with open(partial_path, 'wb') as f_dst:
+            f_dst.truncate(total_size)
+    _save_resume_state(partial_path, state)
+
+    segments = state['segments']
+    log_message(f"Сегментированное скачивание: {len(segments)} сегментов по ~{segments[0][1] - segments[0][0] + 1} байт.")
+
+    lock = threading.Lock()
+    downloaded = {'size': sum(done for _, _, done in segments)}
+    report_progress(downloaded['size'], total_size)
+    # Ошибка в одном сегменте останавливает остальные, уже полученные данные сохраняются для докачки
+    abort_event = threading.Event()
+    checkpoint_interval_sec = 1.0
+
+    def checkpoint(index, f_dst, done):
+        # Сначала сбрасываем буфер на диск, и только потом отмечаем байты как полученные
+        f_dst.flush()
+        with lock:
+            segments[index][2] = done
+            _save_resume_state(partial_path, state)
+
+    hasher = hashlib.sha256()
+    hashed = {'size': 0} # Хэш посчитан по байтам [0, hashed['size'])
+    hash_lock = threading.Lock()
+    # Блоки с диска передаются распаковщику по 64 КБ, как и из сети: очередь распаковщика ограничена числом блоков
+    catch_up_buffer = 64 * 1024 if stream_consumer is not None else 1024 * 1024
+    if stream_consumer is not None:
+        stream_consumer.start()
+
+    def hash_in_order(f_dst, segment_start, position, chunk):
+        # Хэширует блок, записанный с позиции position, если до него дошла непрерывная хэшированная часть.
+        # Блокировку не ждем: пока передний сегмент отдает байты распаковщику, остальные сегменты качают дальше,
+        # а пропущенный блок будет прочитан с диска, когда хэш до него дойдет
+        if not hash_lock.acquire(blocking=False):
+            return
+        try:
+            front = hashed['size']
+            if not segment_start <= front <= position:
+                return # Сегмент впереди - его байты будут прочитаны с диска, когда хэш до них дойдет
+            if front < position:
+                # Часть сегмента получена раньше, чем до нее дошел хэш: дочитываем ее с диска
+                f_dst.flush()
+                _hash_file_prefix(hasher, partial_path, position - front, catch_up_buffer, front, stream_consumer)
+            hasher.update(chunk)
+            if stream_consumer is not None:
+                stream_consumer.feed(chunk)
+            hashed['size'] = position + len(chunk)
+        finally:
+            hash_lock.release()
+
+    def fetch_segment(index):
+        start, end, done = segments[index]
+        if start + done > end:
+            return # Сегмент уже скачан
+        headers = {'Range': f'bytes={start + done}-{end}'}
+        if_range = _http_if_range(state)
+        if if_range:
+            headers['If-Range'] = if_range
+        with get_http_session().get(http_full_url, headers=headers, stream=True, timeout=http_timeout) as response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise _RangeNotSupported(f"сервер ответил {response.status_code} на запрос диапазона {start + done}-{end}")
+
+            position = start + done
+            last_checkpoint = time.monotonic()
+            # У каждого потока свой дескриптор: seek + write дают позиционную запись без общей блокировки
+            with open(partial_path, 'r+b') as f_dst, _close_on_cancel(cancel_event, lambda: _shutdown_http_response(response)):
+                f_dst.seek(position)
+                try:
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        _check_cancelled(cancel_event)
+                        if abort_event.is_set():
+                            raise OperationCancelled("Сегмент прерван из-за ошибки в другом сегменте.")
+                        if not chunk:
+                            continue
+                        if position + len(chunk) > end + 1:
+                            raise _RangeNotSupported(f"сервер вернул больше данных, чем запрошено в диапазоне {start}-{end}")
+                        f_dst.write(chunk)
+                        hash_in_order(f_dst, start, position, chunk)
+                        position += len(chunk)
+                        with lock:
+                            downloaded['size'] += len(chunk)
+                            current = downloaded['size']
+                        report_progress(current, total_size)
+                        if throttle is not None:
+                            throttle(len(chunk)) # Лимит общий для всех сегментов
+                        if time.monotonic() - last_checkpoint >= checkpoint_interval_sec:
+                            checkpoint(index, f_dst, position - start)
+                            last_checkpoint = time.monotonic()
+                finally:
+                    checkpoint(index, f_dst, position - start)
+
+            if position != end + 1:
+                raise requests.exceptions.ChunkedEncodingError(f"Сегмент {start}-{end} получен не полностью ({position - start} из {end - start + 1} байт).")
+
+    first_error = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(segments)) as pool:
+        pending = {pool.submit(fetch_segment, index) for index in range(len(segments))}
+        while pending:
+            done_futures, pending = concurrent.futures.wait(pending, timeout=checkpoint_interval_sec)
+            for future in done_futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    abort_event.set()
+                    # Запоминаем исходную ошибку, а не вторичные отмены других сегментов
+                    if first_error is None or isinstance(first_error, OperationCancelled):
+                        first_error = e
+
+    if first_error is not None:
+        if isinstance(first_error, _RangeNotSupported):
+            # Одиночный поток начнет с нуля - сегментированная часть ему не подходит
+            _discard_partial(partial_path)
+        raise first_error
+    log_message("DEBUG: Все %s сегментов скачаны.", len(segments), level="DEBUG")
+    if hashed['size'] < total_size:
+        # Сегменты, завершившиеся раньше, чем до них дошел хэш
+        log_message("DEBUG: Дочитывание с диска для хэша: %s байт, полученных с опережением.", total_size - hashed['size'], level="DEBUG")
+        _hash_file_prefix(hasher, partial_path, total_size - hashed['size'], catch_up_buffer, hashed['size'], stream_consumer)
+    if stream_consumer is not None:
+        stream_consumer.finish_input()
+    return hasher.hexdigest()
+
+
+def _download_from_http(config, app_type, version_formatted, expected_installer_name, temp_archive_path, update_status, update_progress_callback, base_progress, progress_range, cancel_event=None, stream_consumer=None, background=False):
+    """Скачивает архив дистрибутива по HTTP. stream_consumer - потоковый распаковщик (получает архив с первого байта
+       и при скачивании одним потоком, и при сегментированном).
+       background - фоновая передача (предзагрузка): действуют лимиты скорости RateLimitKBps.
+       Возвращает сведения о скачанном архиве ({'sha256', 'verified'}) или False.
+    """
+    log_message("DEBUG: Попытка скачивания с HTTP.", level="DEBUG")
+    http_enabled = get_config_value(config, 'HttpSource', 'Enabled', default=False, type_cast=bool)
+    if not http_enabled:
+        log_message("DEBUG: HTTP источник отключен в конфиге.", level="DEBUG")
+        return False # Источник отключен
+
+    http_full_url = _get_http_archive_url(config, app_type, version_formatted)
+    if not http_full_url:
+        return False # Не настроен
+
+    partial_path = _partial_archive_path(temp_archive_path, 'http')
+    http_timeout = get_config_value(config, 'Settings', 'HttpRequestTimeoutSec', default=15, type_cast=int)
+    segment_count = get_config_value(config, 'HttpSource', 'Segments', default=4, type_cast=int)
+    segment_min_size = get_config_value(config, 'HttpSource', 'SegmentMinSizeMb', default=16, type_cast=int) * 1024 * 1024
+    throttle = _transfer_throttle(config, 'HttpSource', background, cancel_event)
+    update_status(f"Скачивание с HTTP: {os.path.basename(http_full_url)}...")
+    log_message(f"Попытка скачивания с HTTP: '{http_full_url}' в '{temp_archive_path}'.")
 
+    def report_progress(downloaded_size, total_size):
+        # Обновление прогресса (общий объем по всем сегментам)
+        if total_size > 0:
+            progress_value = base_progress + (downloaded_size / total_size) * progress_range
+            update_progress_callback(progress_value, transfer=(downloaded_size, total_size))
+
+    def fetch_manifest(manifest_name):
+        # Файл контрольных сумм лежит рядом с архивом
+        response = get_http_session().get(urllib.parse.urljoin(http_full_url, manifest_name), timeout=http_timeout)
+        response.raise_for_status()
+        return response.text
+
+    try:
+        expected_sha256 = _get_expected_sha256(config, 'HttpSource', _get_archive_name(config, 'HttpSource', app_type, version_formatted), fetch_manifest)
+        segmented_done = False
+        resume_state = _load_resume_state(partial_path)
+        # Начатое одним потоком скачивание и докачиваем одним потоком
+        resume_single = resume_state is not None and resume_state.get('mode') == 'single'
+        if segment_count > 1 and not resume_single:
+            # Узнаем размер архива и поддержку Range, чтобы решить, качать ли в несколько потоков
+            download_url, total_size, accepts_ranges, validators = _http_probe_ranges(http_full_url, http_timeout)
+            if accepts_ranges and total_size >= segment_min_size:
+                try:
+                    archive_sha256 = _download_http_segmented(download_url, partial_path, total_size, segment_count, validators, http_timeout, report_progress, cancel_event, throttle, stream_consumer)
+                    segmented_done = True
+                except _RangeNotSupported as e:
+                    log_message(f"Сегментированное скачивание невозможно: {e}. Переход на один поток.", level="WARNING")
+                    if stream_consumer is not None:
+                        # Распаковщик уже получил начало архива, а один поток скачает его заново
+                        stream_consumer.abandon("архив скачивается заново одним потоком")
+            else:
+                log_message("DEBUG: Скачивание в один поток (Accept-Ranges: %s, размер: %s байт).", accepts_ranges, total_size, level="DEBUG")
+
+        if not segmented_done:
+            archive_sha256 = _download_http_single(http_full_url, partial_path, http_timeout, report_progress, cancel_event, stream_consumer, throttle)
+
+        archive_result = _archive_result(archive_sha256, expected_sha256, 'http')
+        os.replace(partial_path, temp_archive_path)
+        _remove_file_quietly(_resume_state_path(partial_path))
         log_message("Скачивание HTTP завершено.")
         update_status("Скачивание HTTP завершено.")
         update_progress_callback(base_progress + progress_range) # Убедимся, что прогресс достигает конца этапа
-        return True # Успех
+        return archive_result # Успех
 
+    except OperationCancelled:
+        if stream_consumer is not None:
+            stream_consumer.abandon("скачивание прервано")
+        log_message(f"Скачивание с HTTP '{http_full_url}' прервано.")
+        _discard_partial(partial_path)
+        return False
+    except _ChecksumMismatch as e:
+        if stream_consumer is not None:
+            stream_consumer.abandon("контрольная сумма архива не совпала")
+        # Поврежденный архив не докачивается - следующая попытка начнет с нуля
+        log_message(f"Ошибка проверки архива с HTTP '{http_full_url}': {e}", level="ERROR")
+        update_status("Контрольная сумма архива с HTTP не совпала.", level="ERROR")
+        _discard_partial(partial_path)
+        return False
     except requests.exceptions.RequestException as e:
-        log_message(f"Ошибка HTTP скачивания с '{http_full_url}': {e}", level="ERROR")
+        if stream_consumer is not None:
+            stream_consumer.abandon("ошибка скачивания")
+        # Частичный архив сохраняется: следующая попытка докачает только недостающие байты
+        log_message(f"Ошибка HTTP скачивания с '{http_full_url}': {e}. Полученная часть сохранена для докачки.", level="ERROR")
         update_status(f"Ошибка HTTP скачивания: {e}", level="ERROR")
         return False # Ошибка скачивания
     except Exception as e:
+        if stream_consumer is not None:
+            stream_consumer.abandon("ошибка скачивания")
         log_message(f"Неизвестная ошибка при скачивании с HTTP '{http_full_url}': {e}", level="ERROR")
         update_status(f"Неизвестная ошибка HTTP скачивания: {e}", level="ERROR")
         return False # Неизвестная ошибка
 
 
-def _download_from_ftp(config, app_type, version_formatted, expected_installer_name, temp_archive_path, update_status, update_progress_callback, base_progress, progress_range):
-    """Скачивает архив дистрибутива по FTP."""
-    log_message(f"DEBUG: Попытка скачивания с FTP.")
+def _download_from_ftp(config, app_type, version_formatted, expected_installer_name, temp_archive_path, update_status, update_progress_callback, base_progress, progress_range, cancel_event=None, background=False):
+    """Скачивает архив дистрибутива по FTP. Возвращает сведения о скачанном архиве ({'sha256', 'verified'}) или False.
+       background - фоновая передача (предзагрузка): действуют лимиты скорости RateLimitKBps.
+    """
+    log_message("DEBUG: Попытка скачивания с FTP.", level="DEBUG")
     ftp_enabled = get_config_value(config, 'FtpSource', 'Enabled', default=False, type_cast=bool)
     if not ftp_enabled:
         log_message("DEBUG: FTP источник отключен в конфиге.", level="DEBUG")
         return False # Источник отключен
 
-    ftp_host = get_config_value(config, 'FtpSource', 'Host', default=None, type_cast=str)
-    ftp_port = get_config_value(config, 'FtpSource', 'Port', default=21, type_cast=int)
-    ftp_username = get_config_value(config, 'FtpSource', 'Username', default='anonymous', type_cast=str)
-    ftp_password = get_config_value(config, 'FtpSource', 'Password', default='', type_cast=str)
-    ftp_directory = get_config_value(config, 'FtpSource', 'Directory', default=None, type_cast=str)
-
-    if not ftp_host or not ftp_directory:
-        log_message("Ошибка: Не указаны Host или Directory для FTP источника в конфиге.", level="ERROR")
+    location = _get_ftp_archive_location(config, app_type, version_formatted)
+    if location is None:
         return False # Не настроен
 
-    # Определяем имя архива для FTP источника
-    archive_name_template = get_config_value(config, 'FtpSource', f'{app_type}_ArchiveName', default=None, type_cast=str)
-    if not archive_name_template:
-         log_message(f"Ошибка: Не указан шаблон имени архива для типа '{app_type}' в разделе FtpSource конфига.", level="ERROR")
-         return False # Не настроен
-
-    # Заменяем {version} на форматированную версию
-    archive_name = archive_name_template.replace('{version}', version_formatted)
-
-    # Соединяем директорию и имя архива на FTP. ftplib требует отдельно директорию и имя файла.
-    ftp_full_path = f"{ftp_directory.rstrip('/')}/{archive_name}"
+    ftp_host = location['Host']
+    ftp_port = location['Port']
+    ftp_full_path = location['FullPath']
+    archive_file = location['ArchiveFile']
+    partial_path = _partial_archive_path(temp_archive_path, 'ftp')
+    throttle = _transfer_throttle(config, 'FtpSource', background, cancel_event)
 
-
-    update_status(f"Скачивание с FTP: {archive_name}...")
+    update_status(f"Скачивание с FTP: {location['ArchiveName']}...")
     log_message(f"Попытка скачивания с FTP: '{ftp_host}:{ftp_port}{ftp_full_path}' в '{temp_archive_path}'.")
 
-    from ftplib import FTP
+    ftp = None
+    cancelled = False
     try:
-        with FTP() as ftp:
-            ftp.connect(ftp_host, ftp_port)
-            ftp.login(ftp_username, ftp_password)
-            log_message(f"DEBUG: FTP логин успешен. Текущая директория: {ftp.pwd()}", level="DEBUG")
-
-            # Переходим в нужную директорию
-            # ftplib.cwd может принимать относительные пути, включая подпапки типа "Syrve/"
-            ftp.cwd(ftp_directory)
-            log_message(f"DEBUG: FTP смена директории на '{ftp_directory}' успешна. Текущая директория: {ftp.pwd()}", level="DEBUG")
-
-            # Если archive_name_template включал подпапку (например "Syrve/"),
-            # то archive_name будет "Syrve/RMSSOffice887.zip".
-            # Нам нужно сменить директорию еще раз для Syrve
-            archive_dir = os.path.dirname(archive_name)
-            archive_file = os.path.basename(archive_name)
-
-            if archive_dir and archive_dir != '.': # Если есть подпапка в имени архива
-                 try:
-                      ftp.cwd(archive_dir)
-                      log_message(f"DEBUG: FTP смена директории на подпапку '{archive_dir}' успешна. Текущая директория: {ftp.pwd()}", level="DEBUG")
-                 except Exception as e:
-                      log_message(f"Ошибка FTP: Не удалось сменить директорию на '{archive_dir}': {e}", level="ERROR")
-                      update_status(f"Ошибка FTP: Не найдена подпапка '{archive_dir}'.", level="ERROR")
-                      return False # Ошибка
-
-            # Получаем размер файла для прогресса
-            try:
-                total_size = ftp.size(archive_file)
-                log_message(f"DEBUG: Размер архива на FTP: {total_size} байт.", level="DEBUG")
-            except Exception as e:
-                 log_message(f"Ошибка FTP: Не удалось получить размер файла '{archive_file}': {e}", level="WARNING")
-                 total_size = 0
-
+        ftp = _ftp_connect(location)
 
-            downloaded_size = 0
-            buffer_size = 8192
+        def fetch_manifest(manifest_name):
+            # Файл контрольных сумм лежит в каталоге архива, куда _ftp_connect уже перешел
+            lines = []
+            ftp.retrlines(f'RETR {manifest_name}', lines.append)
+            return '\n'.join(lines)
 
-            # Callback функция для передачи прогресса в retrbinary
-            def handle_ftp_progress(chunk):
-                 nonlocal downloaded_size
-                 downloaded_size += len(chunk)
-                 if total_size > 0:
-                      progress_value = base_progress + (downloaded_size / total_size) * progress_range
-                      update_progress_callback(progress_value)
-                 f_dst.write(chunk)
+        expected_sha256 = _get_expected_sha256(config, 'FtpSource', location['ArchiveName'], fetch_manifest)
 
+        # Получаем размер файла для прогресса. SIZE многие серверы выполняют только в двоичном режиме.
+        try:
+            ftp.voidcmd('TYPE I')
+            total_size = ftp.size(archive_file)
+            log_message("DEBUG: Размер архива на FTP: %s байт.", total_size, level="DEBUG")
+        except Exception as e:
+             log_message(f"Ошибка FTP: Не удалось получить размер файла '{archive_file}': {e}", level="WARNING")
+             total_size = 0
 
-            with open(temp_archive_path, 'wb') as f_dst:
-                 # ftp.retrbinary('RETR filename', callback, blocksize)
-                 ftp.retrbinary(f'RETR {archive_file}', handle_ftp_progress, buffer_size)
-
-            log_message("Скачивание FTP завершено.")
-            update_status("Скачивание FTP завершено.")
-            update_progress_callback(base_progress + progress_range) # Убедимся, что прогресс достигает конца этапа
-            return True # Успех
+        # Время изменения файла на сервере - валидатор для докачки (аналог ETag)
+        try:
+            remote_mtime = ftp.voidcmd(f'MDTM {archive_file}')[4:].strip()
+        except Exception as e:
+            log_message("DEBUG: Сервер не поддерживает MDTM для '%s': %s", archive_file, e, level="DEBUG")
+            remote_mtime = None
+
+        # Докачиваем, только если архив на сервере не изменился с прошлой попытки
+        offset = 0
+        resume_state = _load_resume_state(partial_path)
+        if (resume_state and resume_state.get('mode') == 'ftp' and resume_state.get('path') == f"{ftp_host}:{ftp_port}{ftp_full_path}"
+                and total_size and resume_state.get('size') == total_size and resume_state.get('mdtm') == remote_mtime):
+            offset = os.path.getsize(partial_path)
+            if offset > total_size:
+                offset = 0
+            elif offset:
+                log_message(f"Найден частично скачанный архив ({offset} из {total_size} байт). Докачка с FTP (REST {offset}).")
+        elif resume_state:
+            log_message("Сохраненная часть архива не соответствует файлу на FTP. Скачивание начинается заново.", level="WARNING")
+        _save_resume_state(partial_path, {'mode': 'ftp', 'path': f"{ftp_host}:{ftp_port}{ftp_full_path}", 'size': total_size, 'mdtm': remote_mtime})
+
+        downloaded_size = offset
+        buffer_size = 8192
+        # Хэш считается по ходу скачивания; при докачке - сначала по уже полученной части
+        hasher = hashlib.sha256()
+        if offset:
+            _hash_file_prefix(hasher, partial_path, offset)
+
+        # Обработка очередного блока данных: хэш, прогресс и запись
+        def handle_ftp_progress(chunk):
+             nonlocal downloaded_size
+             _check_cancelled(cancel_event)
+             hasher.update(chunk)
+             downloaded_size += len(chunk)
+             if total_size > 0:
+                  progress_value = base_progress + (downloaded_size / total_size) * progress_range
+                  update_progress_callback(progress_value, transfer=(downloaded_size, total_size))
+             f_dst.write(chunk)
+             throttle(len(chunk))
+
+        with open(partial_path, 'r+b' if offset else 'wb') as f_dst:
+             f_dst.seek(offset)
+             f_dst.truncate()
+             if not total_size or offset < total_size:
+                 # RETR выполняется вручную (как ftp.retrbinary; rest отправляет REST перед RETR), чтобы при отмене
+                 # сразу разорвать соединение данных, а не ждать следующего блока от сервера
+                 with ftp.transfercmd(f'RETR {archive_file}', rest=offset or None) as conn, \
+                         _close_on_cancel(cancel_event, lambda: _shutdown_socket(conn)):
+                     while chunk := conn.recv(buffer_size):
+                         handle_ftp_progress(chunk)
+                 ftp.voidresp()
+
+        if total_size and downloaded_size != total_size:
+            raise EOFError(f"Архив получен не полностью ({downloaded_size} из {total_size} байт).")
+
+        archive_result = _archive_result(hasher.hexdigest(), expected_sha256, 'ftp')
+        os.replace(partial_path, temp_archive_path)
+        _remove_file_quietly(_resume_state_path(partial_path))
+        log_message("Скачивание FTP завершено.")
+        update_status("Скачивание FTP завершено.")
+        update_progress_callback(base_progress + progress_range) # Убедимся, что прогресс достигает конца этапа
+        return archive_result # Успех
 
+    except OperationCancelled:
+        cancelled = True
+        log_message(f"Скачивание с FTP '{ftp_host}:{ftp_port}{ftp_full_path}' прервано.")
+        _discard_partial(partial_path)
+        return False
+    except _ChecksumMismatch as e:
+        # Поврежденный архив не докачивается - следующая попытка начнет с нуля
+        log_message(f"Ошибка проверки архива с FTP '{ftp_host}:{ftp_port}{ftp_full_path}': {e}", level="ERROR")
+        update_status("Контрольная сумма архива с FTP не совпала.", level="ERROR")
+        _discard_partial(partial_path)
+        return False
     except Exception as e:
+        # Частичный архив сохраняется: следующая попытка продолжит с места обрыва (REST)
         log_message(f"Ошибка FTP скачивания с '{ftp_host}:{ftp_port}{ftp_full_path}': {e}", level="ERROR")
         update_status(f"Ошибка FTP скачивания: {e}", level="ERROR")
         return False # Ошибка скачивания
+    finally:
+        if ftp is not None:
+            _ftp_close(ftp, graceful=not cancelled)
 
 
-def _download_from_smb(config, app_type, version_formatted, expected_installer_name, temp_archive_path, update_status, update_progress_callback, base_progress, progress_range):
-    """Скачивает архив дистрибутива с SMB ресурса (копированием)."""
-    log_message(f"DEBUG: Попытка скачивания с SMB.")
+def _download_from_smb(config, app_type, version_formatted, expected_installer_name, temp_archive_path, update_status, update_progress_callback, base_progress, progress_range, cancel_event=None, background=False):
+    """Скачивает архив дистрибутива с SMB ресурса (копированием).
+       background - фоновая передача (предзагрузка): действуют лимиты скорости RateLimitKBps.
+       Возвращает сведения о скачанном архиве ({'sha256', 'verified'}) или False.
+    """
+    log_message("DEBUG: Попытка скачивания с SMB.", level="DEBUG")
     smb_enabled = get_config_value(config, 'SmbSource', 'Enabled', default=False, type_cast=bool)
     if not smb_enabled:
         log_message("DEBUG: SMB источник отключен в конфиге.", level="DEBUG")
         return False # Источник отключен
 
-    smb_path_base = get_config_value(config, 'SmbSource', 'Path', default=None, type_cast=str)
-    if not smb_path_base:
-        log_message("Ошибка: Не указан Path для SMB источника в конфиге.", level="ERROR")
+    smb_full_path = _get_smb_archive_path(config, app_type, version_formatted)
+    if not smb_full_path:
         return False # Не настроен
 
-    # Определяем имя архива для SMB источника
-    archive_name_template = get_config_value(config, 'SmbSource', f'{app_type}_ArchiveName', default=None, type_cast=str)
-    if not archive_name_template:
-         log_message(f"Ошибка: Не указан шаблон имени архива для типа '{app_type}' в разделе SmbSource конфига.", level="ERROR")
-         return False # Не настроен
-
-    # Заменяем {version} на форматированную версию
-    archive_name = archive_name_template.replace('{version}', version_formatted)
-
-    # Соединяем базовый путь и имя архива.
-    smb_full_path = os.path.join(smb_path_base, archive_name)
-    # При необходимости, os.path.join может некорректно работать с UNC путями и подпапками типа "Syrve/".
-    # Более надежно использовать Path.Combine в .NET или вручную склеивать, но для простых случаев os.path.join может сработать.
-    # Если шаблон включает подпапку (e.g., "Syrve/"), os.path.join(r"\\server\share", "Syrve/file.zip") может дать r"\\server\share\Syrve/file.zip"
-    # Лучше вручную склеить, учитывая слеши
-    smb_full_path = f"{smb_path_base.rstrip('/\\')}{os.sep}{archive_name.replace('/', os.sep).replace('\\', os.sep)}"
-
-
+    partial_path = _partial_archive_path(temp_archive_path, 'smb')
+    throttle = _transfer_throttle(config, 'SmbSource', background, cancel_event)
     update_status(f"Скачивание с SMB: {os.path.basename(smb_full_path)}...")
     log_message(f"Попытка скачивания с SMB: '{smb_full_path}' в '{temp_archive_path}'.")
 
@@ -642,56 +1831,1875 @@ def _download_from_smb(config, app_type, version_formatted, expected_installer_n
         # Получаем размер файла для прогресса
         try:
             total_size = os.path.getsize(smb_full_path)
-            log_message(f"DEBUG: Размер архива на SMB: {total_size} байт.", level="DEBUG")
+            log_message("DEBUG: Размер архива на SMB: %s байт.", total_size, level="DEBUG")
         except Exception as e:
              log_message(f"Ошибка при получении размера файла '{smb_full_path}': {e}", level="WARNING")
              total_size = 0
 
+        def fetch_manifest(manifest_name):
+            # Файл контрольных сумм лежит в папке архива
+            with open(os.path.join(os.path.dirname(smb_full_path), manifest_name), 'r', encoding='utf-8') as f:
+                return f.read()
+
+        expected_sha256 = _get_expected_sha256(config, 'SmbSource', _get_archive_name(config, 'SmbSource', app_type, version_formatted), fetch_manifest)
+
         copied_size = 0
-        buffer_size = 1024 * 1024 # 1 MB buffer
+        # 1 MB buffer; при лимите скорости - блоки помельче, чтобы чтение с шары шло ровнее, без пачек по мегабайту
+        buffer_size = 64 * 1024 if throttle.limited else 1024 * 1024
+        hasher = hashlib.sha256() # Хэш считается по ходу копирования
 
         # Копирование файла по частям для индикации прогресса
-        with open(smb_full_path, 'rb') as f_src, open(temp_archive_path, 'wb') as f_dst:
+        with open(smb_full_path, 'rb') as f_src, open(partial_path, 'wb') as f_dst:
             while True:
+                _check_cancelled(cancel_event)
                 buffer = f_src.read(buffer_size)
                 if not buffer:
                     break
                 f_dst.write(buffer)
+                hasher.update(buffer)
                 copied_size += len(buffer)
                 # Обновление прогресса
                 if total_size > 0:
                     progress_value = base_progress + (copied_size / total_size) * progress_range
-                    update_progress_callback(progress_value)
+                    update_progress_callback(progress_value, transfer=(copied_size, total_size))
+                throttle(len(buffer))
 
+        archive_result = _archive_result(hasher.hexdigest(), expected_sha256, 'smb')
+        os.replace(partial_path, temp_archive_path)
         log_message("Копирование SMB завершено.")
         update_status("Копирование SMB завершено.")
         update_progress_callback(base_progress + progress_range) # Убедимся, что прогресс достигает конца этапа
-        return True # Успех
+        return archive_result # Успех
 
+    except OperationCancelled:
+        log_message(f"Копирование с SMB '{smb_full_path}' прервано.")
+        _remove_file_quietly(partial_path)
+        return False
+    except _ChecksumMismatch as e:
+        log_message(f"Ошибка проверки архива с SMB '{smb_full_path}': {e}", level="ERROR")
+        update_status("Контрольная сумма архива с SMB не совпала.", level="ERROR")
+        _remove_file_quietly(partial_path)
+        return False
     except FileNotFoundError:
         log_message(f"Ошибка FileNotFoundError при скачивании с SMB: '{smb_full_path}'.", level="ERROR")
         update_status("Ошибка SMB скачивания: Файл не найден.", level="ERROR")
+        _remove_file_quietly(partial_path)
         return False # Ошибка
     except PermissionError:
         log_message(f"Ошибка доступа PermissionError при скачивании с SMB: '{smb_full_path}'. Проверьте права.", level="ERROR")
         update_status("Ошибка SMB скачивания: Нет прав доступа.", level="ERROR")
+        _remove_file_quietly(partial_path)
         return False # Ошибка
     except Exception as e:
         log_message(f"Неизвестная ошибка при скачивании с SMB '{smb_full_path}': {e}", level="ERROR")
         update_status(f"Неизвестная ошибка SMB скачивания: {e}", level="ERROR")
+        _remove_file_quietly(partial_path)
         return False # Неизвестная ошибка
 
 
-# ... (вспомогательные функции скачивания _download_from_smb, _download_from_http, _download_from_ftp) ...
+# Функции скачивания по коротким именам источников (используются в SourcePriority.Order)
+SOURCE_DOWNLOADERS = {
+    'smb': _download_from_smb,
+    'http': _download_from_http,
+    'ftp': _download_from_ftp
+}
+
 
-# --- Основная функция поиска/скачивания ---
+# --- Гонка источников ---
 
-def find_or_download_installer(config, app_type, version_formatted, vendor, update_status, update_progress_callback):
+def _probe_source(config, source_type, app_type, version_formatted, timeout_sec):
+    """Проверяет доступность архива на источнике (HEAD / SIZE / stat).
+       Возвращает размер архива в байтах (0, если размер неизвестен). При недоступности выбрасывает исключение.
+    """
+    if source_type == 'http':
+        http_full_url = _get_http_archive_url(config, app_type, version_formatted)
+        if not http_full_url:
+            raise ValueError("HTTP источник не настроен.")
+        response = get_http_session().head(http_full_url, allow_redirects=True, timeout=timeout_sec)
+        response.raise_for_status()
+        return int(response.headers.get('content-length', 0))
+
+    elif source_type == 'ftp':
+        location = _get_ftp_archive_location(config, app_type, version_formatted)
+        if location is None:
+            raise ValueError("FTP источник не настроен.")
+        ftp = _ftp_connect(location, timeout=timeout_sec)
+        try:
+            ftp.voidcmd('TYPE I') # SIZE многие серверы выполняют только в двоичном режиме
+            return ftp.size(location['ArchiveFile']) or 0
+        finally:
+            _ftp_close(ftp)
+
+    elif source_type == 'smb':
+        smb_full_path = _get_smb_archive_path(config, app_type, version_formatted)
+        if not smb_full_path:
+            raise ValueError("SMB источник не настроен.")
+        return os.stat(smb_full_path).st_size
+
+    raise ValueError(f"Неизвестный источник: '{source_type}'.")
+
+
+def _probe_sources_concurrently(config, source_types, app_type, version_formatted, timeout_sec):
+    """Запускает проверку всех источников одновременно.
+       Возвращает очередь, в которую по мере ответа попадают кортежи (source_type, size, error, latency_sec).
+    """
+    results = queue.Queue()
+
+    def probe_worker(source_type):
+        started = time.monotonic()
+        try:
+            size = _probe_source(config, source_type, app_type, version_formatted, timeout_sec)
+            results.put((source_type, size, None, time.monotonic() - started))
+        except Exception as e:
+            results.put((source_type, None, e, time.monotonic() - started))
+
+    for source_type in source_types:
+        # Daemon-потоки: зависший stat() на мертвой SMB шаре не должен мешать завершению приложения
+        threading.Thread(target=probe_worker, args=(source_type,), daemon=True).start()
+    return results
+
+
+def _collect_probe_winners(config, source_types, app_type, version_formatted, timeout_sec, grace_sec, update_status):
+    """Собирает ответившие источники в порядке ответа.
+       После первого ответа ждет остальных не дольше grace_sec, общий лимит - timeout_sec.
+    """
+    results = _probe_sources_concurrently(config, source_types, app_type, version_formatted, timeout_sec)
+    responders = []
+    pending = len(source_types)
+    deadline = time.monotonic() + timeout_sec
+
+    while pending > 0:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            source_type, size, error, latency = results.get(timeout=remaining)
+        except queue.Empty:
+            break
+        pending -= 1
+        if error is not None:
+            log_message(f"Источник '{source_type}' недоступен ({latency:.2f} сек): {error}", level="WARNING")
+            continue
+        log_message(f"Источник '{source_type}' ответил за {latency:.2f} сек. Размер архива: {size} байт.")
+        if not responders:
+            update_status(f"Первым ответил источник '{source_type}'.")
+            # После первого ответа даем остальным источникам лишь короткое окно
+            deadline = min(deadline, time.monotonic() + grace_sec)
+        responders.append(source_type)
+
+    if pending > 0:
+        log_message("DEBUG: %s источник(ов) не ответили вовремя и исключены из гонки.", pending, level="DEBUG")
+    return responders
+
+
+def _race_transfers(config, responders, app_type, version_formatted, expected_local_dir_name, temp_archive_path, update_status, update_progress_callback, base_progress, progress_range, measure_sec, cancel_event=None, background=False):
+    """Запускает скачивание со всех ответивших источников одновременно и через measure_sec
+       оставляет самый быстрый по фактической скорости, остальные передачи отменяются.
+       Возвращает кортеж (источник-победитель или None, сведения о скачанном архиве, список источников, завершившихся ошибкой).
+       При установке cancel_event отменяются все передачи и выбрасывается OperationCancelled.
+    """
+    contenders = {}
+    state = {'winner': None}
+
+    def make_progress(source_type):
+        def progress(value, transfer=None):
+            if transfer is not None:
+                # Скорость считается по фактически полученным байтам: файл сегментированного скачивания
+                # выделяется сразу целиком, а при докачке уже содержит часть архива
+                contender = contenders[source_type]
+                if contender['first_received'] is None:
+                    contender['first_received'] = transfer[0]
+                contender['received'] = transfer[0] - contender['first_received']
+            # До выбора победителя прогресс не показываем, иначе полоса будет прыгать между передачами
+            if state['winner'] == source_type:
+                update_progress_callback(value, transfer=transfer)
+        return progress
+
+    def make_status(source_type):
+        def status(message, level="INFO"):
+            if state['winner'] == source_type:
+                update_status(message, level=level)
+            else:
+                log_message("[%s] %s", source_type, message, level="DEBUG" if level == "INFO" else level)
+        return status
+
+    def transfer_worker(source_type):
+        contender = contenders[source_type]
+        downloader = SOURCE_DOWNLOADERS[source_type]
+        contender['result'] = downloader(
+            config, app_type, version_formatted, expected_local_dir_name,
+            _race_archive_path(temp_archive_path, source_type),
+            make_status(source_type), make_progress(source_type),
+            base_progress, progress_range, cancel_event=contender['cancel_event'], background=background
+        )
+        contender['done'].set()
+
+    for source_type in responders:
+        contenders[source_type] = {
+            'cancel_event': threading.Event(),
+            'done': threading.Event(),
+            'result': False,
+            'first_received': None, # Сколько байт было на первом отчете о прогрессе (докачка)
+            'received': 0,
+            'started': time.monotonic()
+        }
+    update_status(f"Гонка источников: {', '.join(responders)}...")
+    for source_type in responders:
+        contenders[source_type]['thread'] = threading.Thread(target=transfer_worker, args=(source_type,), daemon=True)
+        contenders[source_type]['thread'].start()
+
+    def downloaded_bytes(source_type):
+        if contenders[source_type]['first_received'] is not None:
+            return contenders[source_type]['received']
+        # Размер архива неизвестен и прогресс не сообщается - считаем по частичному файлу,
+        # который в этом случае растет по мере скачивания; он лежит рядом с итоговым путем участника
+        race_path = _race_archive_path(temp_archive_path, source_type)
+        for path in (_partial_archive_path(race_path, source_type), race_path):
+            try:
+                return os.path.getsize(path)
+            except OSError:
+                continue
+        return 0
+
+    # Фаза измерения: ждем measure_sec или пока кто-то не закончит
+    measure_deadline = time.monotonic() + measure_sec
+    finished_first = None
+    while time.monotonic() < measure_deadline:
+        finished = [s for s, c in contenders.items() if c['done'].is_set()]
+        successful = [s for s in finished if contenders[s]['result']]
+        if successful:
+            finished_first = successful[0]
+            break
+        if len(finished) == len(contenders):
+            break
+        if cancel_event is not None and cancel_event.is_set():
+            break
+        time.sleep(_CANCEL_CHECK_SEC)
+
+    alive = [s for s, c in contenders.items() if not c['done'].is_set() or c['result']]
+    if cancel_event is not None and cancel_event.is_set():
+        winner = None # Отмена: останавливаются все передачи
+    elif finished_first:
+        winner = finished_first
+    elif alive:
+        speeds = {s: downloaded_bytes(s) / max(time.monotonic() - contenders[s]['started'], 0.001) for s in alive}
+        for s, speed in speeds.items():
+            log_message(f"Источник '{s}': {speed / 1024:.0f} КБ/с за время измерения.")
+        winner = max(speeds, key=speeds.get)
+    else:
+        winner = None
+
+    state['winner'] = winner
+    for source_type, contender in contenders.items():
+        if source_type != winner:
+            contender['cancel_event'].set()
+    for source_type, contender in contenders.items():
+        if source_type != winner:
+            contender['thread'].join()
+            # Проигравший мог успеть скачать архив целиком до отмены
+            _remove_file_quietly(_race_archive_path(temp_archive_path, source_type))
+
+    # Источники, передача с которых сама завершилась ошибкой (а не была отменена)
+    failed = [s for s, c in contenders.items() if s != winner and c['done'].is_set() and not c['result'] and not c['cancel_event'].is_set()]
+
+    if winner is None:
+        _check_cancelled(cancel_event)
+        return None, None, failed
+
+    update_status(f"Выбран самый быстрый источник: '{winner}'.")
+    log_message(f"Победитель гонки источников: '{winner}'. Остальные передачи отменены.")
+    while not contenders[winner]['done'].wait(_CANCEL_CHECK_SEC):
+        if cancel_event is not None and cancel_event.is_set():
+            contenders[winner]['cancel_event'].set() # Передача прервется на ближайшем блоке данных
+    race_path = _race_archive_path(temp_archive_path, winner)
+    if cancel_event is not None and cancel_event.is_set():
+        _remove_file_quietly(race_path)
+        _check_cancelled(cancel_event)
+    if contenders[winner]['result'] and os.path.exists(race_path):
+        os.replace(race_path, temp_archive_path)
+        return winner, contenders[winner]['result'], failed
+    _remove_file_quietly(race_path)
+    return None, None, failed + [winner]
+
+
+def _race_archive_path(temp_archive_path, source_type):
+    """Итоговый путь архива для участника гонки (до выбора победителя у каждого свой файл)."""
+    return f"{temp_archive_path}.{source_type}.race"
+
+
+def _download_archive_sequential(config, source_order, app_type, version_formatted, expected_local_dir_name, temp_archive_path, update_status, update_progress_callback, base_progress, progress_range, stream_consumer=None, cancel_event=None, background=False):
+    """Скачивает архив, перебирая источники по очереди.
+       Возвращает кортеж (имя источника, сведения о скачанном архиве) или (None, None).
+       stream_consumer (потоковый распаковщик) передается только HTTP источнику.
+       При установке cancel_event передача прерывается и выбрасывается OperationCancelled.
+    """
+    for source_type in source_order:
+        _check_cancelled(cancel_event)
+        log_message("DEBUG: Попытка скачивания с источника '%s'...", source_type, level="DEBUG")
+        downloader = SOURCE_DOWNLOADERS.get(source_type)
+        if downloader is None:
+            log_message(f"Внимание: Неизвестный источник в приоритете: '{source_type}'. Пропускаем.", level="WARNING")
+            update_status(f"Неизвестный источник: '{source_type}'.", level="WARNING")
+            continue
+
+        update_status(f"Попытка скачивания с {source_type.upper()}...")
+        extra_args = {'cancel_event': cancel_event, 'background': background}
+        if source_type == 'http' and stream_consumer is not None and not stream_consumer.abandoned:
+            extra_args['stream_consumer'] = stream_consumer
+        archive_result = downloader(config, app_type, version_formatted, expected_local_dir_name, temp_archive_path, update_status, update_progress_callback, base_progress, progress_range, **extra_args)
+        if archive_result:
+            return source_type, archive_result # Скачивание успешно, переходим к распаковке
+        # Прерванная отменой передача - не повод переходить к следующему источнику
+        _check_cancelled(cancel_event)
+
+        log_message("DEBUG: Скачивание с источника '%s' не удалось.", source_type, level="DEBUG")
+    return None, None
+
+
+def _download_archive_race(config, source_order, app_type, version_formatted, expected_local_dir_name, temp_archive_path, update_status, update_progress_callback, base_progress, progress_range, cancel_event=None, background=False):
+    """Скачивает архив в режиме гонки: все включенные источники проверяются одновременно,
+       передача начинается с первого ответившего (RaceSelect = first) или с самого быстрого (RaceSelect = fastest).
+       Возвращает кортеж (имя источника, сведения о скачанном архиве) или (None, None).
+    """
+    probe_timeout = get_config_value(config, 'SourcePriority', 'ProbeTimeoutSec', default=5, type_cast=float)
+    grace_sec = get_config_value(config, 'SourcePriority', 'RaceGraceMs', default=500, type_cast=int) / 1000
+    race_select = get_config_value(config, 'SourcePriority', 'RaceSelect', default='first', type_cast=str).strip().lower()
+    measure_sec = get_config_value(config, 'SourcePriority', 'RaceMeasureSec', default=3, type_cast=float)
+
+    enabled_sources = []
+    for source_type in source_order:
+        section = SOURCE_SECTIONS.get(source_type)
+        if section is None:
+            log_message(f"Внимание: Неизвестный источник в приоритете: '{source_type}'. Пропускаем.", level="WARNING")
+            continue
+        if get_config_value(config, section, 'Enabled', default=False, type_cast=bool):
+            enabled_sources.append(source_type)
+
+    if not enabled_sources:
+        log_message("Нет включенных источников для гонки.", level="ERROR")
+        return None, None
+
+    update_status(f"Проверка источников: {', '.join(enabled_sources)}...")
+    responders = _collect_probe_winners(config, enabled_sources, app_type, version_formatted, probe_timeout, grace_sec, update_status)
+    if not responders:
+        log_message("Ни один источник не ответил на проверку наличия архива.", level="ERROR")
+        return None, None
+
+    if race_select == 'fastest' and len(responders) > 1:
+        winner, archive_result, failed = _race_transfers(config, responders, app_type, version_formatted, expected_local_dir_name, temp_archive_path, update_status, update_progress_callback, base_progress, progress_range, measure_sec, cancel_event, background)
+        if winner:
+            return winner, archive_result
+        # Если победитель не справился, пробуем остальных по очереди ответа
+        log_message("Гонка передач не дала результата. Последовательная попытка с ответившими источниками.", level="WARNING")
+        responders = [s for s in responders if s not in failed]
+
+    # Режим first: передача с первого ответившего, остальные - запасные в порядке ответа
+    return _download_archive_sequential(config, responders, app_type, version_formatted, expected_local_dir_name, temp_archive_path, update_status, update_progress_callback, base_progress, progress_range, cancel_event=cancel_event, background=background)
+
+# --- Локальный кэш дистрибутивов (индекс InstallerRoot) ---
+
+CACHE_INDEX_FILE_NAME = "cache_index.json"
+
+# Блокировка индекса кэша: к нему обращаются поток запуска и фоновые загрузки
+_cache_index_lock = threading.RLock()
+
+
+def _cache_index_path(installer_root):
+    """Путь к файлу индекса кэша дистрибутивов."""
+    return os.path.join(installer_root, CACHE_INDEX_FILE_NAME)
+
+
+def load_cache_index(installer_root):
+    """Загружает индекс кэша дистрибутивов. При отсутствии или повреждении возвращает пустой индекс."""
+    index_path = _cache_index_path(installer_root)
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        if isinstance(index, dict) and isinstance(index.get('entries'), dict):
+            return index
+        log_message(f"Внимание: Индекс кэша '{index_path}' имеет неверный формат и будет пересоздан.", level="WARNING")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        log_message(f"Внимание: Не удалось прочитать индекс кэша '{index_path}': {e}", level="WARNING")
+    return {'version': 1, 'entries': {}}
+
+
+def _save_cache_index(installer_root, index):
+    """Атомарно сохраняет индекс кэша дистрибутивов."""
+    index_path = _cache_index_path(installer_root)
+    try:
+        os.makedirs(installer_root, exist_ok=True)
+        with open(index_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False, indent=2)
+        os.replace(index_path + '.tmp', index_path)
+    except Exception as e:
+        log_message(f"Ошибка при сохранении индекса кэша '{index_path}': {e}", level="ERROR")
+
+
+def update_cache_entry(installer_root, dir_name, **fields):
+    """Создает или обновляет запись индекса кэша для папки дистрибутива."""
+    with _cache_index_lock:
+        index = load_cache_index(installer_root)
+        entry = index['entries'].setdefault(dir_name, {})
+        entry.update(fields)
+        _save_cache_index(installer_root, index)
+        return dict(entry)
+
+
+def remove_cache_entry(installer_root, dir_name):
+    """Удаляет запись индекса кэша для папки дистрибутива."""
+    with _cache_index_lock:
+        index = load_cache_index(installer_root)
+        if index['entries'].pop(dir_name, None) is not None:
+            _save_cache_index(installer_root, index)
+
+
+def get_cache_entry(installer_root, dir_name):
+    """Возвращает запись индекса кэша для папки дистрибутива или None."""
+    with _cache_index_lock:
+        return load_cache_index(installer_root)['entries'].get(dir_name)
+
+
+def _get_dir_size(path):
+    """Считает суммарный размер файлов в папке (рекурсивно). Общие с другими версиями файлы
+       (жесткие ссылки на хранилище) входят целиком - это размер версии, а не ее доля на диске.
+    """
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass
+    return total
+
+
+def _scan_file_inodes(path):
+    """Возвращает {(st_dev, st_ino): размер} для файлов папки (рекурсивно).
+       Жесткие ссылки на один файл дают один ключ - по нему общие файлы версий учитываются один раз.
+    """
+    inodes = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                # os.stat, а не DirEntry.stat: на Windows только он заполняет st_ino
+                st = os.stat(os.path.join(dirpath, filename))
+            except OSError:
+                continue
+            inodes[(st.st_dev, st.st_ino)] = st.st_size
+    return inodes
+
+
+def _is_process_alive(pid):
+    """Проверяет, что процесс с указанным PID еще работает."""
+    if not pid:
+        return False
+    if os.name == 'nt':
+        PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+        STILL_ACTIVE = 259
+        handle = ctypes.windll.kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, int(pid))
+        if not handle:
+            return False
+        try:
+            exit_code = ctypes.wintypes.DWORD()
+            if not ctypes.windll.kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code)):
+                return False
+            return exit_code.value == STILL_ACTIVE
+        finally:
+            ctypes.windll.kernel32.CloseHandle(handle)
+    try:
+        os.kill(int(pid), 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True # Процесс есть, но принадлежит другому пользователю
+    except Exception:
+        return False
+
+
+def _is_installer_in_use(local_installer_path, entry):
+    """Определяет, используется ли дистрибутив сейчас (запущен BackOffice из этой папки)."""
+    # Процессы, запущенные этим лаунчером
+    if any(_is_process_alive(pid) for pid in entry.get('active_pids', [])):
+        return True
+    # На Windows исполняемый файл запущенного процесса нельзя открыть на запись
+    backoffice_exe = os.path.join(local_installer_path, "BackOffice.exe")
+    if os.name == 'nt' and os.path.exists(backoffice_exe):
+        try:
+            with open(backoffice_exe, 'r+b'):
+                pass
+        except PermissionError:
+            return True
+        except OSError:
+            pass
+    return False
+
+
+def mark_installer_in_use(config, installer_path, pid):
+    """Закрепляет дистрибутив за запущенным процессом BackOffice, чтобы он не был вытеснен из кэша."""
+    installer_root = os.path.dirname(installer_path)
+    dir_name = os.path.basename(installer_path)
+    with _cache_index_lock:
+        index = load_cache_index(installer_root)
+        entry = index['entries'].setdefault(dir_name, {})
+        # Заодно забываем PID завершившихся процессов
+        active_pids = [p for p in entry.get('active_pids', []) if _is_process_alive(p)]
+        if pid not in active_pids:
+            active_pids.append(pid)
+        entry['active_pids'] = active_pids
+        entry['last_launch'] = time.time()
+        _save_cache_index(installer_root, index)
+    log_message("DEBUG: Дистрибутив '%s' закреплен за процессом PID %s.", dir_name, pid, level="DEBUG")
+
+
+def _adopt_untracked_installers(installer_root, index):
+    """Добавляет в индекс папки дистрибутивов, созданные до появления индекса (или вручную)."""
+    changed = False
+    try:
+        names = os.listdir(installer_root)
+    except OSError:
+        return changed
+    for name in names:
+        path = os.path.join(installer_root, name)
+        if name in index['entries'] or not os.path.isfile(os.path.join(path, "BackOffice.exe")):
+            continue
+        index['entries'][name] = {
+            'state': 'ready',
+            'size_bytes': _get_dir_size(path),
+            'source': 'local',
+            'archive_sha256': None,
+            'checksum_verified': False,
+            'installed_at': os.path.getmtime(path),
+            # Время последнего запуска неизвестно - берем время изменения папки
+            'last_launch': os.path.getmtime(path)
+        }
+        changed = True
+        log_message("DEBUG: Папка '%s' добавлена в индекс кэша.", name, level="DEBUG")
+    return changed
+
+
+def _is_installer_being_prepared(installer_root, entry):
+    """Готовит ли сейчас дистрибутив этой записи другой поток (занята блокировка подготовки версии)."""
+    if not entry.get('app_type') or not entry.get('version'):
+        return False
+    key = (os.path.normcase(os.path.abspath(installer_root)), entry['app_type'], entry['version'])
+    with _installer_locks_guard:
+        lock = _installer_locks.get(key)
+    return lock is not None and lock.locked()
+
+
+def _remove_stale_installs(installer_root, index):
+    """Удаляет папки и записи установок, оборванных падением лаунчера: запись 'installing',
+       которую не готовит ни поток этого процесса, ни другой живой процесс лаунчера.
+       Возвращает True, если индекс изменился.
+    """
+    changed = False
+    for name, entry in list(index['entries'].items()):
+        if entry.get('state') != 'installing' or _is_installer_being_prepared(installer_root, entry):
+            continue
+        pid = entry.get('installer_pid')
+        if pid and pid != os.getpid() and _is_process_alive(pid):
+            continue # Версию сейчас ставит другой процесс лаунчера
+        path = os.path.join(installer_root, name)
+        if _is_path_inside(path, installer_root):
+            shutil.rmtree(path, ignore_errors=True)
+        if os.path.exists(path):
+            log_message(f"Внимание: Не удалось удалить папку незавершенной установки '{path}'.", level="WARNING")
+            continue
+        log_message(f"Удалена папка незавершенной установки '{name}' (установка была прервана).", level="WARNING")
+        del index['entries'][name]
+        changed = True
+    return changed
+
+
+def enforce_cache_limits(config, keep=None):
+    """Вытесняет давно не запускавшиеся версии (LRU), пока кэш не уложится в лимиты [Cache].
+       Закрепленные (PinnedVersions), используемые сейчас и keep не удаляются.
+       Версии, которые еще устанавливаются (state не 'ready' или занята блокировка подготовки),
+       не вытесняются и не учитываются в лимитах. Установки, прерванные падением лаунчера, удаляются.
+    """
+    installer_root = get_config_value(config, 'Settings', 'InstallerRoot', default='D:\\Backs')
+    max_size_gb = get_config_value(config, 'Cache', 'MaxSizeGb', default=0, type_cast=float)
+    max_versions = get_config_value(config, 'Cache', 'MaxVersions', default=0, type_cast=int)
+    pinned_str = get_config_value(config, 'Cache', 'PinnedVersions', default='', type_cast=str)
+    pinned = {name.strip().lower() for name in pinned_str.split(',') if name.strip()}
+
+    # Установки, оборванные падением лаунчера, иначе остались бы в кэше навсегда
+    with _cache_index_lock:
+        index = load_cache_index(installer_root)
+        if _remove_stale_installs(installer_root, index):
+            _save_cache_index(installer_root, index)
+
+    if max_size_gb <= 0 and max_versions <= 0:
+        if get_config_value(config, 'Cache', 'Deduplicate', default=True, type_cast=bool):
+            prune_object_store(installer_root) # Объекты папок, удаленных вручную
+        return [] # Лимиты не заданы
+
+    max_size_bytes = int(max_size_gb * 1024 ** 3)
+    evicted = []
+    with _cache_index_lock:
+        index = load_cache_index(installer_root)
+        changed = _adopt_untracked_installers(installer_root, index)
+
+        # Записи о папках, удаленных вручную, больше не нужны
+        for name in [n for n in index['entries'] if not os.path.isdir(os.path.join(installer_root, n))]:
+            del index['entries'][name]
+            changed = True
+
+        entries = index['entries']
+        # Устанавливаемые версии не трогаем: их папку сейчас заполняет другой поток.
+        # keep готовит сам вызывающий - его блокировка занята, но версия уже готова.
+        ready = [name for name, entry in entries.items()
+                 if entry.get('state') == 'ready' and (name == keep or not _is_installer_being_prepared(installer_root, entry))]
+        ready_count = len(ready)
+        total_size = 0
+        if max_size_bytes > 0:
+            # Реальный объем на диске: файл, общий для нескольких версий (жесткие ссылки на объект хранилища),
+            # учитывается один раз и освобождается, только когда вытеснены все использующие его версии
+            version_inodes = {name: _scan_file_inodes(os.path.join(installer_root, name)) for name in ready}
+            inode_refs = {}
+            for inodes in version_inodes.values():
+                for inode, size in inodes.items():
+                    if inode not in inode_refs:
+                        total_size += size
+                    inode_refs[inode] = inode_refs.get(inode, 0) + 1
+        # Кандидаты на вытеснение - от самых давно запускавшихся
+        candidates = sorted(ready, key=lambda n: entries[n].get('last_launch', 0))
+
+        for name in candidates:
+            over_size = max_size_bytes > 0 and total_size > max_size_bytes
+            over_count = max_versions > 0 and ready_count > max_versions
+            if not over_size and not over_count:
+                break
+            if name == keep or name.lower() in pinned:
+                continue
+            path = os.path.join(installer_root, name)
+            if _is_installer_in_use(path, entries[name]):
+                log_message("DEBUG: Дистрибутив '%s' используется и не будет вытеснен.", name, level="DEBUG")
+                continue
+            try:
+                shutil.rmtree(path)
+            except Exception as e:
+                log_message(f"Внимание: Не удалось удалить дистрибутив '{path}' из кэша: {e}", level="WARNING")
+                continue
+            log_message(f"Дистрибутив '{name}' вытеснен из кэша (последний запуск: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entries[name].get('last_launch', 0)))}).")
+            if max_size_bytes > 0:
+                for inode, size in version_inodes[name].items():
+                    inode_refs[inode] -= 1
+                    if inode_refs[inode] == 0:
+                        total_size -= size
+            ready_count -= 1
+            del entries[name]
+            evicted.append(name)
+            changed = True
+
+        if changed:
+            _save_cache_index(installer_root, index)
+    if get_config_value(config, 'Cache', 'Deduplicate', default=True, type_cast=bool):
+        prune_object_store(installer_root) # Объекты, на которые ссылались только вытесненные версии
+    return evicted
+
+
+# --- Хранилище файлов дистрибутивов по содержимому (общие файлы версий хранятся один раз) ---
+
+OBJECT_STORE_DIR_NAME = ".objects" # Папка хранилища в InstallerRoot: <первые 2 символа SHA-256>/<SHA-256>
+_DEDUP_MIN_FILE_BYTES = 4096 # Файлы меньше кластера ссылками не заменяются - места это не экономит
+_FICLONE = 0x40049409 # ioctl Linux: копия файла с общими блоками (Btrfs, XFS)
+
+# Блокировка хранилища: объекты добавляют установки разных версий из разных потоков
+_object_store_lock = threading.Lock()
+
+
+def _object_path(installer_root, sha256):
+    """Путь объекта хранилища для файла с заданным SHA-256."""
+    return os.path.join(installer_root, OBJECT_STORE_DIR_NAME, sha256[:2], sha256)
+
+
+def _clone_file(src, dst):
+    """Копирует файл: клонированием блоков (copy-on-write), если ФС это умеет, иначе обычным копированием.
+       Возвращает 'clone' или 'copy'.
+    """
+    if sys.platform.startswith('linux'):
+        try:
+            import fcntl
+            with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+                fcntl.ioctl(f_dst.fileno(), _FICLONE, f_src.fileno())
+            return 'clone'
+        except OSError:
+            pass # ФС без reflink - копируем
+    shutil.copyfile(src, dst)
+    return 'copy'
+
+
+def _link_or_clone(src, dst):
+    """Создает dst с содержимым src без записи данных, если возможно: жесткой ссылкой,
+       иначе клонированием блоков, в крайнем случае копированием. Возвращает 'link', 'clone' или 'copy'.
+    """
+    try:
+        os.link(src, dst)
+        return 'link'
+    except OSError:
+        return _clone_file(src, dst)
+
+
+def find_store_object(installer_root, sha256, size):
+    """Путь объекта хранилища с заданным SHA-256 и размером или None."""
+    path = _object_path(installer_root, sha256)
+    try:
+        return path if os.path.getsize(path) == size else None
+    except OSError:
+        return None
+
+
+def _store_file(installer_root, path, sha256):
+    """Заменяет файл дистрибутива ссылкой на объект хранилища (или добавляет его в хранилище как новый объект).
+       Возвращает 'stored', 'link', 'clone', 'copy' или None, если ФС не поддерживает жесткие ссылки.
+    """
+    object_path = _object_path(installer_root, sha256)
+    with _object_store_lock:
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            try:
+                os.link(path, object_path)
+            except OSError:
+                return None
+            return 'stored'
+        if os.path.samefile(object_path, path):
+            return 'link' # Уже ссылка на объект
+        temp_path = path + '.dedup'
+        mode = _link_or_clone(object_path, temp_path)
+        os.replace(temp_path, path)
+        return mode
+
+
+def _store_file_quietly(installer_root, path, sha256):
+    """_store_file без исключений: файл, который не удалось перевести на хранилище, остается копией."""
+    try:
+        return _store_file(installer_root, path, sha256)
+    except OSError as e:
+        log_message("DEBUG: Файл '%s' не переведен на хранилище: %s", path, e, level="DEBUG")
+        return None
+
+
+def deduplicate_installer(installer_root, installer_path, known_hashes=None, cancel_event=None):
+    """Переводит файлы папки дистрибутива на хранилище InstallerRoot/.objects: файл, уже известный
+       по другой версии, заменяется жесткой ссылкой на объект, новый - становится объектом.
+       known_hashes - {относительный путь: SHA-256} для файлов, хэш которых уже известен (манифест версии).
+       Возвращает статистику {'files', 'linked', 'stored', 'saved_bytes'}.
+    """
+    known_hashes = known_hashes or {}
+    stats = {'files': 0, 'linked': 0, 'stored': 0, 'saved_bytes': 0}
+    for dirpath, dirnames, filenames in os.walk(installer_path):
+        for filename in filenames:
+            _check_cancelled(cancel_event)
+            path = os.path.join(dirpath, filename)
+            size = os.path.getsize(path)
+            if size < _DEDUP_MIN_FILE_BYTES:
+                continue
+            stats['files'] += 1
+            sha256 = known_hashes.get(os.path.relpath(path, installer_path).replace(os.sep, '/'))
+            if sha256 is None:
+                hasher = hashlib.sha256()
+                _hash_file_prefix(hasher, path, size)
+                sha256 = hasher.hexdigest()
+            try:
+                mode = _store_file(installer_root, path, sha256)
+            except OSError as e:
+                # Файл занят или недоступен - он просто остается отдельной копией
+                log_message("DEBUG: Файл '%s' не переведен на хранилище: %s", path, e, level="DEBUG")
+                continue
+            if mode is None:
+                log_message(f"Файловая система '{installer_root}' не поддерживает жесткие ссылки. Дедупликация файлов пропущена.", level="WARNING")
+                return stats
+            if mode == 'stored':
+                stats['stored'] += 1
+            elif mode in ('link', 'clone'):
+                stats['linked'] += 1
+                stats['saved_bytes'] += size
+    return stats
+
+
+def prune_object_store(installer_root):
+    """Удаляет объекты хранилища, на которые не ссылается ни одна папка дистрибутива (число ссылок 1).
+       Возвращает число освобожденных байт.
+    """
+    freed = 0
+    store_root = os.path.join(installer_root, OBJECT_STORE_DIR_NAME)
+    with _object_store_lock:
+        for dirpath, dirnames, filenames in os.walk(store_root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                    if st.st_nlink <= 1:
+                        os.remove(path)
+                        freed += st.st_size
+                except OSError as e:
+                    log_message("DEBUG: Не удалось проверить объект хранилища '%s': %s", path, e, level="DEBUG")
+    if freed:
+        log_message(f"Из хранилища файлов удалены объекты, не используемые ни одной версией ({freed} байт).")
+    return freed
+
+
+# --- Распаковка дистрибутива ---
+
+def _find_content_root(member_names):
+    """Определяет корень содержимого дистрибутива внутри архива - папку, в которой лежит BackOffice.exe.
+       Возвращает префикс ('' или 'folder/.../') или None, если BackOffice.exe в архиве нет.
+    """
+    candidates = [name for name in member_names if name.replace('\\', '/').rsplit('/', 1)[-1] == "BackOffice.exe"]
+    if not candidates:
+        return None
+    # Если BackOffice.exe встречается несколько раз, берем самый верхний уровень
+    shallowest = min(candidates, key=lambda name: name.replace('\\', '/').count('/'))
+    normalized = shallowest.replace('\\', '/')
+    return normalized[:-len("BackOffice.exe")]
+
+
+def _safe_member_path(dest_root, relative_name):
+    """Преобразует имя элемента архива в путь внутри dest_root, отбрасывая опасные компоненты ('..', диски, корни)."""
+    parts = []
+    for part in relative_name.replace('\\', '/').split('/'):
+        if part in ('', '.', '..'):
+            continue
+        if os.name == 'nt':
+            # Как zipfile: убираем двоеточия дисков и недопустимые символы Windows
+            part = re.sub(r'[:<>"|?*]', '_', part).rstrip('. ')
+            if not part:
+                continue
+        parts.append(part)
+    if not parts:
+        return None
+    return os.path.join(dest_root, *parts)
+
+
+def _is_path_inside(path, root):
+    """Проверяет, что path лежит строго внутри root (после разрешения '..' и символических ссылок)."""
+    root = os.path.realpath(root)
+    path = os.path.realpath(path)
+    return path != root and os.path.commonpath([path, root]) == root
+
+
+def _content_members(zip_ref, content_root):
+    """Возвращает список (ZipInfo, относительное имя) элементов архива, лежащих внутри корня содержимого."""
+    members = []
+    for info in zip_ref.infolist():
+        name = info.filename.replace('\\', '/')
+        if not name.startswith(content_root):
+            continue # Все, что вне корня содержимого, в дистрибутив не попадает
+        relative_name = name[len(content_root):]
+        if relative_name:
+            members.append((info, relative_name))
+    return members
+
+
+def _get_extract_workers(config):
+    """Число потоков распаковки из конфига (0 - по числу ядер процессора, но не более 8)."""
+    workers = get_config_value(config, 'Settings', 'ExtractWorkers', default=0, type_cast=int)
+    if workers <= 0:
+        workers = min(os.cpu_count() or 1, 8)
+    return workers
+
+
+def _shard_members(file_members, shard_count):
+    """Раскладывает элементы архива по shard_count частям, выравнивая их по объему распакованных данных.
+       Крупные файлы раскладываются первыми, каждый - в наименее загруженную часть.
+    """
+    shards = [[] for _ in range(shard_count)]
+    shard_sizes = [0] * shard_count
+    for member in sorted(file_members, key=lambda item: item[0].file_size, reverse=True):
+        lightest = shard_sizes.index(min(shard_sizes))
+        shards[lightest].append(member)
+        shard_sizes[lightest] += member[0].file_size
+    return [shard for shard in shards if shard]
+
+
+def _extract_shard(archive_path, shard, abort_event, progress_state):
+    """Распаковывает часть элементов архива. Каждый поток работает со своим дескриптором ZipFile."""
+    with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+        for info, target_path in shard:
+            if abort_event.is_set():
+                return
+            with zip_ref.open(info) as f_src, open(target_path, 'wb') as f_dst:
+                while True:
+                    if abort_event.is_set():
+                        return # Большой файл прерывается на ближайшем блоке
+                    data = f_src.read(1024 * 1024)
+                    if not data:
+                        break
+                    f_dst.write(data)
+                    with progress_state['lock']:
+                        progress_state['bytes'] += len(data)
+
+
+def _extract_archive_direct(archive_path, dest_root, update_progress_callback, base_progress, progress_range, workers=1, cancel_event=None):
+    """Распаковывает архив сразу в итоговую папку дистрибутива, отбрасывая путь до корня содержимого
+       (папки с BackOffice.exe). Промежуточная папка и последующее перемещение не нужны.
+       Файлы распаковываются в workers потоков, прогресс считается по объему распакованных данных.
+       При установке cancel_event потоки останавливаются и выбрасывается OperationCancelled.
+    """
+    try:
+        with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+            content_root = _find_content_root(zip_ref.namelist())
+            if content_root is None:
+                raise FileNotFoundError(f"Файл BackOffice.exe не найден в архиве '{os.path.basename(archive_path)}'.")
+            log_message(f"Корень содержимого в архиве: '{content_root or '/'}'. Распаковка напрямую в '{dest_root}'.")
+            members = _content_members(zip_ref, content_root)
+
+        if not members:
+             log_message("DEBUG: Архив пуст. Распаковка не требуется.", level="WARNING")
+
+        # Все папки создаются заранее, чтобы потоки распаковки не делали это для каждого файла
+        directories = set()
+        file_members = []
+        for info, relative_name in members:
+            target_path = _safe_member_path(dest_root, relative_name)
+            if target_path is None:
+                continue
+            if info.is_dir():
+                directories.add(target_path)
+            else:
+                directories.add(os.path.dirname(target_path))
+                file_members.append((info, target_path))
+        for directory in sorted(directories):
+            os.makedirs(directory, exist_ok=True)
+
+        total_bytes = sum(info.file_size for info, _ in file_members)
+        shards = _shard_members(file_members, max(1, workers))
+        log_message("DEBUG: Распаковка %s файлов (%s байт) в %s потоков.", len(file_members), total_bytes, len(shards), level="DEBUG")
+
+        progress_state = {'bytes': 0, 'lock': threading.Lock()}
+        abort_event = threading.Event()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(shards)), thread_name_prefix="extract") as executor:
+            futures = [executor.submit(_extract_shard, archive_path, shard, abort_event, progress_state) for shard in shards]
+            pending = set(futures)
+            try:
+                while pending:
+                    done, pending = concurrent.futures.wait(pending, timeout=_CANCEL_CHECK_SEC, return_when=concurrent.futures.FIRST_EXCEPTION)
+                    for future in done:
+                        future.result() # Пробрасываем ошибку потока распаковки
+                    _check_cancelled(cancel_event)
+                    # Обновление прогресса
+                    # Прогресс внутри распаковки: (распаковано байт / всего байт) * range
+                    if total_bytes > 0:
+                        update_progress_callback(base_progress + (progress_state['bytes'] / total_bytes) * progress_range,
+                                                 transfer=(progress_state['bytes'], total_bytes))
+            except BaseException:
+                abort_event.set() # Остальные потоки прекращают работу после текущего файла
+                raise
+    except zipfile.BadZipFile:
+        # Специфическая ошибка парсинга ZIP - перебрасываем с более понятным сообщением
+        raise zipfile.BadZipFile(f"Архив '{os.path.basename(archive_path)}' поврежден или не является ZIP-файлом.")
+
+
+class _StreamingZipExtractor:
+    """Распаковывает ZIP по мере скачивания, разбирая локальные заголовки элементов из потока байтов.
+
+       Функция скачивания передает сюда каждый полученный блок (feed). Отдельный поток пишет элементы
+       в итоговую папку по их полным путям, а после скачивания finalize() сверяет результат с центральным
+       каталогом архива и поднимает корень содержимого на место. Если структура архива не позволяет
+       потоковую распаковку (данные без размера, шифрование), распаковщик отказывается,
+       и архив распаковывается обычным способом после скачивания.
+    """
+
+    LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+    DATA_DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+
+    def __init__(self, dest_root):
+        self.dest_root = dest_root
+        self.started = False
+        self.abandoned = False
+        self.error = None
+        self.extracted = {} # Имя элемента -> (CRC-32, размер)
+        self.created_top_level = set() # Верхние элементы, созданные в dest_root
+        self._queue = queue.Queue(maxsize=256) # Ограничение памяти: не более ~256 блоков в очереди
+        self._buffer = bytearray()
+        self._input_closed = False
+        self._thread = None
+
+    # --- Сторона скачивания ---
+
+    def start(self):
+        """Запускает поток распаковки (вызывается функцией скачивания перед первым блоком)."""
+        if self.started or self.abandoned:
+            return
+        self.started = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def feed(self, chunk):
+        """Передает очередной блок скачанных данных."""
+        if not self.started or self.abandoned:
+            return
+        while not self.abandoned:
+            try:
+                self._queue.put(chunk, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def finish_input(self):
+        """Сообщает, что скачивание завершено."""
+        if self.started and not self.abandoned:
+            self._queue.put(None)
+
+    def abandon(self, reason):
+        """Отказ от потоковой распаковки (ошибка скачивания, докачка с середины, неподходящая структура)."""
+        if not self.abandoned:
+            log_message("Потоковая распаковка отменена: %s", reason, level="WARNING" if self.started else "DEBUG")
+        self.abandoned = True
+        if self.started:
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                pass
+
+    def wait(self):
+        """Ожидает завершения потока распаковки. Возвращает True, если поток разобрал весь архив."""
+        if self._thread is not None:
+            self._thread.join()
+        return self.started and not self.abandoned and self.error is None
+
+    # --- Разбор потока ---
+
+    def _read_exact(self, size):
+        """Читает ровно size байт из потока (блокируется до поступления данных)."""
+        while len(self._buffer) < size:
+            if self._input_closed or self.abandoned:
+                raise EOFError("Поток данных архива закончился раньше ожидаемого.")
+            chunk = self._queue.get()
+            if chunk is None:
+                self._input_closed = True
+                continue
+            self._buffer += chunk
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def _read_some(self):
+        """Возвращает следующую порцию данных потока (b'' в конце потока)."""
+        if self._buffer:
+            data = bytes(self._buffer)
+            self._buffer.clear()
+            return data
+        while not self._input_closed and not self.abandoned:
+            chunk = self._queue.get()
+            if chunk is None:
+                self._input_closed = True
+                break
+            if chunk:
+                return chunk
+        return b''
+
+    def _run(self):
+        try:
+            while not self.abandoned:
+                signature = self._read_exact(4)
+                if signature != self.LOCAL_HEADER_SIGNATURE:
+                    # Центральный каталог или конец архива - все элементы разобраны
+                    break
+                self._extract_next_member()
+            # Дочитываем поток до конца, чтобы не блокировать скачивание
+            while not self.abandoned and self._read_some():
+                pass
+        except Exception as e:
+            self.error = e
+            self.abandon(str(e))
+
+    def _extract_next_member(self):
+        header = struct.unpack('<HHHHHIIIHH', self._read_exact(26))
+        _, flags, method, _, _, crc, compressed_size, file_size, name_length, extra_length = header
+        raw_name = self._read_exact(name_length)
+        extra = self._read_exact(extra_length)
+        # Бит 11 - имя в UTF-8, иначе cp437 (как в zipfile)
+        name = raw_name.decode('utf-8' if flags & 0x800 else 'cp437')
+
+        if flags & 0x1:
+            raise ValueError(f"элемент '{name}' зашифрован")
+        if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise ValueError(f"метод сжатия {method} элемента '{name}' не поддерживается")
+
+        zip64 = False
+        if compressed_size == 0xFFFFFFFF or file_size == 0xFFFFFFFF:
+            zip64 = True
+            file_size, compressed_size = self._parse_zip64_sizes(extra, file_size, compressed_size)
+        has_descriptor = bool(flags & 0x8)
+        if has_descriptor and method == zipfile.ZIP_STORED:
+            # Без размера в заголовке конец несжатых данных не найти
+            raise ValueError(f"элемент '{name}' без размера в локальном заголовке")
+
+        target_path = _safe_member_path(self.dest_root, name)
+        is_dir = name.endswith('/')
+        if target_path is not None:
+            # Верхний элемент берем из очищенного пути: сырое имя может начинаться с '..'
+            self.created_top_level.add(os.path.relpath(target_path, self.dest_root).split(os.sep, 1)[0])
+
+        f_dst = None
+        if target_path is not None and is_dir:
+            os.makedirs(target_path, exist_ok=True)
+        elif target_path is not None:
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            f_dst = open(target_path, 'wb')
+        # Данные читаются и у папок: при сжатии deflate даже пустой элемент занимает пару байт
+        try:
+            written_crc, written_size = self._copy_member_data(f_dst, method, has_descriptor, compressed_size)
+        finally:
+            if f_dst is not None:
+                f_dst.close()
+
+        if has_descriptor:
+            descriptor = self._read_exact(4)
+            if descriptor == self.DATA_DESCRIPTOR_SIGNATURE:
+                descriptor = self._read_exact(4)
+            crc = struct.unpack('<I', descriptor)[0]
+            self._read_exact(16 if zip64 else 8) # Размеры уже известны из распаковки
+        if written_crc != crc:
+            raise ValueError(f"CRC элемента '{name}' не совпадает")
+        self.extracted[name] = (written_crc, written_size)
+
+    def _parse_zip64_sizes(self, extra, file_size, compressed_size):
+        position = 0
+        while position + 4 <= len(extra):
+            header_id, data_size = struct.unpack('<HH', extra[position:position + 4])
+            if header_id == 0x0001:
+                data = extra[position + 4:position + 4 + data_size]
+                offset = 0
+                if file_size == 0xFFFFFFFF:
+                    file_size = struct.unpack('<Q', data[offset:offset + 8])[0]
+                    offset += 8
+                if compressed_size == 0xFFFFFFFF:
+                    compressed_size = struct.unpack('<Q', data[offset:offset + 8])[0]
+                return file_size, compressed_size
+            position += 4 + data_size
+        raise ValueError("не найдено расширенное поле ZIP64")
+
+    def _copy_member_data(self, f_dst, method, has_descriptor, compressed_size):
+        """Распаковывает данные элемента в файл. Возвращает (CRC-32, размер) записанных данных."""
+        crc = 0
+        size = 0
+        decompressor = zlib.decompressobj(-15) if method == zipfile.ZIP_DEFLATED else None
+        remaining = None if has_descriptor else compressed_size
+
+        while remaining is None or remaining > 0:
+            if remaining is None:
+                data = self._read_some()
+            else:
+                data = self._read_exact(min(remaining, 256 * 1024))
+                remaining -= len(data)
+            if not data:
+                raise EOFError("Поток данных архива закончился внутри элемента.")
+            if decompressor is not None:
+                output = decompressor.decompress(data)
+                if decompressor.eof and decompressor.unused_data:
+                    # Лишние байты принадлежат дескриптору/следующему элементу - возвращаем их в буфер
+                    self._buffer[:0] = decompressor.unused_data
+            else:
+                output = data
+            if output:
+                crc = zlib.crc32(output, crc)
+                size += len(output)
+                if f_dst is not None:
+                    f_dst.write(output)
+            if decompressor is not None and decompressor.eof:
+                break
+        if decompressor is not None:
+            tail = decompressor.flush()
+            if tail:
+                crc = zlib.crc32(tail, crc)
+                size += len(tail)
+                if f_dst is not None:
+                    f_dst.write(tail)
+        return crc, size
+
+    # --- Завершение ---
+
+    def finalize(self, archive_path):
+        """Сверяет распакованное с центральным каталогом скачанного архива и поднимает корень содержимого
+           в dest_root. Возвращает True при успехе; при False dest_root нужно очистить и распаковать архив заново.
+        """
+        with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+            infos = zip_ref.infolist()
+            content_root = _find_content_root([info.filename for info in infos])
+            if content_root is None:
+                raise FileNotFoundError(f"Файл BackOffice.exe не найден в архиве '{os.path.basename(archive_path)}'.")
+            for info in infos:
+                if info.is_dir():
+                    continue
+                if self.extracted.get(info.filename) != (info.CRC, info.file_size):
+                    log_message(f"Потоковая распаковка: элемент '{info.filename}' отсутствует или отличается от центрального каталога.", level="WARNING")
+                    return False
+
+        if content_root:
+            self._lift_content_root(content_root)
+        log_message(f"Потоковая распаковка завершена и сверена с центральным каталогом ({len(self.extracted)} элементов).")
+        return True
+
+    def _lift_content_root(self, content_root):
+        """Переносит содержимое корня (папки с BackOffice.exe) в dest_root переименованием,
+           остальное, распакованное из архива, удаляет.
+        """
+        # Корень содержимого - в том виде, в каком его пути очищены при распаковке
+        content_path = _safe_member_path(self.dest_root, content_root)
+        if content_path is None:
+            return # После очистки пути корень содержимого совпадает с dest_root - переносить нечего
+        top_level = os.path.relpath(content_path, self.dest_root).split(os.sep, 1)[0]
+        # Элементы архива вне корня содержимого в дистрибутив не попадают - убираем их до переноса,
+        # чтобы они не конфликтовали по именам с содержимым корня
+        for name in self.created_top_level - {top_level}:
+            path = os.path.join(self.dest_root, name)
+            if not _is_path_inside(path, self.dest_root):
+                log_message(f"Внимание: Элемент '{path}' вне папки дистрибутива не удаляется.", level="WARNING")
+                continue
+            log_message("DEBUG: Удаление элемента вне корня содержимого: '%s'", path, level="DEBUG")
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.remove(path)
+
+        # Верхнюю папку убираем с дороги: внутри корня может быть элемент с тем же именем
+        top_path = os.path.join(self.dest_root, top_level)
+        if not _is_path_inside(top_path, self.dest_root):
+            raise ValueError(f"корень содержимого '{content_root}' вне папки дистрибутива")
+        staging_path = os.path.join(self.dest_root, f".stream_root_{os.getpid()}_{threading.get_ident()}")
+        os.rename(top_path, staging_path)
+        source_root = os.path.join(staging_path, os.path.relpath(content_path, top_path))
+        for name in os.listdir(source_root):
+            os.rename(os.path.join(source_root, name), os.path.join(self.dest_root, name))
+        shutil.rmtree(staging_path)
+
+
+# --- Предварительная проверка архива по центральному каталогу ZIP ---
+
+_PRECHECK_READ_BLOCK = 1024 * 1024 # Минимальный объем одного Range-запроса при чтении архива с HTTP
+
+
+class _ArchiveContentMismatch(Exception):
+    """BackOffice.exe в архиве источника от другого производителя или другой версии."""
+    pass
+
+
+class _HttpRangeFile(io.RawIOBase):
+    """Файловый объект только для чтения поверх HTTP Range-запросов.
+       Позволяет zipfile прочитать центральный каталог и отдельный файл архива, не скачивая архив целиком.
+       Файл архива читается последовательными запросами по _PRECHECK_READ_BLOCK байт.
+       Каждый промах читает не меньше _PRECHECK_READ_BLOCK байт; первое обращение к концу архива
+       забирает сразу последний блок, в котором обычно помещается весь центральный каталог.
+    """
+    def __init__(self, url, size, http_timeout, validators=None, cancel_event=None, deadline=None):
+        super().__init__()
+        self._cancel_event = cancel_event
+        self._deadline = deadline # time.monotonic(), после которого чтение прекращается (TimeoutError)
+        self._url = url
+        self._size = size
+        self._timeout = http_timeout
+        self._if_range = _http_if_range(validators or {})
+        self._position = 0
+        self._buffer_start = 0
+        self._buffer = b''
+        self.requests_made = 0 # Для журнала: сколько Range-запросов понадобилось
+        self.bytes_fetched = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self._size + offset
+        else:
+            raise ValueError(f"Неподдерживаемое значение whence: {whence}")
+        if position < 0:
+            raise ValueError("Отрицательная позиция в файле")
+        self._position = position
+        return position
+
+    def _fetch(self, start, end):
+        _check_cancelled(self._cancel_event)
+        if self._deadline is not None and time.monotonic() > self._deadline:
+            raise TimeoutError(f"чтение архива не уложилось в отведенное время ({self.requests_made} запросов, {self.bytes_fetched} байт)")
+        headers = {'Range': f'bytes={start}-{end - 1}'}
+        if self._if_range:
+            headers['If-Range'] = self._if_range
+        response = get_http_session().get(self._url, headers=headers, timeout=self._timeout)
+        response.raise_for_status()
+        if response.status_code != 206:
+            # Сервер отдал бы весь архив - для предварительной проверки это бессмысленно
+            raise _RangeNotSupported(f"сервер ответил {response.status_code} на запрос диапазона")
+        self.requests_made += 1
+        self.bytes_fetched += len(response.content)
+        return response.content
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._size - self._position
+        end = min(self._position + size, self._size)
+        if end <= self._position:
+            return b''
+        buffer_end = self._buffer_start + len(self._buffer)
+        if not (self._buffer_start <= self._position and end <= buffer_end):
+            if self._position >= self._size - _PRECHECK_READ_BLOCK:
+                fetch_start = max(0, self._size - _PRECHECK_READ_BLOCK)
+                fetch_end = self._size
+            else:
+                fetch_start = self._position
+                fetch_end = min(self._size, max(end, self._position + _PRECHECK_READ_BLOCK))
+            self._buffer = self._fetch(fetch_start, fetch_end)
+            self._buffer_start = fetch_start
+        data = self._buffer[self._position - self._buffer_start:end - self._buffer_start]
+        self._position += len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def _check_archive_version_info(archive_file, vendor, version_formatted, max_member_bytes):
+    """Находит BackOffice.exe по центральному каталогу архива, распаковывает его целиком во временный файл
+       (сжатый объем - до max_member_bytes) и читает из копии ресурс версии. Остальные файлы архива не читаются.
+       Возвращает сведения о версии или None, если проверка невозможна (нет ресурса, файл слишком большой).
+       При несовпадении производителя или версии вызывает _ArchiveContentMismatch.
+    """
+    with zipfile.ZipFile(archive_file) as zf:
+        names = zf.namelist()
+        content_root = _find_content_root(names)
+        if content_root is None:
+            raise _ArchiveContentMismatch("в архиве нет BackOffice.exe")
+        member_name = next(name for name in names if name.replace('\\', '/') == content_root + "BackOffice.exe")
+        member = zf.getinfo(member_name)
+        if member.compress_size > max_member_bytes:
+            log_message("DEBUG: BackOffice.exe в архиве занимает %s байт - больше лимита предварительной проверки.", member.compress_size, level="DEBUG")
+            return None
+        with zf.open(member) as src, tempfile.TemporaryFile() as exe_copy:
+            shutil.copyfileobj(src, exe_copy, 1024 * 1024)
+            exe_copy.flush()
+            info = _read_version_info_from_file(exe_copy)
+
+    company_name = info.get('CompanyName')
+    if company_name and vendor.lower() not in company_name.lower():
+        raise _ArchiveContentMismatch(f"производитель BackOffice.exe '{company_name}', ожидался '{vendor}'")
+    archive_versions = {format_version(info[key]) for key in ('FileVersion', 'ProductVersion') if info.get(key)}
+    if archive_versions and version_formatted not in archive_versions:
+        raise _ArchiveContentMismatch(f"версия BackOffice.exe {info.get('FileVersion') or info.get('ProductVersion')}, ожидалась {version_formatted}")
+    return info
+
+
+def _precheck_http_archive(config, app_type, version_formatted, vendor, max_member_bytes, cancel_event=None, reachable=None):
+    """Проверяет архив на HTTP источнике Range-запросами. Возвращает сведения о версии или None.
+       reachable (threading.Event) устанавливается, когда сервер ответил на первый запрос.
+    """
+    http_full_url = _get_http_archive_url(config, app_type, version_formatted)
+    if not http_full_url:
+        return None
+    http_timeout = get_config_value(config, 'Settings', 'HttpRequestTimeoutSec', default=15, type_cast=int)
+    download_url, total_size, accepts_ranges, validators = _http_probe_ranges(http_full_url, http_timeout)
+    if reachable is not None:
+        reachable.set()
+    if not accepts_ranges or total_size <= 0:
+        log_message("DEBUG: HTTP сервер не поддерживает Range для '%s' - предварительная проверка пропущена.", http_full_url, level="DEBUG")
+        return None
+    # Последовательные запросы по 1 МБ к большому BackOffice.exe на медленном канале ограничены и по времени
+    precheck_timeout = get_config_value(config, 'SourcePriority', 'ProbeTimeoutSec', default=5, type_cast=float)
+    range_file = _HttpRangeFile(download_url, total_size, http_timeout, validators, cancel_event, time.monotonic() + precheck_timeout)
+    info = _check_archive_version_info(range_file, vendor, version_formatted, max_member_bytes)
+    log_message("DEBUG: Предварительная проверка HTTP архива: %s запросов, %s из %s байт.", range_file.requests_made, range_file.bytes_fetched, total_size, level="DEBUG")
+    return info
+
+
+def _precheck_smb_archive(config, app_type, version_formatted, vendor, max_member_bytes, cancel_event=None, reachable=None):
+    """Проверяет архив на SMB ресурсе чтением центрального каталога и BackOffice.exe прямо с ресурса.
+       reachable (threading.Event) устанавливается, когда ресурс ответил (stat не завис).
+    """
+    smb_full_path = _get_smb_archive_path(config, app_type, version_formatted)
+    if not smb_full_path:
+        return None
+    archive_exists = os.path.exists(smb_full_path)
+    if reachable is not None:
+        reachable.set()
+    if not archive_exists:
+        return None
+    with open(smb_full_path, 'rb') as archive_file:
+        return _check_archive_version_info(archive_file, vendor, version_formatted, max_member_bytes)
+
+
+# Источники, архив на которых можно проверить без скачивания целиком
+SOURCE_PRECHECKS = {
+    'http': ('HttpSource', _precheck_http_archive),
+    'smb': ('SmbSource', _precheck_smb_archive),
+}
+
+
+def precheck_archive_sources(config, source_order, app_type, version_formatted, vendor, update_status, cancel_event=None):
+    """До скачивания проверяет производителя и версию BackOffice.exe в архивах источников.
+       Источники проверяются одновременно, результатов ждем не дольше SourcePriority.ProbeTimeoutSec;
+       незавершенные проверки прекращаются, а их источники остаются без проверки (медленный, но рабочий
+       источник не должен срывать запуск - доступность проверят сами скачивание или гонка источников).
+       Источники с чужим архивом исключаются из порядка скачивания; ошибки самой проверки источник не исключают.
+       Возвращает кортеж (оставшиеся источники, {источник: причина отказа}).
+    """
+    if not get_config_value(config, 'Settings', 'ArchivePrecheck', default=True, type_cast=bool):
+        return source_order, {}
+    max_member_bytes = get_config_value(config, 'Settings', 'ArchivePrecheckMaxMb', default=64, type_cast=int) * 1024 * 1024
+    probe_timeout = get_config_value(config, 'SourcePriority', 'ProbeTimeoutSec', default=5, type_cast=float)
+
+    checks = {}
+    results = queue.Queue()
+
+    def check_worker(source_type, precheck, check):
+        try:
+            info = precheck(config, app_type, version_formatted, vendor, max_member_bytes, check['cancel_event'], check['reachable'])
+            results.put((source_type, info, None))
+        except Exception as e:
+            results.put((source_type, None, e))
+
+    for source_type in source_order:
+        section, precheck = SOURCE_PRECHECKS.get(source_type, (None, None))
+        if precheck is None or not get_config_value(config, section, 'Enabled', default=False, type_cast=bool):
+            continue
+        checks[source_type] = {'cancel_event': threading.Event(), 'reachable': threading.Event()}
+        # Daemon-потоки: зависший stat() на мертвой SMB шаре не должен держать ни запуск, ни выход из приложения
+        threading.Thread(target=check_worker, args=(source_type, precheck, checks[source_type]), daemon=True).start()
+
+    outcomes = {}
+    deadline = time.monotonic() + probe_timeout
+    while len(outcomes) < len(checks) and not (cancel_event is not None and cancel_event.is_set()):
+        remaining_sec = deadline - time.monotonic()
+        if remaining_sec <= 0:
+            break
+        try:
+            source_type, info, error = results.get(timeout=min(remaining_sec, _CANCEL_CHECK_SEC))
+        except queue.Empty:
+            continue
+        outcomes[source_type] = (info, error)
+    for check in checks.values():
+        check['cancel_event'].set() # Незавершенные проверки HTTP прекращают чтение на следующем Range-запросе
+    _check_cancelled(cancel_event)
+
+    remaining = []
+    rejected = {}
+    for source_type in source_order:
+        if source_type not in checks:
+            remaining.append(source_type)
+            continue
+        if source_type not in outcomes:
+            if checks[source_type]['reachable'].is_set():
+                log_message("DEBUG: Предварительная проверка архива на '%s' не уложилась в %g сек - источник остается без проверки.",
+                            source_type, probe_timeout, level="DEBUG")
+            else:
+                log_message(f"Источник '{source_type}' не ответил за {probe_timeout:g} сек при проверке архива. "
+                            f"Проверка пропущена, архив проверится после распаковки.", level="WARNING")
+            remaining.append(source_type)
+            continue
+        info, error = outcomes[source_type]
+        if error is None:
+            if info:
+                log_message(f"Архив на источнике '{source_type}' прошел предварительную проверку: {info}")
+            remaining.append(source_type)
+        elif isinstance(error, _ArchiveContentMismatch):
+            rejected[source_type] = str(error)
+            log_message(f"Архив на источнике '{source_type}' не подходит: {error}. Источник пропускается.", level="WARNING")
+            update_status(f"Архив на {source_type.upper()} не подходит: {error}", level="WARNING")
+        else:
+            # Проверка - лишь оптимизация: при любой ошибке источник остается, архив проверится после распаковки
+            log_message("DEBUG: Предварительная проверка архива на '%s' не выполнена: %s", source_type, error, level="DEBUG")
+            remaining.append(source_type)
+    return remaining, rejected
+
+
+# --- Обновление по разнице: сборка версии из ближайшей локальной и измененных файлов ---
+
+class _FileManifestError(Exception):
+    """Манифест файлов версии отсутствует, не читается или имеет неверный формат."""
+    pass
+
+
+def _delta_archive_layout(config, section, app_type, version_formatted):
+    """Расположение манифеста файлов версии и папки с ее файлами относительно папки архива на источнике.
+       Возвращает (имя манифеста, префикс папки файлов) или None, если FileManifest в секции не задан.
+    """
+    manifest_template = get_config_value(config, section, 'FileManifest', default='', type_cast=str).strip()
+    archive_name = _get_archive_name(config, section, app_type, version_formatted)
+    if not manifest_template or not archive_name:
+        return None
+    # {name} - имя архива без расширения: RMSOffice887.zip -> RMSOffice887
+    name = os.path.splitext(archive_name.replace('\\', '/').rsplit('/', 1)[-1])[0]
+    return manifest_template.replace('{name}', name), f"{name}/"
+
+
+def _parse_file_manifest(text):
+    """Разбирает манифест файлов версии: JSON {"files": [{"path", "size", "sha256"}, ...]},
+       пути - относительно папки с BackOffice.exe. Возвращает список словарей с относительным путем (через '/'), размером и SHA-256 в нижнем регистре.
+    """
+    try:
+        data = json.loads(text)
+        files = []
+        for item in data['files']:
+            path = str(item['path']).replace('\\', '/').strip('/')
+            size = int(item['size'])
+            sha256 = str(item['sha256']).lower()
+            if not path or size < 0 or not re.fullmatch(r'[0-9a-f]{64}', sha256):
+                raise ValueError(f"неверная запись {item!r}")
+            files.append({'path': path, 'size': size, 'sha256': sha256})
+    except (ValueError, KeyError, TypeError) as e:
+        raise _FileManifestError(f"неверный формат манифеста файлов: {e}")
+    if not any(entry['path'] == "BackOffice.exe" for entry in files):
+        raise _FileManifestError("в корне манифеста файлов нет BackOffice.exe")
+    return files
+
+
+class _HttpFileFetcher:
+    """Чтение манифеста и отдельных файлов версии с HTTP источника (пути - относительно папки архива)."""
+    def __init__(self, config, app_type, version_formatted, cancel_event=None):
+        archive_url = _get_http_archive_url(config, app_type, version_formatted)
+        if archive_url is None:
+            raise _FileManifestError("HTTP источник не настроен")
+        self._base_url = archive_url.rsplit('/', 1)[0] + '/'
+        self._timeout = get_config_value(config, 'Settings', 'HttpRequestTimeoutSec', default=15, type_cast=int)
+        self._cancel_event = cancel_event
+
+    def _url(self, relative_path):
+        return urllib.parse.urljoin(self._base_url, urllib.parse.quote(relative_path))
+
+    def read_text(self, relative_path):
+        response = get_http_session().get(self._url(relative_path), timeout=self._timeout)
+        response.raise_for_status()
+        return response.content.decode('utf-8-sig')
+
+    def fetch(self, relative_path, f_dst, on_chunk):
+        with get_http_session().get(self._url(relative_path), stream=True, timeout=self._timeout) as response, \
+                _close_on_cancel(self._cancel_event, lambda: _shutdown_http_response(response)):
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                _check_cancelled(self._cancel_event)
+                if chunk:
+                    f_dst.write(chunk)
+                    on_chunk(chunk)
+
+    def close(self):
+        pass
+
+
+class _FtpFileFetcher:
+    """Чтение манифеста и отдельных файлов версии с FTP источника по одному соединению управления."""
+    def __init__(self, config, app_type, version_formatted, cancel_event=None):
+        location = _get_ftp_archive_location(config, app_type, version_formatted)
+        if location is None:
+            raise _FileManifestError("FTP источник не настроен")
+        self._cancel_event = cancel_event
+        self._ftp = _ftp_connect(location) # Текущий каталог - папка архива
+
+    def _retrieve(self, relative_path, on_data):
+        self._ftp.voidcmd('TYPE I')
+        with self._ftp.transfercmd(f'RETR {relative_path}') as conn, \
+                _close_on_cancel(self._cancel_event, lambda: _shutdown_socket(conn)):
+            while data := conn.recv(64 * 1024):
+                _check_cancelled(self._cancel_event)
+                on_data(data)
+        self._ftp.voidresp()
+
+    def read_text(self, relative_path):
+        buffer = io.BytesIO()
+        self._retrieve(relative_path, buffer.write)
+        return buffer.getvalue().decode('utf-8-sig')
+
+    def fetch(self, relative_path, f_dst, on_chunk):
+        def write(chunk):
+            f_dst.write(chunk)
+            on_chunk(chunk)
+        self._retrieve(relative_path, write)
+
+    def close(self):
+        _ftp_close(self._ftp, graceful=not (self._cancel_event is not None and self._cancel_event.is_set()))
+
+
+class _SmbFileFetcher:
+    """Чтение манифеста и отдельных файлов версии с SMB ресурса (копированием)."""
+    def __init__(self, config, app_type, version_formatted, cancel_event=None):
+        archive_path = _get_smb_archive_path(config, app_type, version_formatted)
+        if archive_path is None:
+            raise _FileManifestError("SMB источник не настроен")
+        self._base_dir = os.path.dirname(archive_path)
+        self._cancel_event = cancel_event
+
+    def _path(self, relative_path):
+        return os.path.join(self._base_dir, *relative_path.split('/'))
+
+    def read_text(self, relative_path):
+        with open(self._path(relative_path), 'r', encoding='utf-8-sig') as f:
+            return f.read()
+
+    def fetch(self, relative_path, f_dst, on_chunk):
+        with open(self._path(relative_path), 'rb') as f_src:
+            while True:
+                _check_cancelled(self._cancel_event)
+                chunk = f_src.read(1024 * 1024)
+                if not chunk:
+                    break
+                f_dst.write(chunk)
+                on_chunk(chunk)
+
+    def close(self):
+        pass
+
+
+# Чтение файлов версии по коротким именам источников: (секция конфига, класс)
+SOURCE_FILE_FETCHERS = {
+    'http': ('HttpSource', _HttpFileFetcher),
+    'ftp': ('FtpSource', _FtpFileFetcher),
+    'smb': ('SmbSource', _SmbFileFetcher),
+}
+
+
+def _version_distance(version_a, version_b):
+    """Расстояние между форматированными версиями ("886" и "887" -> 1) или None, если версии не числовые."""
+    if not (version_a.isdigit() and version_b.isdigit()):
+        return None
+    return abs(int(version_a) - int(version_b))
+
+
+def _find_delta_base(installer_root, app_type, version_formatted, vendor, exclude):
+    """Ближайшая по номеру готовая локальная версия того же типа и производителя (имя папки) или None.
+       При равном расстоянии предпочитается более старая версия - обычный случай обновления.
+    """
+    best = None
+    for name, entry in load_cache_index(installer_root)['entries'].items():
+        if name == exclude or entry.get('state') != 'ready' or entry.get('app_type') != app_type:
+            continue
+        if str(entry.get('vendor', '')).lower() != vendor.lower():
+            continue
+        distance = _version_distance(str(entry.get('version', '')), version_formatted)
+        if distance is None or not os.path.isfile(os.path.join(installer_root, name, "BackOffice.exe")):
+            continue
+        key = (distance, int(entry['version']) > int(version_formatted)) # Обе версии числовые - проверено выше
+        if best is None or key < best[0]:
+            best = (key, name)
+    return best[1] if best else None
+
+
+def _plan_delta(manifest_files, base_path, store_root=None):
+    """Сопоставляет файлы новой версии с файлами локальной версии base_path.
+       Файл переиспользуется, если в локальной версии есть файл того же размера и SHA-256
+       (сначала по тому же пути, затем по любому пути). Хэшируются только файлы подходящего размера.
+       Если задан store_root (InstallerRoot с хранилищем .objects), файл берется и из объектов других версий.
+       Возвращает (список (запись манифеста, локальный путь или None), байт переиспользуется, байт скачивается).
+    """
+    base_sizes = {}
+    for dirpath, dirnames, filenames in os.walk(base_path):
+        for filename in filenames:
+            full_path = os.path.join(dirpath, filename)
+            try:
+                base_sizes[full_path] = os.path.getsize(full_path)
+            except OSError:
+                continue
+    paths_by_size = {}
+    for full_path, size in base_sizes.items():
+        paths_by_size.setdefault(size, []).append(full_path)
+
+    hashes = {}
+
+    def file_sha256(full_path):
+        if full_path not in hashes:
+            hasher = hashlib.sha256()
+            try:
+                _hash_file_prefix(hasher, full_path, base_sizes[full_path])
+                hashes[full_path] = hasher.hexdigest()
+            except (OSError, EOFError):
+                hashes[full_path] = None
+        return hashes[full_path]
+
+    plan = []
+    reuse_bytes = 0
+    fetch_bytes = 0
+    for entry in manifest_files:
+        same_path = os.path.join(base_path, *entry['path'].split('/'))
+        candidates = paths_by_size.get(entry['size'], [])
+        ordered = ([same_path] if same_path in candidates else []) + [p for p in candidates if p != same_path]
+        match = next((p for p in ordered if file_sha256(p) == entry['sha256']), None)
+        if match is None and store_root is not None:
+            match = find_store_object(store_root, entry['sha256'], entry['size'])
+        plan.append((entry, match))
+        if match is not None:
+            reuse_bytes += entry['size']
+        else:
+            fetch_bytes += entry['size']
+    return plan, reuse_bytes, fetch_bytes
+
+
+def _apply_delta_plan(plan, dest_root, fetcher, files_prefix, update_progress_callback, base_progress, progress_range, cancel_event=None, store_root=None, throttle=None):
+    """Собирает версию в dest_root: совпадающие файлы копирует из локальной версии, остальные скачивает
+       по одному через fetcher и сверяет размер и SHA-256 с манифестом.
+       Если задан store_root, совпадающие файлы не копируются, а связываются с хранилищем (жесткие ссылки),
+       скачанные файлы добавляются в хранилище. throttle (_TransferThrottle) ограничивает скорость скачивания.
+    """
+    total_bytes = sum(entry['size'] for entry, _ in plan) or 1
+    fetch_total = sum(entry['size'] for entry, match in plan if match is None)
+    state = {'done': 0, 'fetched': 0}
+
+    def report():
+        update_progress_callback(base_progress + state['done'] / total_bytes * progress_range,
+                                 transfer=(state['fetched'], fetch_total) if fetch_total else None)
+
+    # Сначала локальные копии (быстро), затем скачивание - прогресс скорости считается только по сети
+    for entry, match in sorted(plan, key=lambda item: item[1] is None):
+        _check_cancelled(cancel_event)
+        target_path = _safe_member_path(dest_root, entry['path'])
+        if target_path is None:
+            raise _FileManifestError(f"недопустимый путь в манифесте: '{entry['path']}'")
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        if match is not None:
+            if store_root is not None:
+                _link_or_clone(match, target_path)
+                _store_file_quietly(store_root, target_path, entry['sha256'])
+            else:
+                shutil.copyfile(match, target_path)
+            state['done'] += entry['size']
+            report()
+            continue
+
+        hasher = hashlib.sha256()
+        received = {'size': 0}
+
+        def on_chunk(chunk):
+            hasher.update(chunk)
+            received['size'] += len(chunk)
+            state['done'] += len(chunk)
+            state['fetched'] += len(chunk)
+            report()
+            if throttle is not None:
+                throttle(len(chunk))
+
+        partial_path = target_path + '.part'
+        try:
+            with open(partial_path, 'wb') as f_dst:
+                fetcher.fetch(files_prefix + entry['path'], f_dst, on_chunk)
+            if received['size'] != entry['size'] or hasher.hexdigest() != entry['sha256']:
+                raise _ChecksumMismatch(f"файл '{entry['path']}' не совпадает с манифестом "
+                                        f"({received['size']} байт, SHA-256 {hasher.hexdigest()})")
+            os.replace(partial_path, target_path)
+        finally:
+            _remove_file_quietly(partial_path)
+        if store_root is not None:
+            _store_file_quietly(store_root, target_path, entry['sha256'])
+
+
+def build_installer_from_delta(config, installer_root, app_type, version_formatted, vendor, dest_root, source_order,
+                               update_status, update_progress_callback, base_progress, progress_range, cancel_event=None, background=False):
+    """Собирает дистрибутив в dest_root из ближайшей локальной версии и измененных файлов, если на источнике
+       рядом с архивом опубликован манифест файлов версии (FileManifest) и его файлы в папке с именем архива.
+       Возвращает сведения о сборке ({'source', 'base', 'files', 'reused_bytes', 'fetched_bytes'}) или None,
+       если обновление по разнице невозможно или невыгодно - тогда скачивается архив целиком.
+       background - фоновая передача (предзагрузка): действуют лимиты скорости RateLimitKBps.
+    """
+    base_name = _find_delta_base(installer_root, app_type, version_formatted, vendor, exclude=os.path.basename(dest_root))
+    if base_name is None:
+        log_message("DEBUG: Нет локальной версии %s для обновления по разнице.", app_type, level="DEBUG")
+        return None
+    base_path = os.path.join(installer_root, base_name)
+    store_root = installer_root if get_config_value(config, 'Cache', 'Deduplicate', default=True, type_cast=bool) else None
+    max_fetch_percent = get_config_value(config, 'Settings', 'DeltaMaxChangedPercent', default=50, type_cast=float)
+
+    plans = {} # План зависит только от манифеста: одинаковые манифесты разных источников не сверяются повторно
+    for source_type in source_order:
+        _check_cancelled(cancel_event)
+        section, fetcher_class = SOURCE_FILE_FETCHERS.get(source_type, (None, None))
+        if fetcher_class is None or not get_config_value(config, section, 'Enabled', default=False, type_cast=bool):
+            continue
+        layout = _delta_archive_layout(config, section, app_type, version_formatted)
+        if layout is None:
+            continue
+        manifest_name, files_prefix = layout
+
+        fetcher = None
+        try:
+            fetcher = fetcher_class(config, app_type, version_formatted, cancel_event)
+            manifest_text = fetcher.read_text(manifest_name)
+            if manifest_text not in plans:
+                update_status(f"Сравнение с локальной версией {base_name}...")
+                manifest_files = _parse_file_manifest(manifest_text)
+                plans[manifest_text] = _plan_delta(manifest_files, base_path, store_root)
+            plan, reuse_bytes, fetch_bytes = plans[manifest_text]
+
+            total_bytes = reuse_bytes + fetch_bytes
+            if total_bytes and fetch_bytes * 100 > total_bytes * max_fetch_percent:
+                log_message(f"Обновление по разнице невыгодно: изменено {fetch_bytes} из {total_bytes} байт "
+                            f"(больше DeltaMaxChangedPercent = {max_fetch_percent:g}%). Будет скачан архив целиком.")
+                return None
+
+            changed_count = sum(1 for _, match in plan if match is None)
+            log_message(f"Обновление по разнице с '{source_type}' от '{base_name}': {changed_count} из {len(plan)} файлов "
+                        f"({fetch_bytes} байт) скачивается, {reuse_bytes} байт берется из локальных версий.")
+            update_status(f"Обновление от {base_name}: скачивание {changed_count} измененных файлов "
+                          f"({fetch_bytes / (1024 * 1024):.1f} МБ) с {source_type.upper()}...")
+            _apply_delta_plan(plan, dest_root, fetcher, files_prefix, update_progress_callback, base_progress, progress_range, cancel_event, store_root,
+                              _transfer_throttle(config, section, background, cancel_event))
+            update_progress_callback(base_progress + progress_range)
+            return {'source': source_type, 'base': base_name, 'files': len(plan), 'reused_bytes': reuse_bytes, 'fetched_bytes': fetch_bytes}
+        except OperationCancelled:
+            raise
+        except Exception as e:
+            # Манифеста нет или файл не скачался - пробуем следующий источник, в крайнем случае архив целиком
+            log_message("Обновление по разнице с '%s' не выполнено: %s", source_type, e, level="WARNING" if plans else "DEBUG")
+            shutil.rmtree(dest_root, ignore_errors=True)
+            os.makedirs(dest_root, exist_ok=True)
+        finally:
+            if fetcher is not None:
+                fetcher.close()
+    return None
+
+
+# --- Основная функция поиска/скачивания ---
+
+# Блокировки подготовки дистрибутивов: одну версию не готовят одновременно несколько потоков
+_installer_locks = {}
+_installer_locks_guard = threading.Lock()
+
+
+def _get_installer_lock(config, app_type, version_formatted):
+    """Возвращает блокировку подготовки дистрибутива заданного типа и версии."""
+    installer_root = get_config_value(config, 'Settings', 'InstallerRoot', default='D:\\Backs')
+    key = (os.path.normcase(os.path.abspath(installer_root)), app_type, version_formatted)
+    with _installer_locks_guard:
+        return _installer_locks.setdefault(key, threading.Lock())
+
+
+def find_or_download_installer(config, app_type, version_formatted, vendor, update_status, update_progress_callback, trace=None, cancel_event=None, background=False):
     """
     Находит дистрибутив локально или скачивает/распаковывает его с настроенных источников
-    в порядке приоритета.
+    в порядке приоритета. Параллельные запросы одной версии выполняются по очереди:
+    второй дождется подготовки дистрибутива первым и найдет его локально.
+    trace - трасса запуска (LaunchTrace) для интервалов ожидания, скачивания и распаковки.
+    cancel_event - флаг отмены: скачивание и распаковка прерываются, частичные файлы удаляются,
+    выбрасывается OperationCancelled.
+    background - фоновая подготовка (предзагрузка): скачивание ограничено лимитами скорости RateLimitKBps
+    и уступает канал скачиванию для запусков.
     """
-    log_message(f"DEBUG: Начат поиск или скачивание дистрибутива для типа '{app_type}' версии '{version_formatted}' (производитель '{vendor}')")
+    installer_lock = _get_installer_lock(config, app_type, version_formatted)
+    if not installer_lock.acquire(blocking=False):
+        update_status(f"Ожидание подготовки дистрибутива {app_type} {version_formatted} другим запуском...")
+        with _trace_span(trace, 'installer_lock_wait'):
+            while not installer_lock.acquire(timeout=_CANCEL_CHECK_SEC):
+                _check_cancelled(cancel_event)
+    try:
+        return _find_or_download_installer(config, app_type, version_formatted, vendor, update_status, update_progress_callback, trace, cancel_event, background)
+    finally:
+        installer_lock.release()
+
+
+def _find_or_download_installer(config, app_type, version_formatted, vendor, update_status, update_progress_callback, trace=None, cancel_event=None, background=False):
+    """Поиск или скачивание дистрибутива (вызывается под блокировкой дистрибутива)."""
+    log_message(f"DEBUG: Начат поиск или скачивание дистрибутива для типа '{app_type}' версии '{version_formatted}' (производитель '{vendor}')", level="DEBUG")
 
     installer_root = get_config_value(config, 'Settings', 'InstallerRoot', default='D:\\Backs')
     # Определяем ожидаемое имя локальной папки
@@ -708,14 +3716,34 @@ def find_or_download_installer(config, app_type, version_formatted, vendor, upda
     update_status(f"Проверка локального дистрибутива: {expected_local_dir_name}...")
 
     # 1. Проверяем локально
-    if os.path.exists(backoffice_exe_direct_path):
+    cache_entry = get_cache_entry(installer_root, expected_local_dir_name)
+    if os.path.exists(backoffice_exe_direct_path) and cache_entry and cache_entry.get('state') == 'installing':
+        # Предыдущая распаковка оборвалась: BackOffice.exe есть, но остальные файлы могут отсутствовать
+        log_message(f"Локальный дистрибутив '{local_installer_path}' не был подготовлен до конца. Он будет скачан заново.", level="WARNING")
+    elif os.path.exists(backoffice_exe_direct_path):
         log_message(f"Найден локальный дистрибутив: {local_installer_path}")
-        company_name = get_file_company_name(backoffice_exe_direct_path) # Проверяем производителя
-        # Если get_file_company_name вернул None (ctypes не работает или нет данных),
+        if cache_entry and cache_entry.get('vendor', '').lower() == vendor.lower():
+            # Производитель уже проверялся при установке - повторно читать метаданные EXE не нужно
+            company_name = cache_entry['vendor']
+            log_message(f"DEBUG: Производитель взят из индекса кэша: '{company_name}'.", level="DEBUG")
+        else:
+            company_name = get_file_company_name(backoffice_exe_direct_path) # Проверяем производителя
+        # Если get_file_company_name вернул None (нет ресурса версии или файл не читается),
         # мы доверяем имени папки и считаем производителя совпадающим.
         if company_name is None or vendor.lower() in company_name.lower():
             update_status("Локальный дистрибутив найден и производитель совпадает (или не определен).")
             log_message("Производитель совпадает (или не определен). Используем локальный дистрибутив.")
+            if cache_entry and cache_entry.get('checksum_verified'):
+                log_message(f"DEBUG: Архив версии был сверен с контрольной суммой при установке (SHA-256 {cache_entry.get('archive_sha256')}). Повторная проверка не требуется.", level="DEBUG")
+            entry_fields = {'state': 'ready', 'vendor': vendor, 'last_launch': time.time()}
+            if cache_entry is None:
+                # Дистрибутив появился до индекса кэша - досчитываем его параметры один раз
+                entry_fields.update({'app_type': app_type, 'version': version_formatted, 'size_bytes': _get_dir_size(local_installer_path),
+                                     'source': 'local', 'archive_sha256': None, 'checksum_verified': False,
+                                     'installed_at': os.path.getmtime(local_installer_path)})
+            update_cache_entry(installer_root, expected_local_dir_name, **entry_fields)
+            if trace is not None:
+                trace.annotate(installer_source='local')
             # Прогресс 100%, т.к. ничего скачивать не нужно
             update_progress_callback(100)
             return local_installer_path
@@ -727,6 +3755,7 @@ def find_or_download_installer(config, app_type, version_formatted, vendor, upda
             if os.path.exists(local_installer_path):
                  log_message(f"Удаление локальной папки с несовпадающим производителем: '{local_installer_path}'")
                  shutil.rmtree(local_installer_path, ignore_errors=True)
+            remove_cache_entry(installer_root, expected_local_dir_name)
 
 
     # 2. Если локальная проверка не удалась, начинаем процесс скачивания/распаковки/проверки
@@ -735,8 +3764,8 @@ def find_or_download_installer(config, app_type, version_formatted, vendor, upda
 
     # Инициализируем пути временных файлов/папок перед try блоком для доступа в except
     temp_archive_path = os.path.join(tempfile.gettempdir(), f"{expected_local_dir_name}.zip")
-    temp_archive_path_exists = False # Флаг, был ли временный файл создан (хотя бы частично)
-    temp_extract_path = os.path.join(local_installer_path, "temp_extract_folder")
+    temp_archive_path_exists = False # Флаг, был ли временный архив скачан полностью
+    stream_extractor = None # Потоковый распаковщик (если распаковка идет параллельно со скачиванием)
 
 
     # --- ГЛАВНЫЙ TRY БЛОК для скачивания, распаковки и подготовки ---
@@ -750,6 +3779,9 @@ def find_or_download_installer(config, app_type, version_formatted, vendor, upda
         os.makedirs(installer_root, exist_ok=True)
         os.makedirs(local_installer_path, exist_ok=True)
         log_message(f"DEBUG: Создана локальная папка дистрибутива: '{local_installer_path}'.", level="DEBUG")
+        # Пока установка не завершена, папка помечена в индексе как незаконченная
+        update_cache_entry(installer_root, expected_local_dir_name, state='installing', app_type=app_type, version=version_formatted, vendor=vendor,
+                           installer_pid=os.getpid())
 
         # --- ДОБАВЛЕНО: Создаем родительскую директорию для временного архива ---
         # Это решает проблему FileNotFoundError, если путь к временному файлу включает несуществующие подпапки
@@ -760,20 +3792,10 @@ def find_or_download_installer(config, app_type, version_formatted, vendor, upda
         # --- КОНЕЦ ДОБАВЛЕНОГО БЛОКА ---
 
 
-        # 2.1. Скачиваем с удаленных источников по приоритету
+        # Порядок источников из SourcePriority.Order
         source_order_str = get_config_value(config, 'SourcePriority', 'Order', default='smb, http, ftp', type_cast=str)
         source_order = [s.strip().lower() for s in source_order_str.split(',') if s.strip()]
 
-        download_success = False
-        # Очищаем временный файл, если он вдруг остался от предыдущих попыток
-        if os.path.exists(temp_archive_path):
-             try:
-                 os.remove(temp_archive_path)
-                 log_message(f"DEBUG: Удален старый временный архив '{temp_archive_path}'.", level="DEBUG")
-             except Exception as e:
-                 log_message(f"Внимание: Не удалось удалить старый временный архив '{temp_archive_path}': {e}", level="WARNING")
-
-
         # Прогресс: 55% - 85% на скачивание и распаковку (30%)
         # Распределим 15% на скачивание и 15% на распаковку
         download_progress_base = 55
@@ -781,141 +3803,133 @@ def find_or_download_installer(config, app_type, version_formatted, vendor, upda
         extract_progress_base = 70
         extract_progress_range = 15
 
-
-        for source_type in source_order:
-            log_message(f"DEBUG: Попытка скачивания с источника '{source_type}'...", level="DEBUG")
-            if source_type == 'smb':
-                update_status(f"Попытка скачивания с SMB...")
-                if _download_from_smb(config, app_type, version_formatted, expected_local_dir_name, temp_archive_path, update_status, update_progress_callback, download_progress_base, download_progress_range):
-                     download_success = True
-                     temp_archive_path_exists = True # Файл создан (полностью или частично)
-                     break # Скачивание успешно, переходим к распаковке
-            elif source_type == 'http':
-                update_status(f"Попытка скачивания с HTTP...")
-                if _download_from_http(config, app_type, version_formatted, expected_local_dir_name, temp_archive_path, update_status, update_progress_callback, download_progress_base, download_progress_range):
-                     download_success = True
-                     temp_archive_path_exists = True # Файл создан (полностью или частично)
-                     break # Скачивание успешно, переходим к распаковке
-            elif source_type == 'ftp':
-                update_status(f"Попытка скачивания с FTP...")
-                if _download_from_ftp(config, app_type, version_formatted, expected_local_dir_name, temp_archive_path, update_status, update_progress_callback, download_progress_base, download_progress_range):
-                     download_success = True
-                     temp_archive_path_exists = True # Файл создан (полностью или частично)
-                     break # Скачивание успешно, переходим к распаковке
+        # 2.0. Обновление по разнице: файлы, совпадающие с ближайшей локальной версией, копируются,
+        # с источника скачиваются только измененные (если рядом с архивом опубликован манифест файлов версии)
+        with _trace_span(trace, 'delta_update') as delta_span:
+            delta_result = build_installer_from_delta(config, installer_root, app_type, version_formatted, vendor, local_installer_path, source_order,
+                                                      update_status, update_progress_callback, download_progress_base,
+                                                      download_progress_range + extract_progress_range, cancel_event, background)
+            if delta_result:
+                delta_span.update(delta_result)
             else:
-                log_message(f"Внимание: Неизвестный источник в приоритете: '{source_type}'. Пропускаем.", level="WARNING")
-                update_status(f"Неизвестный источник: '{source_type}'.", level="WARNING")
-
-            log_message(f"DEBUG: Скачивание с источника '{source_type}' не удалось.", level="DEBUG")
+                delta_span['outcome'] = 'skipped'
 
+        if delta_result:
+            used_source = f"delta:{delta_result['source']}"
+            archive_result = {'sha256': None, 'verified': True} # Каждый файл сверен с SHA-256 из манифеста
+            update_status(f"Дистрибутив собран из {delta_result['base']} и измененных файлов.")
+        else:
+            # 2.1. Скачиваем с удаленных источников по приоритету
+            download_success = False
+            # Очищаем временный файл, если он вдруг остался от предыдущих попыток.
+            # Частично скачанные архивы (*.part) не трогаем - их докачивают функции скачивания.
+            if os.path.exists(temp_archive_path):
+                 try:
+                     os.remove(temp_archive_path)
+                     log_message(f"DEBUG: Удален старый временный архив '{temp_archive_path}'.", level="DEBUG")
+                 except Exception as e:
+                     log_message(f"Внимание: Не удалось удалить старый временный архив '{temp_archive_path}': {e}", level="WARNING")
 
-        if not download_success:
-            # Если цикл завершился без успешного скачивания
-            raise RuntimeError("Не удалось скачать дистрибутив ни с одного доступного источника.")
 
 
-        # 2.2. Распаковываем скачанный архив
-        update_status(f"Распаковка архива '{os.path.basename(temp_archive_path)}'...")
-        log_message(f"Распаковка архива '{temp_archive_path}' во временную папку '{temp_extract_path}'.")
 
-        # Создаем временную папку для распаковки
-        os.makedirs(temp_extract_path, exist_ok=True)
+            # Архивы с чужим BackOffice.exe отсеиваются до скачивания - по центральному каталогу ZIP
+            with _trace_span(trace, 'archive_precheck'):
+                source_order, rejected_sources = precheck_archive_sources(config, source_order, app_type, version_formatted, vendor, update_status, cancel_event)
+            if rejected_sources and not source_order:
+                reasons = "; ".join(f"{source}: {reason}" for source, reason in rejected_sources.items())
+                raise ValueError(f"Архив дистрибутива не подходит ни на одном источнике ({reasons}).")
 
-        try:
-            with zipfile.ZipFile(temp_archive_path, 'r') as zip_ref:
-                file_list = zip_ref.namelist()
-                total_files = len(file_list)
-                extracted_count = 0
-
-                if total_files == 0:
-                     log_message("DEBUG: Архив пуст. Распаковка не требуется.", level="WARNING")
-
-                for file_info in file_list:
-                    # Распаковываем каждый файл во временную папку
-                    zip_ref.extract(file_info, temp_extract_path)
-                    extracted_count += 1
-                    # Обновление прогресса
-                    if total_files > 0: # Избегаем деления на ноль
-                        # Прогресс внутри распаковки: (extracted_count / total_files) * range
-                        progress_value = extract_progress_base + (extracted_count / total_files) * extract_progress_range
-                        update_progress_callback(progress_value)
-                    # update_status(f"Распаковка файла {extracted_count}/{total_files}...") # Слишком частые обновления
-
-            log_message("Распаковка завершена.")
-            update_status("Архив успешно распакован во временную папку.")
+            # Режим выбора источника: sequential - по очереди в порядке Order, race - гонка источников
+            source_mode = get_config_value(config, 'SourcePriority', 'Mode', default='sequential', type_cast=str).strip().lower()
+            with _trace_span(trace, 'download', mode=source_mode) as download_span:
+                if source_mode == 'race':
+                    log_message("Режим гонки источников: все включенные источники проверяются одновременно.")
+                    used_source, archive_result = _download_archive_race(config, source_order, app_type, version_formatted, expected_local_dir_name, temp_archive_path, update_status, update_progress_callback, download_progress_base, download_progress_range, cancel_event, background)
+                else:
+                    if get_config_value(config, 'Settings', 'StreamingExtraction', default=True, type_cast=bool):
+                        # Распаковка параллельно со скачиванием по HTTP, прямо в папку дистрибутива
+                        stream_extractor = _StreamingZipExtractor(local_installer_path)
+                    used_source, archive_result = _download_archive_sequential(config, source_order, app_type, version_formatted, expected_local_dir_name, temp_archive_path, update_status, update_progress_callback, download_progress_base, download_progress_range, stream_extractor, cancel_event, background)
+
+                if used_source:
+                    download_success = True
+                    temp_archive_path_exists = True # Архив полностью скачан
+                    log_message(f"Архив получен с источника '{used_source}'.")
+                    download_span.update(source=used_source, archive_bytes=os.path.getsize(temp_archive_path),
+                                         checksum_verified=archive_result['verified'])
+                else:
+                    download_span['outcome'] = 'no_source'
+
+
+            if not download_success:
+                # Если цикл завершился без успешного скачивания
+                if rejected_sources:
+                    reasons = "; ".join(f"{source}: {reason}" for source, reason in rejected_sources.items())
+                    raise RuntimeError(f"Не удалось скачать дистрибутив ни с одного доступного источника (отклонены при проверке архива: {reasons}).")
+                raise RuntimeError("Не удалось скачать дистрибутив ни с одного доступного источника.")
+
+
+            # 2.2. Распаковываем скачанный архив сразу в папку дистрибутива
+            with _trace_span(trace, 'extract') as extract_span:
+                stream_extracted = False
+                if stream_extractor is not None and stream_extractor.started:
+                    if stream_extractor.wait():
+                        update_status("Проверка архива, распакованного во время скачивания...")
+                        try:
+                            stream_extracted = stream_extractor.finalize(temp_archive_path)
+                        except zipfile.BadZipFile:
+                            raise zipfile.BadZipFile(f"Архив '{os.path.basename(temp_archive_path)}' поврежден или не является ZIP-файлом.")
+                    if not stream_extracted:
+                        # Потоковая распаковка не удалась - очищаем папку и распаковываем скачанный архив заново
+                        log_message("Потоковая распаковка не завершена. Архив будет распакован после скачивания.", level="WARNING")
+                        shutil.rmtree(local_installer_path, ignore_errors=True)
+                        os.makedirs(local_installer_path, exist_ok=True)
+
+                if stream_extracted:
+                    update_status("Архив распакован во время скачивания.")
+                    extract_span['mode'] = 'stream'
+                else:
+                    update_status(f"Распаковка архива '{os.path.basename(temp_archive_path)}'...")
+                    log_message(f"Распаковка архива '{temp_archive_path}' в '{local_installer_path}'.")
+                    _extract_archive_direct(temp_archive_path, local_installer_path, update_progress_callback, extract_progress_base, extract_progress_range,
+                                            workers=_get_extract_workers(config), cancel_event=cancel_event)
+                    # Любые другие ошибки при распаковке будут пойманы внешним except Exception
+                    log_message("Распаковка завершена.")
+                    update_status("Архив успешно распакован.")
+                    extract_span['mode'] = 'direct'
             update_progress_callback(extract_progress_base + extract_progress_range) # Убедимся, что прогресс достигает конца этапа распаковки
 
 
-        except zipfile.BadZipFile:
-            # Специфическая ошибка парсинга ZIP - перебрасываем с более понятным сообщением
-            raise zipfile.BadZipFile(f"Архив '{os.path.basename(temp_archive_path)}' поврежден или не является ZIP-файлом.")
-        # Любые другие ошибки при распаковке будут пойманы внешним except Exception
-
-
-        # 2.3. Проверка и перемещение распакованного дистрибутива
-        update_status("Проверка и перемещение распакованного дистрибутива...")
-        log_message(f"Поиск BackOffice.exe во временной папке распаковки: '{temp_extract_path}'")
-
-        found_backoffice_exe = None
-        actual_content_root = None # Папка внутри temp_extract_path, которая является корнем дистрибутива
-
-        # Ищем BackOffice.exe рекурсивно внутри временной папки распаковки
-        for dirpath, dirnames, filenames in os.walk(temp_extract_path):
-             if "BackOffice.exe" in filenames:
-                 found_backoffice_exe = os.path.join(dirpath, "BackOffice.exe")
-                 actual_content_root = dirpath # Папка, в которой найден BackOffice.exe
-                 log_message(f"BackOffice.exe найден по пути: '{found_backoffice_exe}'. Корень содержимого: '{actual_content_root}'")
-                 break # Нашли, останавливаем поиск
-
-        if not found_backoffice_exe or not actual_content_root:
-             # Если BackOffice.exe не найден после распаковки
-             raise FileNotFoundError(f"Файл BackOffice.exe не найден в распакованном содержимом архива '{os.path.basename(temp_archive_path)}'.")
-
-
-        # Теперь перемещаем содержимое actual_content_root в local_installer_path
-        log_message(f"Перемещение содержимого из '{actual_content_root}' в '{local_installer_path}'")
-        update_status("Перемещение содержимого дистрибутива...")
-        try:
-            # Перемещаем все элементы из найденной корневой папки во временной папке
-            items_to_move = [os.path.join(actual_content_root, name) for name in os.listdir(actual_content_root)]
-            for item_src in items_to_move:
-                item_dest = os.path.join(local_installer_path, os.path.basename(item_src))
-                # Используем shutil.move, который работает как переименование внутри одной ФС
-                shutil.move(item_src, item_dest)
-
-            log_message("DEBUG: Содержимое успешно перемещено.")
-            update_status("Содержимое дистрибутива перемещено.")
-
-        except Exception as e:
-            # Ошибка при перемещении файлов
-            raise RuntimeError(f"Ошибка при перемещении содержимого дистрибутива: {e}")
-
-
-        # 2.4. Финальная проверка и верификация производителя BackOffice.exe после перемещения
+        # 2.3. Финальная проверка и верификация производителя BackOffice.exe после распаковки
         backoffice_exe_final_path = os.path.join(local_installer_path, "BackOffice.exe")
         if not os.path.exists(backoffice_exe_final_path):
-             # Это не должно произойти после успешного перемещения, но на всякий случай
-             raise FileNotFoundError(f"Файл BackOffice.exe не найден по ожидаемому конечному пути '{backoffice_exe_final_path}' после перемещения.")
+             # Это не должно произойти после успешной распаковки, но на всякий случай
+             raise FileNotFoundError(f"Файл BackOffice.exe не найден по ожидаемому конечному пути '{backoffice_exe_final_path}' после распаковки.")
 
         company_name = get_file_company_name(backoffice_exe_final_path)
-        # Если get_file_company_name вернул None (ctypes не работает или нет данных),
+        # Если get_file_company_name вернул None (нет ресурса версии или файл не читается),
         # мы доверяем производителю, определенному ранее (на основе имени архива/URL)
         if company_name is not None and vendor.lower() not in company_name.lower():
             # Производитель не совпадает
             raise ValueError(f"Производитель распакованного дистрибутива ('{company_name}') не совпадает с ожидаемым ('{vendor}'). Дистрибутив, возможно, некорректен.")
 
+        # 2.4. Файлы, уже известные по другим версиям, заменяются жесткими ссылками на хранилище InstallerRoot/.objects.
+        # При обновлении по разнице файлы связаны с хранилищем уже при сборке.
+        if delta_result is None and get_config_value(config, 'Cache', 'Deduplicate', default=True, type_cast=bool):
+            update_status("Объединение одинаковых файлов с другими версиями...")
+            with _trace_span(trace, 'dedup') as dedup_span:
+                dedup_stats = deduplicate_installer(installer_root, local_installer_path, cancel_event=cancel_event)
+                dedup_span.update(dedup_stats)
+            if dedup_stats['linked']:
+                log_message(f"Дедупликация: {dedup_stats['linked']} из {dedup_stats['files']} файлов совпали с другими версиями "
+                            f"и заменены ссылками ({dedup_stats['saved_bytes'] / (1024 * 1024):.1f} МБ не занимают место повторно).")
+
 
         # --- УСПЕХ: Удаляем временные папки и возвращаем путь ---
         log_message("Производитель распакованного дистрибутива совпадает (или не определен). Дистрибутив готов к использованию.")
         update_status("Дистрибутив успешно подготовлен.")
 
-        if os.path.exists(temp_extract_path): # Удаляем временную папку распаковки
-             try:
-                 shutil.rmtree(temp_extract_path)
-                 log_message("Временная папка распаковки удалена после успеха.")
-             except Exception as e:
-                 log_message(f"Ошибка при удалении временной папки распаковки '{temp_extract_path}' после успеха: {e}", level="WARNING")
-
         if temp_archive_path_exists and os.path.exists(temp_archive_path): # Удаляем временный архив
              try:
                  os.remove(temp_archive_path)
@@ -923,6 +3937,19 @@ def find_or_download_installer(config, app_type, version_formatted, vendor, upda
              except Exception as e:
                  log_message(f"Ошибка при удалении временного архива '{temp_archive_path}' после успеха: {e}", level="WARNING")
 
+        # Регистрируем версию в индексе кэша и освобождаем место под лимиты [Cache].
+        # SHA-256 посчитан при скачивании; checksum_verified - архив сверен с файлом контрольных сумм источника,
+        # при следующих запусках проверка не повторяется.
+        now = time.time()
+        update_cache_entry(installer_root, expected_local_dir_name, state='ready', app_type=app_type, version=version_formatted, vendor=vendor,
+                           size_bytes=_get_dir_size(local_installer_path), source=used_source, archive_sha256=archive_result['sha256'],
+                           checksum_verified=archive_result['verified'], installed_at=now, last_launch=now)
+        if trace is not None:
+            trace.annotate(installer_source=used_source)
+        evicted = enforce_cache_limits(config, keep=expected_local_dir_name)
+        if evicted:
+            update_status(f"Из кэша удалены давно не используемые версии: {', '.join(evicted)}")
+
         update_progress_callback(100) # Убедимся, что прогресс 100%
         return local_installer_path # Возвращаем путь к готовому дистрибутиву
 
@@ -930,23 +3957,23 @@ def find_or_download_installer(config, app_type, version_formatted, vendor, upda
     # --- ГЛАВНЫЙ EXCEPT БЛОК для обработки ошибок скачивания, распаковки и подготовки ---
     except Exception as e:
         # Этот блок ловит ЛЮБУЮ ошибку, которая произошла
-        # на этапах скачивания, распаковки, проверки или перемещения.
-        log_message(f"Ошибка в процессе подготовки дистрибутива: {e}", level="ERROR")
-        # Статус уже обновлен в более специфичных блоках except (если они были), но можно обновить еще раз
-        update_status(f"Ошибка подготовки дистрибутива: {e}", level="ERROR")
+        # на этапах скачивания, распаковки или проверки.
+        cancelled = isinstance(e, OperationCancelled)
+        if cancelled:
+            log_message("Подготовка дистрибутива отменена.", level="WARNING")
+            update_status("Подготовка дистрибутива отменена. Удаление частичных файлов...", level="WARNING")
+        else:
+            log_message(f"Ошибка в процессе подготовки дистрибутива: {e}", level="ERROR")
+            # Статус уже обновлен в более специфичных блоках except (если они были), но можно обновить еще раз
+            update_status(f"Ошибка подготовки дистрибутива: {e}", level="ERROR")
 
         # --- ОШИБКА: Выполняем очистку временных папок и локальной папки дистрибутива ---
-        # Удаляем временную папку распаковки, если она была создана
-        if os.path.exists(temp_extract_path):
-             try:
-                 # ignore_errors=True полезно, если папка частично удалена или заблокирована
-                 shutil.rmtree(temp_extract_path, ignore_errors=True)
-                 log_message("Временная папка распаковки очищена после ошибки.")
-             except Exception as temp_e:
-                 log_message(f"Ошибка при очистке временной папки распаковки '{temp_extract_path}' после основной ошибки: {temp_e}", level="WARNING")
-
-        # Удаляем временный архив, если он был создан (частично или полностью)
-        # Проверяем флаг temp_archive_path_exists, чтобы не пытаться удалить, если скачивание даже не началось
+        # Останавливаем потоковую распаковку, чтобы она не писала в удаляемую папку
+        if stream_extractor is not None:
+            stream_extractor.abandon("ошибка подготовки дистрибутива")
+            stream_extractor.wait()
+        # Удаляем полностью скачанный временный архив (он мог оказаться поврежденным).
+        # Частично скачанные архивы (*.part) остаются для докачки при следующем запуске.
         if temp_archive_path_exists and os.path.exists(temp_archive_path):
              try:
                  os.remove(temp_archive_path)
@@ -962,15 +3989,18 @@ def find_or_download_installer(config, app_type, version_formatted, vendor, upda
                  log_message("Локальная папка дистрибутива очищена после ошибки подготовки.")
              except Exception as cleanup_e:
                   log_message(f"Ошибка при очистке локальной папки дистрибутива '{local_installer_path}' после ошибки: {cleanup_e}", level="WARNING")
+        remove_cache_entry(installer_root, expected_local_dir_name)
 
 
         update_progress_callback(0) # Прогресс 0% при ошибке
+        if cancelled:
+            raise # Отмена - не ошибка подготовки: вызывающий код должен ее отличать
         return None
 
 
 def get_appdata_path(vendor, app_type, sanitized_target, version_raw=None):
     """Определяет правильный путь к временной папке кэша BackOffice в AppData."""
-    log_message(f"DEBUG: Определение пути AppData для производителя '{vendor}', типа '{app_type}', адреса '{sanitized_target}' и версии '{version_raw}'")
+    log_message(f"DEBUG: Определение пути AppData для производителя '{vendor}', типа '{app_type}', адреса '{sanitized_target}' и версии '{version_raw}'", level="DEBUG")
     app_data_root = os.getenv('APPDATA')
     if not app_data_root:
         log_message("Переменная окружения APPDATA не найдена.", level="ERROR")
@@ -988,9 +4018,9 @@ def get_appdata_path(vendor, app_type, sanitized_target, version_raw=None):
                         major_version = int(major_version_str.group(0))
                         if major_version >= 9:
                             vendor_folder = "Syrve"
-                            log_message(f"DEBUG: Версия Syrve >= 9 ('{version_raw}'). Используется папка Syrve в AppData.")
+                            log_message(f"DEBUG: Версия Syrve >= 9 ('{version_raw}'). Используется папка Syrve в AppData.", level="DEBUG")
                         else:
-                             log_message(f"DEBUG: Версия Syrve < 9 ('{version_raw}'). Используется папка iiko в AppData.")
+                             log_message(f"DEBUG: Версия Syrve < 9 ('{version_raw}'). Используется папка iiko в AppData.", level="DEBUG")
                     else:
                          log_message(f"DEBUG: Не удалось извлечь основную версию из '{version_raw}'. Используется папка iiko.", level="WARNING")
                 else:
@@ -1011,81 +4041,213 @@ def get_appdata_path(vendor, app_type, sanitized_target, version_raw=None):
     return backoffice_temp_dir
 
 
-def wait_for_file(filepath, timeout_sec, check_interval_ms, update_status, update_progress_step_callback):
-    """Ожидает появления файла с таймаутом и обновлением прогресса."""
-    log_message(f"Ожидание появления файла: '{filepath}'")
-    update_status(f"Ожидание файла: '{os.path.basename(filepath)}'...")
+# --- Ожидание файла конфигурации BackOffice ---
 
-    max_attempts = int(timeout_sec * 1000 / check_interval_ms)
-    file_found = False
+_CONFIG_CONTENT_WAIT_SEC = 10 # Сколько ждать полной записи файла после его появления
+_WATCHER_RECHECK_SEC = 1.0 # Контрольная проверка файла при ожидании событий ФС (на случай пропущенного события)
+_FILE_LOCK_RETRY_SEC = 5.0 # Сколько ждать освобождения файла завершающимся процессом
 
-    # Прогресс для этого этапа: 0% -> 50% на ожидание файла
-    step_progress_base = 0.0
-    step_progress_range = 0.5
 
-    for attempt in range(max_attempts):
-        if os.path.exists(filepath):
-            file_found = True
-            log_message("Файл найден!")
-            update_status("Файл конфигурации найден.")
-            update_progress_step_callback(step_progress_base + step_progress_range) # Прогресс 50% для этапа "Ожидание файла"
-            break
-        time.sleep(check_interval_ms / 1000)
-        # Обновляем прогресс немного во время ожидания
-        # Прогресс за один цикл: (1 / max_attempts) * step_progress_range
-        if max_attempts > 0: # Избегаем деления на ноль
-            progress_increment_per_attempt = step_progress_range / max_attempts
-            update_progress_step_callback(step_progress_base + (attempt + 1) * progress_increment_per_attempt)
+def _deepest_existing_dir(path):
+    """Возвращает ближайший существующий каталог на пути path (сам path или его родителя)."""
+    while not os.path.isdir(path):
+        parent = os.path.dirname(path)
+        if not parent or parent == path:
+            return None
+        path = parent
+    return path
 
 
-    if not file_found:
-        log_message(f"Таймаут ожидания файла конфигурации '{filepath}' ({timeout_sec} сек).", level="ERROR")
-        update_status("Таймаут ожидания файла.", level="ERROR")
-        return False
+class _PollingWatcher:
+    """Ожидание изменений опросом: просто пауза check_interval между проверками."""
 
-    # Ожидание содержимого файла (не пустой/не заблокирован)
-    log_message(f"Ожидание содержимого в файле: '{filepath}'")
-    update_status("Ожидание содержимого файла...")
-    content_wait_timeout_sec = 10 # Таймаут ожидания содержимого
-    content_check_interval_ms = 50
-    max_content_attempts = int(content_wait_timeout_sec * 1000 / content_check_interval_ms)
-    content_found = False
+    def __init__(self, check_interval_sec):
+        self.check_interval_sec = check_interval_sec
 
-    # Прогресс для этого этапа: 50% -> 100% на ожидание содержимого
-    step_progress_base = 0.5
-    step_progress_range = 0.5
+    def wait(self, timeout_sec):
+        time.sleep(max(0.0, min(timeout_sec, self.check_interval_sec)))
 
-    for attempt in range(max_content_attempts):
-        try:
-            # Пытаемся прочитать небольшую часть, чтобы убедиться в доступности и наличии хоть чего-то
-            # Используем 'r' и UTF-8, т.к. это текстовый XML файл
-            with open(filepath, 'r', encoding='utf-8') as f:
-                content_preview = f.read(100) # Читаем первые 100 символов
-                # Базовая проверка на наличие XML-подобного содержимого (наличие '<')
-                if content_preview and '<' in content_preview:
-                    content_found = True
-                    log_message("Содержимое файла обнаружено.")
-                    update_status("Содержимое файла обнаружено.")
-                    update_progress_step_callback(step_progress_base + step_progress_range) # Прогресс 100% для этапа "Ожидание файла"
-                    break
-        except Exception as e:
-            # Ошибка при чтении (файл заблокирован или пуст?)
-            log_message(f"DEBUG: Ошибка при чтении превью файла '{filepath}': {e}", level="VERBOSE") # Используем VERBOSE для отладочных логов
+    def close(self):
+        pass
 
-        time.sleep(content_check_interval_ms / 1000)
-        # Обновляем прогресс немного во время ожидания содержимого
-        # Прогресс за один цикл: (1 / max_content_attempts) * step_progress_range
-        if max_content_attempts > 0: # Избегаем деления на ноль
-            progress_increment_per_attempt = step_progress_range / max_content_attempts
-            update_progress_step_callback(step_progress_base + (attempt + 1) * progress_increment_per_attempt)
 
+class _InotifyWatcher:
+    """Ожидание изменений через inotify (Linux). Наблюдает за ближайшим существующим каталогом
+       на пути к файлу и переходит глубже, когда создаются недостающие каталоги.
+    """
+    _IN_NONBLOCK = 0o4000
+    _IN_CLOEXEC = 0o2000000
+    # IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    _WATCH_MASK = 0x002 | 0x008 | 0x080 | 0x100
+
+    def __init__(self, filepath):
+        import ctypes.util
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._target_dir = os.path.dirname(os.path.abspath(filepath))
+        self._fd = self._libc.inotify_init1(self._IN_NONBLOCK | self._IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        self._watch_dir = None
+        self._wd = None
+        self._update_watch()
+
+    def _update_watch(self):
+        watch_dir = _deepest_existing_dir(self._target_dir)
+        if watch_dir is None or watch_dir == self._watch_dir:
+            return
+        if self._wd is not None:
+            self._libc.inotify_rm_watch(self._fd, self._wd)
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(watch_dir), self._WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch '{watch_dir}'")
+        self._wd = wd
+        self._watch_dir = watch_dir
+        log_message(f"DEBUG: inotify: наблюдение за каталогом '{watch_dir}'", level="DEBUG")
+
+    def wait(self, timeout_sec):
+        readable, _, _ = select.select([self._fd], [], [], max(0.0, min(timeout_sec, _WATCHER_RECHECK_SEC)))
+        if readable:
+            # Содержимое событий не важно: после любого события файл проверяется заново
+            try:
+                while os.read(self._fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+        self._update_watch()
 
-    if not content_found:
-        log_message(f"Таймаут ожидания содержимого в файле конфигурации '{filepath}' ({content_wait_timeout_sec} сек). Файл пуст или некорректен?", level="ERROR")
-        update_status("Таймаут ожидания содержимого файла.", level="ERROR")
+    def close(self):
+        os.close(self._fd)
+
+
+class _WindowsChangeWatcher:
+    """Ожидание изменений через FindFirstChangeNotification (Windows) для ближайшего
+       существующего каталога на пути к файлу (с подкаталогами).
+    """
+    # FILE_NOTIFY_CHANGE_FILE_NAME | DIR_NAME | SIZE | LAST_WRITE
+    _NOTIFY_FILTER = 0x001 | 0x002 | 0x008 | 0x010
+    _INVALID_HANDLE_VALUE = ctypes.c_void_p(-1).value
+
+    def __init__(self, filepath):
+        self._kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        self._kernel32.FindFirstChangeNotificationW.restype = ctypes.wintypes.HANDLE
+        self._kernel32.FindFirstChangeNotificationW.argtypes = [ctypes.wintypes.LPCWSTR, ctypes.wintypes.BOOL, ctypes.wintypes.DWORD]
+        self._kernel32.FindNextChangeNotification.argtypes = [ctypes.wintypes.HANDLE]
+        self._kernel32.FindCloseChangeNotification.argtypes = [ctypes.wintypes.HANDLE]
+        self._kernel32.WaitForSingleObject.argtypes = [ctypes.wintypes.HANDLE, ctypes.wintypes.DWORD]
+        self._kernel32.WaitForSingleObject.restype = ctypes.wintypes.DWORD
+        self._target_dir = os.path.dirname(os.path.abspath(filepath))
+        self._watch_dir = None
+        self._handle = None
+        self._update_watch()
+
+    def _update_watch(self):
+        watch_dir = _deepest_existing_dir(self._target_dir)
+        if watch_dir is None or watch_dir == self._watch_dir:
+            return
+        handle = self._kernel32.FindFirstChangeNotificationW(watch_dir, True, self._NOTIFY_FILTER)
+        if handle is None or handle == self._INVALID_HANDLE_VALUE:
+            raise ctypes.WinError(ctypes.get_last_error())
+        self._close_handle()
+        self._handle = handle
+        self._watch_dir = watch_dir
+        log_message(f"DEBUG: Наблюдение за изменениями в каталоге '{watch_dir}'", level="DEBUG")
+
+    def wait(self, timeout_sec):
+        timeout_ms = int(max(0.0, min(timeout_sec, _WATCHER_RECHECK_SEC)) * 1000)
+        if self._kernel32.WaitForSingleObject(self._handle, timeout_ms) == 0: # WAIT_OBJECT_0 - есть изменения
+            self._kernel32.FindNextChangeNotification(self._handle)
+        self._update_watch()
+
+    def _close_handle(self):
+        if self._handle is not None:
+            self._kernel32.FindCloseChangeNotification(self._handle)
+            self._handle = None
+
+    def close(self):
+        self._close_handle()
+
+
+def _create_file_watcher(filepath, watcher_mode, check_interval_ms):
+    """Создает наблюдатель за файлом: события ФС (inotify / Windows), если доступны
+       и не выбран режим poll, иначе опрос с интервалом check_interval_ms.
+    """
+    if watcher_mode != 'poll':
+        try:
+            if sys.platform.startswith('linux'):
+                return _InotifyWatcher(filepath)
+            if os.name == 'nt':
+                return _WindowsChangeWatcher(filepath)
+        except (OSError, AttributeError) as e:
+            log_message(f"Наблюдение за файлом через события ФС недоступно ({e}), используется опрос.", level="WARNING")
+    return _PollingWatcher(check_interval_ms / 1000)
+
+
+def _is_config_file_complete(filepath):
+    """Файл конфигурации считается записанным, когда он разбирается как XML и содержит узел ServersList."""
+    try:
+        return ET.parse(filepath).getroot().find('.//ServersList') is not None
+    except (ET.ParseError, OSError):
         return False
 
-    return True
+
+def _retry_on_file_lock(action, timeout_sec=_FILE_LOCK_RETRY_SEC, interval_sec=0.05):
+    """Выполняет действие с файлом, повторяя его, пока файл удерживается другим процессом."""
+    deadline = time.monotonic() + timeout_sec
+    while True:
+        try:
+            return action()
+        except PermissionError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(interval_sec)
+
+
+def wait_for_file(filepath, timeout_sec, check_interval_ms, update_status, update_progress_step_callback, watcher_mode='auto', cancel_event=None):
+    """Ожидает, пока файл появится и будет полностью записан (XML с узлом ServersList).
+       Реагирует на события файловой системы; опрос - запасной вариант.
+       При установке cancel_event выбрасывает OperationCancelled (проверяется каждые _CANCEL_CHECK_SEC).
+    """
+    log_message(f"Ожидание появления файла: '{filepath}'")
+    update_status(f"Ожидание файла: '{os.path.basename(filepath)}'...")
+
+    # Прогресс этапа: 0% -> 50% на ожидание файла, 50% -> 100% на ожидание содержимого
+    watcher = _create_file_watcher(filepath, watcher_mode, check_interval_ms)
+    try:
+        started = time.monotonic()
+        deadline = started + timeout_sec
+        file_found = False
+        while True:
+            _check_cancelled(cancel_event)
+            if not file_found and os.path.exists(filepath):
+                file_found = True
+                log_message("Файл найден!")
+                update_status("Файл конфигурации найден.")
+                update_progress_step_callback(0.5)
+                log_message(f"Ожидание содержимого в файле: '{filepath}'")
+                update_status("Ожидание содержимого файла...")
+                deadline = time.monotonic() + _CONFIG_CONTENT_WAIT_SEC
+
+            if file_found and _is_config_file_complete(filepath):
+                log_message("Содержимое файла обнаружено (XML разобран, узел ServersList найден).")
+                update_status("Содержимое файла обнаружено.")
+                update_progress_step_callback(1.0)
+                return True
+
+            now = time.monotonic()
+            if now >= deadline:
+                if not file_found:
+                    log_message(f"Таймаут ожидания файла конфигурации '{filepath}' ({timeout_sec} сек).", level="ERROR")
+                    update_status("Таймаут ожидания файла.", level="ERROR")
+                else:
+                    log_message(f"Таймаут ожидания содержимого в файле конфигурации '{filepath}' ({_CONFIG_CONTENT_WAIT_SEC} сек). Файл пуст или некорректен?", level="ERROR")
+                    update_status("Таймаут ожидания содержимого файла.", level="ERROR")
+                return False
+
+            if not file_found and timeout_sec > 0:
+                update_progress_step_callback(0.5 * (now - started) / timeout_sec)
+            watcher.wait(deadline - now if cancel_event is None else min(deadline - now, _CANCEL_CHECK_SEC))
+    finally:
+        watcher.close()
 
 
 def edit_config_file(filepath, target_url_or_ip, target_port, config_protocol, update_status):
@@ -1094,19 +4256,16 @@ def edit_config_file(filepath, target_url_or_ip, target_port, config_protocol, u
     update_status("Редактирование файла конфигурации...")
 
     try:
-        # Ожидаем короткое время после остановки процесса, чтобы файл точно был доступен
-        time.sleep(0.5)
-
         # Используем ElementTree для парсинга и редактирования XML
-        # parse() автоматически определяет кодировку, но явно укажем для надежности
-        tree = ET.parse(filepath)
+        # Файл может еще удерживаться завершающимся BackOffice - повторяем, пока он не освободится
+        tree = _retry_on_file_lock(lambda: ET.parse(filepath))
         root = tree.getroot()
 
         # Находим узел ServersList в любом месте дерева
         servers_list_node = root.find('.//ServersList')
 
         if servers_list_node is not None:
-            log_message("DEBUG: Узел ServersList найден.")
+            log_message("DEBUG: Узел ServersList найден.", level="DEBUG")
 
             # Находим и обновляем ServerAddr
             server_addr_node = servers_list_node.find('ServerAddr')
@@ -1135,7 +4294,7 @@ def edit_config_file(filepath, target_url_or_ip, target_port, config_protocol, u
             # Сохраняем измененный XML обратно в файл
             # xml_declaration=True добавляет <?xml version='1.0' encoding='utf-8'?>
             # pretty_print=True (доступно в lxml, не в ET) помогло бы форматировать, но не критично
-            tree.write(filepath, encoding='utf-8', xml_declaration=True)
+            _retry_on_file_lock(lambda: tree.write(filepath, encoding='utf-8', xml_declaration=True))
             log_message("Файл конфигурации успешно обновлен.")
             update_status("Файл конфигурации успешно обновлен.")
             return True
@@ -1185,122 +4344,1051 @@ def stop_process_by_pid(pid):
         log_message("Команда 'taskkill' не найдена. Убедитесь, что вы на Windows.", level="ERROR")
         return False # Не удалось остановить
     except Exception as e:
-        log_message(f"Неизвестная ошибка при остановке процесса BackOffice (PID: {pid}): {e}", level="ERROR")
-        return False # Не удалось остановить
+        log_message(f"Неизвестная ошибка при остановке процесса BackOffice (PID: {pid}): {e}", level="ERROR")
+        return False # Не удалось остановить
+
+
+# --- Информация о сервере (getServerMonitoringInfo.jsp) ---
+
+# Кэш ответов серверов в памяти процесса: ключ "хост:порт" из введенного адреса ->
+# {'server_info', 'probe_url', 'scheme', 'port', 'fetched_at'}
+_server_info_cache = {}
+_server_info_cache_lock = threading.Lock()
+_server_info_cache_loaded = False
+
+# Стандартные порты серверов iiko/Syrve, которые проверяются, если порт во вводе не указан
+DEFAULT_PROBE_PORTS = (('https', 443), ('http', 8080), ('http', 80))
+
+
+def build_probe_url(target_url_or_ip, probe_scheme, target_port):
+    """Формирует URL запроса информации о сервере для заданных схемы и порта."""
+    # Определяем, нужно ли включать порт в URL запроса
+    standard_http_port = 80
+    standard_https_port = 443
+    include_port_in_probe_url = True
+
+    if probe_scheme == "http" and target_port == standard_http_port:
+         include_port_in_probe_url = False
+    elif probe_scheme == "https" and target_port == standard_https_port:
+         include_port_in_probe_url = False
+
+    probe_url = f"{probe_scheme}://{target_url_or_ip}"
+    if include_port_in_probe_url:
+        probe_url += f":{target_port}"
+    probe_url += "/resto/getServerMonitoringInfo.jsp"
+    return probe_url
+
+
+def _load_server_endpoints():
+    """Загружает запомненные для хостов схему и порт ({хост: {'scheme', 'port', 'updated_at'}})."""
+    try:
+        with open(SERVER_ENDPOINTS_FILE, 'r', encoding='utf-8') as f:
+            endpoints = json.load(f)
+        return endpoints if isinstance(endpoints, dict) else {}
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        log_message(f"Внимание: Не удалось прочитать файл '{SERVER_ENDPOINTS_FILE}': {e}", level="WARNING")
+        return {}
+
+
+def _remember_server_endpoint(host, scheme, port):
+    """Запоминает схему и порт, на которых ответил сервер, для следующих запусков."""
+    with _server_info_cache_lock:
+        endpoints = _load_server_endpoints()
+        endpoints[host.lower()] = {'scheme': scheme, 'port': port, 'updated_at': time.time()}
+        try:
+            with _atomic_replace(SERVER_ENDPOINTS_FILE) as temp_path:
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump(endpoints, f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            log_message(f"Внимание: Не удалось сохранить файл '{SERVER_ENDPOINTS_FILE}': {e}", level="WARNING")
+
+
+def _probe_candidates(parsed_target):
+    """Список комбинаций (схема, порт) для проверки сервера в порядке вероятности."""
+    target_url_or_ip = parsed_target['UrlOrIp']
+    target_port = parsed_target['Port']
+    port_explicit = parsed_target.get('PortExplicit', True)
+
+    # Для доменов iiko.it и syrve.online наиболее вероятен HTTPS, для остальных - HTTP
+    guessed_scheme = "http"
+    if target_url_or_ip.lower().endswith(".iiko.it") or target_url_or_ip.lower().endswith(".syrve.online"):
+        guessed_scheme = "https"
+    other_scheme = "http" if guessed_scheme == "https" else "https"
+
+    candidates = []
+    remembered = _load_server_endpoints().get(target_url_or_ip.lower())
+    if remembered and (not port_explicit or remembered.get('port') == target_port):
+        candidates.append((remembered['scheme'], remembered['port']))
+    if parsed_target.get('Scheme'):
+        candidates.append((parsed_target['Scheme'], target_port))
+    candidates.append((guessed_scheme, target_port))
+    candidates.append((other_scheme, target_port))
+    if not port_explicit:
+        candidates.extend(DEFAULT_PROBE_PORTS)
+
+    unique = []
+    for candidate in candidates:
+        if candidate not in unique:
+            unique.append(candidate)
+    return unique
+
+
+def _request_server_info(probe_url, http_timeout):
+    """Запрашивает getServerMonitoringInfo.jsp. Возвращает разобранный JSON, ошибки - ConnectionError."""
+    try:
+        response = get_http_session().get(probe_url, timeout=http_timeout)
+        response.raise_for_status() # Генерирует исключение для плохих кодов статуса (4xx или 5xx)
+        server_info = response.json() # Парсим JSON ответ
+    except requests.exceptions.Timeout:
+        raise ConnectionError(f"Таймаут ({http_timeout} сек) при выполнении GET-запроса к '{probe_url}'")
+    except requests.exceptions.ConnectionError as e:
+         raise ConnectionError(f"Ошибка подключения при выполнении GET-запроса к '{probe_url}': {e}")
+    except requests.exceptions.RequestException as e:
+        raise ConnectionError(f"Ошибка HTTP запроса к '{probe_url}': {e}")
+    except Exception as e:
+         raise ConnectionError(f"Неожиданная ошибка при запросе к '{probe_url}': {e}")
+    if not isinstance(server_info, dict):
+        raise ConnectionError(f"Ответ '{probe_url}' не является информацией о сервере.")
+    return server_info
+
+
+def _detect_server_endpoint(config, parsed_target):
+    """Одновременно опрашивает сервер по всем вероятным комбинациям схемы и порта
+       и возвращает первый корректный ответ: (server_info, probe_url, scheme, port).
+    """
+    http_timeout = get_config_value(config, 'Settings', 'HttpRequestTimeoutSec', default=15, type_cast=int)
+    candidates = _probe_candidates(parsed_target)
+    log_message(f"Опрос сервера по вариантам: {', '.join(f'{scheme}:{port}' for scheme, port in candidates)}")
+
+    results = queue.Queue()
+
+    def worker(scheme, port):
+        probe_url = build_probe_url(parsed_target['UrlOrIp'], scheme, port)
+        try:
+            results.put((scheme, port, probe_url, _request_server_info(probe_url, http_timeout), None))
+        except ConnectionError as e:
+            results.put((scheme, port, probe_url, None, e))
+
+    # Потоки-демоны: проигравшие запросы дорабатывают в фоне и не задерживают запуск
+    for scheme, port in candidates:
+        threading.Thread(target=worker, args=(scheme, port), daemon=True).start()
+
+    errors = []
+    for _ in candidates:
+        scheme, port, probe_url, server_info, error = results.get()
+        if error is None:
+            log_message(f"Сервер ответил по адресу: {probe_url}")
+            return server_info, probe_url, scheme, port
+        log_message("DEBUG: Вариант %s:%s не подошел: %s", scheme, port, error, level="DEBUG")
+        errors.append(str(error))
+    raise ConnectionError("Сервер не ответил ни по одному из вариантов адреса: " + "; ".join(errors))
+
+
+def _load_server_info_cache():
+    """Один раз за процесс подгружает кэш ответов серверов с диска (вызывается под блокировкой)."""
+    global _server_info_cache_loaded
+    if _server_info_cache_loaded:
+        return
+    _server_info_cache_loaded = True
+    try:
+        with open(SERVER_INFO_CACHE_FILE, 'r', encoding='utf-8') as f:
+            disk_cache = json.load(f)
+        if isinstance(disk_cache, dict):
+            for key, entry in disk_cache.items():
+                # Записи, полученные в этом процессе, новее записей с диска
+                if isinstance(entry, dict) and all(field in entry for field in ('server_info', 'probe_url', 'scheme', 'port', 'fetched_at')):
+                    _server_info_cache.setdefault(key, entry)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        log_message(f"Внимание: Не удалось прочитать кэш информации о серверах '{SERVER_INFO_CACHE_FILE}': {e}", level="WARNING")
+
+
+def _save_server_info_cache(ttl_sec):
+    """Сохраняет на диск еще не устаревшие записи кэша (вызывается под блокировкой)."""
+    now = time.time()
+    fresh = {key: entry for key, entry in _server_info_cache.items() if now - entry['fetched_at'] < ttl_sec}
+    try:
+        with _atomic_replace(SERVER_INFO_CACHE_FILE) as temp_path:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(fresh, f, ensure_ascii=False)
+    except Exception as e:
+        log_message(f"Внимание: Не удалось сохранить кэш информации о серверах '{SERVER_INFO_CACHE_FILE}': {e}", level="WARNING")
+
+
+def fetch_server_info(config, parsed_target, force_refresh=False):
+    """Возвращает информацию о сервере (JSON getServerMonitoringInfo.jsp).
+       Свежий (моложе ServerInfoCacheTtlSec) ответ берется из кэша в памяти или на диске,
+       force_refresh=True всегда выполняет запрос к серверу.
+       Схема и порт определяются одновременным опросом вероятных вариантов, победивший вариант запоминается.
+       Возвращает словарь {'server_info', 'probe_url', 'scheme', 'port', 'fetched_at', 'from_cache'}.
+       Ошибки запроса выбрасываются как ConnectionError.
+    """
+    ttl_sec = get_config_value(config, 'Settings', 'ServerInfoCacheTtlSec', default=60, type_cast=int)
+    cache_key = f"{parsed_target['UrlOrIp'].lower()}:{parsed_target['Port']}"
+
+    if ttl_sec > 0 and not force_refresh:
+        with _server_info_cache_lock:
+            _load_server_info_cache()
+            entry = _server_info_cache.get(cache_key)
+        if entry is not None:
+            age = time.time() - entry['fetched_at']
+            if 0 <= age < ttl_sec:
+                log_message(f"Информация о сервере '{cache_key}' взята из кэша (получена {age:.0f} сек назад).")
+                return dict(entry, from_cache=True)
+
+    server_info, probe_url, scheme, port = _detect_server_endpoint(config, parsed_target)
+    _remember_server_endpoint(parsed_target['UrlOrIp'], scheme, port)
+
+    entry = {'server_info': server_info, 'probe_url': probe_url, 'scheme': scheme, 'port': port, 'fetched_at': time.time()}
+    if ttl_sec > 0:
+        with _server_info_cache_lock:
+            _load_server_info_cache()
+            _server_info_cache[cache_key] = entry
+            _save_server_info_cache(ttl_sec)
+    return dict(entry, from_cache=False)
+
+
+# --- Трасса запуска (интервалы шагов для поиска узких мест) ---
+
+_launch_trace_lock = threading.Lock()
+
+
+class LaunchTrace:
+    """Трасса одного запуска: интервалы шагов (span) с монотонными отметками времени
+       относительно начала запуска, результатом и атрибутами (источник, байты и т.п.).
+       Шаги идут по очереди: begin() закрывает предыдущий шаг. Вложенные интервалы
+       внутри шага записываются через span(). finish() дописывает трассу строкой JSON в LAUNCH_TRACE_FILE;
+       файл больше max_bytes переименовывается в LAUNCH_TRACE_FILE.1 (хранится одна старая копия).
+    """
+
+    def __init__(self, target_string, mode, enabled=True, max_bytes=0):
+        self.launch_id = uuid.uuid4().hex[:12]
+        self.target_string = target_string
+        self.mode = mode
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.started_at = time.time()
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+        self._current = None
+        self._finished = False
+        self.spans = []
+
+    def _now(self):
+        return round(time.monotonic() - self._started, 4)
+
+    def _close(self, span, outcome, error=None):
+        if 'end' in span:
+            return
+        span['end'] = self._now()
+        span['duration_ms'] = round((span['end'] - span['start']) * 1000, 1)
+        span['outcome'] = outcome
+        if error is not None:
+            span['error'] = str(error)
+
+    def begin(self, name, **attrs):
+        """Начинает очередной шаг запуска (предыдущий шаг считается успешно завершенным)."""
+        with self._lock:
+            if self._current is not None:
+                self._close(self._current, 'ok')
+            self._current = dict({'name': name, 'start': self._now()}, **attrs)
+            self.spans.append(self._current)
+            return self._current
+
+    def annotate(self, **attrs):
+        """Добавляет атрибуты к текущему шагу."""
+        with self._lock:
+            if self._current is not None:
+                self._current.update(attrs)
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        """Вложенный интервал внутри текущего шага. Возвращает словарь для атрибутов."""
+        with self._lock:
+            span = dict({'name': name, 'start': self._now()}, **attrs)
+            if self._current is not None:
+                span['parent'] = self._current['name']
+            self.spans.append(span)
+        try:
+            yield span
+        except OperationCancelled:
+            with self._lock:
+                self._close(span, 'cancelled')
+            raise
+        except Exception as e:
+            with self._lock:
+                self._close(span, 'error', e)
+            raise
+        with self._lock:
+            self._close(span, span.pop('outcome', 'ok'))
+
+    def finish(self, outcome, error=None):
+        """Закрывает текущий шаг и записывает трассу запуска (один раз)."""
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+            if self._current is not None:
+                self._close(self._current, outcome, error)
+            record = {
+                'launch_id': self.launch_id,
+                'target': self.target_string,
+                'mode': self.mode,
+                'started_at': self.started_at,
+                'total_ms': round((time.monotonic() - self._started) * 1000, 1),
+                'outcome': outcome,
+                'error': str(error) if error is not None else None,
+                'spans': self.spans
+            }
+        if not self.enabled:
+            return
+        try:
+            with _launch_trace_lock:
+                if self.max_bytes and os.path.exists(LAUNCH_TRACE_FILE) and os.path.getsize(LAUNCH_TRACE_FILE) >= self.max_bytes:
+                    _rotate_log_files(LAUNCH_TRACE_FILE, 1)
+                with open(LAUNCH_TRACE_FILE, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        except OSError as e:
+            log_message(f"Не удалось записать трассу запуска в '{LAUNCH_TRACE_FILE}': {e}", level="WARNING")
+
+
+def create_launch_trace(config, target_string, mode):
+    """Создает трассу запуска; при LaunchTrace = False она ведется, но не записывается в файл."""
+    enabled = get_config_value(config, 'Settings', 'LaunchTrace', default=True, type_cast=bool)
+    max_bytes = max(0, get_config_value(config, 'Settings', 'LaunchTraceMaxSizeMb', default=10, type_cast=int)) * 1024 * 1024
+    return LaunchTrace(target_string, mode, enabled=enabled, max_bytes=max_bytes)
+
+
+def _trace_span(trace, name, **attrs):
+    """Вложенный интервал трассы, если трасса ведется (иначе пустой контекст)."""
+    if trace is None:
+        return contextlib.nullcontext({})
+    return trace.span(name, **attrs)
+
+
+def _percentile(sorted_values, percent):
+    """Процентиль методом ближайшего ранга по отсортированному списку."""
+    rank = max(1, int(-(-percent * len(sorted_values) // 100)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def launch_trace_report(trace_file=LAUNCH_TRACE_FILE):
+    """Сводка по трассам запусков: для каждого шага число замеров, p50, p95 и максимум (мс).
+       Читаются trace_file и его старая копия trace_file.1 (объем ограничен LaunchTraceMaxSizeMb).
+       Возвращает (число запусков, список строк сводки), строки отсортированы по p95.
+    """
+    durations = {}
+    launches = 0
+    trace_files = [path for path in (f"{trace_file}.1", trace_file) if os.path.exists(path)] or [trace_file]
+    for path in trace_files:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue # Поврежденная строка (например, запись оборвалась) не мешает сводке
+                launches += 1
+                durations.setdefault('(launch total)', []).append(record['total_ms'])
+                for span in record.get('spans', []):
+                    if 'duration_ms' in span:
+                        name = f"{span['parent']}/{span['name']}" if span.get('parent') else span['name']
+                        durations.setdefault(name, []).append(span['duration_ms'])
+
+    rows = []
+    for name, values in durations.items():
+        values.sort()
+        rows.append({'step': name, 'count': len(values), 'p50_ms': _percentile(values, 50),
+                     'p95_ms': _percentile(values, 95), 'max_ms': values[-1]})
+    rows.sort(key=lambda row: row['p95_ms'], reverse=True)
+    return launches, rows
+
+
+# --- Сценарий запуска BackOffice (общий для GUI и консольного режима) ---
+# Данные запуска передаются между шагами в словаре launch_data (те же ключи, что и в GUI):
+# target_string, parsed_target, probe_url, config_protocol, config_port, server_info, edition, version_raw,
+# server_state, app_type, vendor, version_formatted, expected_installer_name, installer_path,
+# backoffice_temp_dir, sanitized_target, backoffice_process, backoffice_exe_path, backoffice_args
+
+def parse_server_info(server_info):
+    """Извлекает из ответа сервера (edition, version, serverState). Если ключей нет - ValueError."""
+    edition = server_info.get("edition")
+    version_raw = server_info.get("version")
+    server_state = server_info.get("serverState")
+
+    if None in [edition, version_raw, server_state]:
+         log_message("Полный ответ сервера: %s", server_info, level="DEBUG")
+         raise ValueError("Ответ сервера не содержит ожидаемых ключей (edition, version, serverState).")
+    return edition, version_raw, server_state
+
+
+def prepare_appdata_dir(target_url_or_ip, vendor, app_type, version_raw, update_status):
+    """Определяет временную папку кэша BackOffice в AppData и очищает ее (шаг 8 запуска).
+       Возвращает (путь к временной папке, санитизированный адрес).
+    """
+    # Санитизируем адрес для пути в AppData
+    sanitized_target = sanitize_for_path(target_url_or_ip)
+    log_message(f"Санитизированный адрес для пути AppData: '{sanitized_target}'")
+
+    # Определяем путь к временной папке в AppData
+    backoffice_temp_dir = get_appdata_path(vendor, app_type, sanitized_target, version_raw)
+    if backoffice_temp_dir is None:
+         raise EnvironmentError("Не удалось определить путь временной папки кэша.")
+
+    update_status(f"Ожидаемый путь временной папки кэша: {backoffice_temp_dir}")
+
+    # Очищаем старый кэш в AppData, если существует
+    if os.path.exists(backoffice_temp_dir):
+        update_status(f"Очистка существующей временной папки кэша...")
+        log_message(f"Очистка существующей временной папки кэша: '{backoffice_temp_dir}'")
+        try:
+            shutil.rmtree(backoffice_temp_dir, ignore_errors=True)
+            log_message("Временная папка успешно удалена.")
+            update_status("Временная папка кэша очищена.")
+        except Exception as e:
+            log_message(f"Ошибка при удалении временной папки '{backoffice_temp_dir}': {e}", level="ERROR")
+            update_status("Ошибка при удалении временной папки.", level="WARNING") # Предупреждение, не критическая ошибка
+    else:
+        log_message("Временная папка кэша не найдена. Удаление не требуется.")
+        update_status("Временная папка кэша не найдена.")
+    return backoffice_temp_dir, sanitized_target
+
+
+def start_backoffice(config, installer_path, sanitized_target):
+    """Запускает BackOffice.exe из каталога дистрибутива с папкой кэша для адреса сервера.
+       Возвращает (процесс, путь к BackOffice.exe, аргументы).
+    """
+    backoffice_exe_path = os.path.join(installer_path, "BackOffice.exe")
+    if not os.path.exists(backoffice_exe_path):
+         raise FileNotFoundError(f"Файл BackOffice.exe не найден в каталоге дистрибутива: '{backoffice_exe_path}'.")
+
+    # Формируем аргументы для BackOffice.exe
+    backoffice_args = f"/AdditionalTmpFolder=\"{sanitized_target}\""
+    log_message(f"Запуск BackOffice.exe: '{backoffice_exe_path}' с аргументами: '{backoffice_args}'")
+
+    try:
+        # Используем subprocess.Popen для асинхронного запуска и получения объекта процесса
+        # shell=True может быть опасен с пользовательским вводом, но здесь $sanitized_target уже очищен.
+        # Альтернатива без shell=True сложнее с аргументами с пробелами и кавычками.
+        # cwd устанавливает рабочий каталог.
+        # startupinfo для скрытия окна консоли в Windows
+        startupinfo = None
+        if os.name == 'nt': # Проверяем, что мы на Windows
+            startupinfo = subprocess.STARTUPINFO()
+            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+            startupinfo.wShowWindow = subprocess.SW_HIDE # Скрыть окно
+
+        process = subprocess.Popen(
+            [backoffice_exe_path, backoffice_args],
+            cwd=installer_path,
+            shell=True, # Используем shell=True для корректной обработки аргументов
+            startupinfo=startupinfo,
+            creationflags=subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0 # Не создавать консольное окно на Windows
+        )
+    except FileNotFoundError:
+         raise FileNotFoundError(f"Не удалось найти исполняемый файл BackOffice.exe: '{backoffice_exe_path}'. Убедитесь в правильности пути.")
+    except Exception as e:
+         raise RuntimeError(f"Ошибка при запуске BackOffice.exe: {e}")
 
+    log_message(f"BackOffice.exe успешно запущен (PID: {process.pid}).")
+    # Закрепляем дистрибутив, чтобы он не был вытеснен из кэша, пока BackOffice работает
+    mark_installer_in_use(config, installer_path, process.pid)
+    return process, backoffice_exe_path, backoffice_args
 
-# --- Класс GUI ---
 
-class BackOfficeLauncherGUI:
-    def __init__(self, root):
-        self.root = root
-        root.title("BackOffice Launcher")
-        # Размер окна оставим прежним, т.к. текстовое поле будет растягиваться
-        root.geometry("600x290") # Ширина x Высота
-        root.resizable(False, True) # Теперь окно может изменять размер
+def _backoffice_config_path(backoffice_temp_dir):
+    """Путь к backclient.config.xml во временной папке кэша BackOffice."""
+    return os.path.join(backoffice_temp_dir, "config", "backclient.config.xml")
 
-        # Загружаем конфигурацию сразу при старте
-        self.config = load_config()
-        # Устанавливаем глобальную переменную для логирования отладки из загруженной конфигурации
-        global global_debug_logging # Объявляем использование глобальной переменной
-        global_debug_logging = get_config_value(self.config, 'Settings', 'DebugLogging', default=False, type_cast=bool)
-        log_message(f"Отладочное логирование включено: {global_debug_logging}", level="INFO")
-        # Проверяем доступность ctypes для WinAPI на старте
-        if os.name != 'nt':
-            log_message(f"Запуск не на Windows. Функция get_file_company_name через WinAPI будет недоступна. Текущая ОС: {os.name}", level="WARNING")
 
+def _config_template_path(app_type, version_formatted):
+    """Путь к шаблону backclient.config.xml для типа приложения и версии."""
+    return os.path.join(CONFIG_TEMPLATES_DIR, f"{app_type}_{version_formatted}.xml")
 
-        self.frame = ttk.Frame(root, padding="15") # Увеличиваем отступы
-        self.frame.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
 
-        # Настраиваем растягивание столбцов и строк корневого окна
-        self.root.columnconfigure(0, weight=1)
-        self.root.rowconfigure(0, weight=1)
+def save_config_template(app_type, version_formatted, config_file_path):
+    """Сохраняет настроенный backclient.config.xml как шаблон для типа приложения и версии."""
+    template_path = _config_template_path(app_type, version_formatted)
+    try:
+        os.makedirs(CONFIG_TEMPLATES_DIR, exist_ok=True)
+        with _atomic_replace(template_path) as temp_path:
+            shutil.copyfile(config_file_path, temp_path)
+        log_message(f"Шаблон конфигурации сохранен: '{template_path}'")
+    except OSError as e:
+        log_message(f"Не удалось сохранить шаблон конфигурации '{template_path}': {e}", level="WARNING")
+
+
+def preseed_backoffice_config(config, launch_data, update_status):
+    """Записывает backclient.config.xml из шаблона во временную папку кэша до запуска BackOffice.
+       Возвращает True, если конфиг подготовлен и первый запуск с перезапуском не нужны;
+       False - шаблона нет (или предзаполнение выключено/не удалось), нужен обычный сценарий.
+    """
+    if not get_config_value(config, 'Settings', 'PreseedConfig', default=True, type_cast=bool):
+        return False
 
-        # Настраиваем 4 колонки внутри фрейма:
-        # Колонка 0: Метка (не растягивается)
-        # Колонка 1: Поле ввода (растягивается)
-        # Колонка 2: Кнопка (не растягивается)
-        # Колонка 3: Кнопка (не растягивается)
-        self.frame.columnconfigure(1, weight=1) # Колонка для поля ввода растягивается
-        self.frame.columnconfigure(0, weight=0) # Метка
-        self.frame.columnconfigure(2, weight=0) # Кнопка Check - левая из пары
-        self.frame.columnconfigure(3, weight=0) # Кнопка Launch/Paste - правая из пары
+    template_path = _config_template_path(launch_data['app_type'], launch_data['version_formatted'])
+    if not os.path.exists(template_path):
+        log_message(f"Шаблон конфигурации '{template_path}' не найден. Конфиг будет получен первым запуском BackOffice.")
+        return False
+    if not _is_config_file_complete(template_path):
+        log_message(f"Шаблон конфигурации '{template_path}' поврежден (нет узла ServersList). Используется первый запуск.", level="WARNING")
+        return False
 
-        # Метка "Введите URL или IP:порт:" - Ряд 0, Колонка 0
-        ttk.Label(self.frame, text="Введите URL или IP:порт:").grid(row=0, column=0, sticky=tk.W, pady=5, padx=5)
+    parsed_target = launch_data['parsed_target']
+    config_file_path = _backoffice_config_path(launch_data['backoffice_temp_dir'])
+    update_status("Подготовка файла конфигурации из шаблона...")
+    try:
+        os.makedirs(os.path.dirname(config_file_path), exist_ok=True)
+        shutil.copyfile(template_path, config_file_path)
+    except OSError as e:
+        log_message(f"Не удалось скопировать шаблон конфигурации в '{config_file_path}': {e}", level="WARNING")
+        return False
 
-        # Поле ввода URL/IP - Ряд 0, Колонки 1-2 (чтобы быть шире)
-        self.target_entry = ttk.Entry(self.frame)
-        self.target_entry.grid(row=0, column=1, columnspan=2, sticky=(tk.W, tk.E), pady=5, padx=5) # columnspan=2
-        self.target_entry.focus()
-        self.target_entry.bind("<Return>", self.start_launch) # Привязываем клавишу Enter
-        # Привязываем виртуальное событие <<Paste>> к нашему обработчику
-        self.target_entry.bind("<<Paste>>", self._on_paste)
+    if not edit_config_file(config_file_path, parsed_target['UrlOrIp'], launch_data.get('config_port', parsed_target['Port']),
+                            launch_data['config_protocol'], update_status):
+        # Не оставляем недоделанный конфиг: BackOffice создаст свой при первом запуске
+        _remove_file_quietly(config_file_path)
+        return False
 
+    log_message(f"Файл конфигурации подготовлен из шаблона '{template_path}'.")
+    return True
 
-        # Кнопка "Paste" - Ряд 0, Колонка 3
-        self.paste_button = ttk.Button(self.frame, text="Paste", command=self.paste_from_clipboard)
-        self.paste_button.grid(row=0, column=3, sticky=tk.W, pady=5, padx=5)
 
+def configure_backoffice(config, launch_data, update_status, update_progress_step_callback, cancel_event=None):
+    """Ожидает появления backclient.config.xml после первого запуска, останавливает BackOffice
+       и записывает в конфиг адрес, порт и протокол сервера (шаг 10 запуска).
+       Ожидание прерывается установкой cancel_event (OperationCancelled).
+    """
+    backoffice_temp_dir = launch_data['backoffice_temp_dir']
+    parsed_target = launch_data['parsed_target']
+    target_url_or_ip = parsed_target['UrlOrIp']
+    target_port = launch_data.get('config_port', parsed_target['Port']) # Порт, на котором ответил сервер на шаге 2
+    config_protocol = launch_data['config_protocol'] # Протокол, определенный на шаге 2
+
+    config_file_path = _backoffice_config_path(backoffice_temp_dir)
+    config_wait_timeout = get_config_value(config, 'Settings', 'ConfigFileWaitTimeoutSec', default=60, type_cast=int)
+    config_check_interval = get_config_value(config, 'Settings', 'ConfigFileCheckIntervalMs', default=100, type_cast=int)
+    config_watcher_mode = get_config_value(config, 'Settings', 'ConfigFileWatcher', default='auto').strip().lower()
+
+    # Ожидаем появления файла конфигурации
+    # update_progress_step_callback передается в wait_for_file, чтобы обновлять прогресс внутри этого шага
+    # Прогресс ожидания файла и содержимого внутри wait_for_file будет от 0.0 до 1.0
+    if not wait_for_file(config_file_path, config_wait_timeout, config_check_interval, update_status, update_progress_step_callback, config_watcher_mode, cancel_event):
+         # Если wait_for_file вернул False, это таймаут или ошибка ожидания содержимого.
+         # Ошибка уже была залогирована и статус обновлен внутри wait_for_file.
+         if launch_data.get('backoffice_process') and launch_data['backoffice_process'].poll() is None: # Проверяем, запущен ли процесс
+             update_status("Таймаут ожидания файла конфига. Попытка остановить BackOffice...", level="WARNING")
+             stop_process_by_pid(launch_data['backoffice_process'].pid) # Останавливаем процесс
+         raise TimeoutError(f"Таймаут ожидания файла конфигурации '{config_file_path}'.")
+
+    # Файл найден. Останавливаем процесс BackOffice перед редактированием.
+    current_process = launch_data.get('backoffice_process')
+    if current_process and current_process.poll() is None: # Проверяем, запущен ли процесс
+        update_status("Файл конфигурации найден. Остановка процесса BackOffice для редактирования...")
+        log_message(f"Остановка процесса BackOffice (PID: {current_process.pid}) для редактирования файла.")
+        # stop_process_by_pid возвращает True, если успешно или процесс не найден
+        stop_process_by_pid(current_process.pid)
+        # Ждем фактического завершения процесса вместо фиксированной паузы
+        try:
+            current_process.wait(timeout=_FILE_LOCK_RETRY_SEC)
+        except subprocess.TimeoutExpired:
+            log_message(f"Процесс BackOffice (PID: {current_process.pid}) не завершился за {_FILE_LOCK_RETRY_SEC} сек.", level="WARNING")
+    launch_data['backoffice_process'] = None # Сбрасываем объект процесса в данных запуска
 
-        # Метка статуса - ПЕРЕНОСИМ В РЯД 1, Колонки 0-1
-        # Она должна занимать место слева от кнопок Проверить/Запустить
-        self.status_label = ttk.Label(self.frame, text="Ожидание ввода...", wraplength=400) # wraplength можно скорректировать
-        self.status_label.grid(row=1, column=0, columnspan=2, sticky=tk.W, pady=5, padx=5) # columnspan=2
+    # Редактируем файл конфигурации
+    update_status("Редактирование файла конфигурации...")
+    # edit_config_file не обновляет прогресс внутри себя, просто завершает шаг
+    if not edit_config_file(config_file_path, target_url_or_ip, target_port, config_protocol, update_status):
+         # Ошибка уже была залогирована и статус обновлен внутри edit_config_file
+         raise RuntimeError(f"Не удалось отредактировать файл конфигурации '{config_file_path}'.")
 
+    # Запоминаем рабочий конфиг как шаблон: следующие запуски этой версии обойдутся без перезапуска
+    save_config_template(launch_data['app_type'], launch_data['version_formatted'], config_file_path)
 
-        # Кнопки действий - ПЕРЕНОСИМ В РЯД 1
-        # Кнопка "Проверить" - Ряд 1, Колонка 2
-        self.check_button = ttk.Button(self.frame, text="Проверить", command=self.start_check)
-        self.check_button.grid(row=1, column=2, sticky=tk.E, pady=5, padx=5) # sticky=tk.E для выравнивания по правому краю
 
-        # Кнопка "Запустить" - Ряд 1, Колонка 3
-        self.launch_button = ttk.Button(self.frame, text="Запустить", command=self.start_launch)
-        self.launch_button.grid(row=1, column=3, sticky=tk.E, pady=5, padx=5) # sticky=tk.E
+def resolve_launch_target(config, target_string, update_status, app_type=None, force_refresh=False, trace=None):
+    """Разбирает адрес, запрашивает информацию о сервере и определяет тип приложения, версию
+       и имя каталога дистрибутива. app_type задает тип приложения, если его нельзя определить
+       по edition. Возвращает словарь launch_data, ошибки выбрасываются исключениями.
+    """
+    if trace is None:
+        trace = LaunchTrace(target_string, 'resolve', enabled=False)
+    launch_data = {'target_string': target_string, 'trace': trace}
+
+    trace.begin('parse')
+    parsed_target = parse_target_string(target_string)
+    if parsed_target is None or not parsed_target.get('UrlOrIp'):
+        raise ValueError("Не удалось распарсить ввод или извлечь хост/IP.")
+    launch_data['parsed_target'] = parsed_target
+
+    update_status(f"Запрос информации о сервере: {parsed_target['UrlOrIp']}:{parsed_target['Port']}...")
+    trace.begin('probe')
+    probe_result = fetch_server_info(config, parsed_target, force_refresh=force_refresh)
+    launch_data['probe_url'] = probe_result['probe_url']
+    launch_data['config_protocol'] = probe_result['scheme']
+    launch_data['config_port'] = probe_result['port']
+    launch_data['server_info'] = probe_result['server_info']
+    trace.annotate(from_cache=probe_result['from_cache'], scheme=probe_result['scheme'], port=probe_result['port'])
+
+    trace.begin('resolve_app_type')
+    edition, version_raw, server_state = parse_server_info(probe_result['server_info'])
+    launch_data.update({'edition': edition, 'version_raw': version_raw, 'server_state': server_state})
+    update_status(f"Получены данные: Edition={edition}, Version={version_raw}, State={server_state}")
+
+    if app_type:
+        app_info = {'AppType': app_type, 'Vendor': "iiko" if "iiko" in app_type.lower() else "Syrve"}
+    else:
+        app_info = determine_app_type(target_string, edition)
+        if app_info is None:
+            raise ValueError(f"Не удалось определить тип приложения по edition ('{edition}'). Укажите тип явно.")
+    launch_data['app_type'] = app_info['AppType']
+    launch_data['vendor'] = app_info['Vendor']
+
+    trace.begin('installer_name')
+    launch_data['version_formatted'] = format_version(version_raw)
+    expected_installer_name = get_expected_installer_name(config, launch_data['app_type'], launch_data['version_formatted'])
+    if expected_installer_name is None:
+        raise ValueError("Ошибка формирования имени дистрибутива.")
+    launch_data['expected_installer_name'] = expected_installer_name
+    return launch_data
+
+
+def run_launch(config, target_string, update_status, update_progress_callback, app_type=None, ignore_server_state=False,
+               force_refresh=False, start_backoffice_process=True, cancel_event=None):
+    """Выполняет запуск без GUI: разбор адреса -> запрос к серверу -> подготовка дистрибутива
+       и, если start_backoffice_process=True, первый запуск BackOffice, правка конфига и перезапуск.
+       Вопросы, которые GUI задает пользователю, решаются параметрами: app_type - тип приложения,
+       если его нельзя определить по edition; ignore_server_state - продолжать при состоянии сервера
+       не STARTED_SUCCESSFULLY. Возвращает словарь launch_data, ошибки выбрасываются исключениями.
+       cancel_event прерывает подготовку дистрибутива и ожидание конфига (OperationCancelled).
+    """
+    trace = create_launch_trace(config, target_string, 'headless' if start_backoffice_process else 'headless-prepare')
+    try:
+        launch_data = _run_launch_steps(config, target_string, update_status, update_progress_callback, app_type, ignore_server_state,
+                                        force_refresh, start_backoffice_process, trace, cancel_event)
+    except OperationCancelled as e:
+        trace.finish('cancelled', e)
+        raise
+    except Exception as e:
+        trace.finish('error', e)
+        raise
+    trace.finish('ok')
+    return launch_data
+
+
+def _run_launch_steps(config, target_string, update_status, update_progress_callback, app_type, ignore_server_state,
+                      force_refresh, start_backoffice_process, trace, cancel_event=None):
+    """Шаги run_launch (трасса запуска завершается вызывающей функцией)."""
+    launch_data = resolve_launch_target(config, target_string, update_status, app_type=app_type, force_refresh=force_refresh, trace=trace)
+    parsed_target = launch_data['parsed_target']
+    version_raw = launch_data['version_raw']
+
+    if launch_data['server_state'] != "STARTED_SUCCESSFULLY" and not ignore_server_state:
+        raise RuntimeError(f"Сервер в состоянии '{launch_data['server_state']}', а не 'STARTED_SUCCESSFULLY'.")
+
+    trace.begin('installer')
+    installer_path = find_or_download_installer(config, launch_data['app_type'], launch_data['version_formatted'],
+                                                launch_data['vendor'], update_status, update_progress_callback, trace, cancel_event)
+    if installer_path is None:
+        raise FileNotFoundError("Не удалось найти или подготовить дистрибутив.")
+    launch_data['installer_path'] = installer_path
+
+    if not start_backoffice_process:
+        return launch_data
+
+    def run_backoffice():
+        process, backoffice_exe_path, backoffice_args = start_backoffice(config, installer_path, launch_data['sanitized_target'])
+        launch_data['backoffice_process'] = process
+        launch_data['backoffice_exe_path'] = backoffice_exe_path
+        launch_data['backoffice_args'] = backoffice_args
 
+    try:
+        trace.begin('appdata')
+        backoffice_temp_dir, sanitized_target = prepare_appdata_dir(parsed_target['UrlOrIp'], launch_data['vendor'], launch_data['app_type'], version_raw, update_status)
+        launch_data['backoffice_temp_dir'] = backoffice_temp_dir
+        launch_data['sanitized_target'] = sanitized_target
+        trace.begin('preseed_config')
+        launch_data['config_preseeded'] = preseed_backoffice_config(config, launch_data, update_status)
+        if launch_data['config_preseeded']:
+            trace.begin('start')
+            update_status("Запуск BackOffice.exe с подготовленной конфигурацией...")
+            run_backoffice()
+        else:
+            trace.begin('first_run')
+            update_status("Первый запуск BackOffice.exe...")
+            run_backoffice()
+            trace.begin('config_wait')
+            configure_backoffice(config, launch_data, update_status, lambda value: None, cancel_event)
+            trace.begin('restart')
+            update_status("Перезапуск BackOffice.exe...")
+            run_backoffice()
+    except Exception:
+        # Не оставляем BackOffice, запущенный с ненастроенным конфигом
+        if launch_data.get('backoffice_process') is not None:
+            stop_process_by_pid(launch_data['backoffice_process'].pid)
+            launch_data['backoffice_process'] = None
+        raise
+    return launch_data
+
+
+def prefetch_installers(config, targets, update_status, probe_workers=8, download_workers=2, app_type=None, force_refresh=False, background=True):
+    """Предзагрузка дистрибутивов для списка серверов: все серверы опрашиваются параллельно,
+       версии сводятся к набору различных (тип приложения, версия), и эти дистрибутивы
+       скачиваются/распаковываются не более чем download_workers потоками.
+       background - скачивать как фоновые передачи (с лимитами скорости RateLimitKBps); False - как для запуска.
+       Возвращает (результаты по серверам, результаты по дистрибутивам) - списки словарей.
+    """
+    server_results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, probe_workers)) as executor:
+        futures = {executor.submit(resolve_launch_target, config, target, update_status, app_type, force_refresh): target
+                   for target in targets}
+        for future in concurrent.futures.as_completed(futures):
+            target = futures[future]
+            try:
+                launch_data = future.result()
+            except Exception as e:
+                log_message(f"[{target}] Не удалось определить версию сервера: {e}", level="ERROR")
+                server_results.append({'target': target, 'ok': False, 'error': str(e)})
+                continue
+            server_results.append({
+                'target': target, 'ok': True,
+                'edition': launch_data['edition'], 'version': launch_data['version_raw'],
+                'server_state': launch_data['server_state'], 'app_type': launch_data['app_type'],
+                'vendor': launch_data['vendor'], 'version_formatted': launch_data['version_formatted'],
+                'installer_name': launch_data['expected_installer_name']
+            })
+
+    # Различные дистрибутивы: один и тот же каталог версии нужен многим серверам
+    installers = {}
+    for result in server_results:
+        if result['ok']:
+            key = (result['app_type'], result['version_formatted'])
+            installer = installers.setdefault(key, {'app_type': key[0], 'version_formatted': key[1], 'vendor': result['vendor'],
+                                                    'installer_name': result['installer_name'], 'targets': []})
+            installer['targets'].append(result['target'])
+    update_status(f"Серверов опрошено: {len(server_results)}, различных дистрибутивов: {len(installers)}.")
+    max_versions = get_config_value(config, 'Cache', 'MaxVersions', default=0, type_cast=int)
+    if 0 < max_versions < len(installers):
+        log_message(f"Различных дистрибутивов ({len(installers)}) больше, чем MaxVersions ({max_versions}): "
+                    f"часть предзагруженных версий будет вытеснена из кэша.", level="WARNING")
+
+    def prefetch_worker(installer):
+        started = time.monotonic()
+        result = dict(installer, ok=False)
+        try:
+            installer_path = find_or_download_installer(config, installer['app_type'], installer['version_formatted'],
+                                                        installer['vendor'], update_status, lambda value, transfer=None: None,
+                                                        background=background)
+            if installer_path is None:
+                raise FileNotFoundError("Не удалось найти или подготовить дистрибутив.")
+            result.update(ok=True, installer_path=installer_path)
+        except Exception as e:
+            log_message(f"Предзагрузка {installer['installer_name']} не удалась: {e}", level="ERROR")
+            result['error'] = str(e)
+        result['elapsed_sec'] = round(time.monotonic() - started, 3)
+        return result
+
+    installer_results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, download_workers)) as executor:
+        for result in executor.map(prefetch_worker, installers.values()):
+            installer_results.append(result)
+    return server_results, installer_results
+
+
+# --- Консольный режим (без GUI) ---
+
+def _read_cli_targets(args):
+    """Собирает список адресов из аргументов и файла (--targets-file, '-' - стандартный ввод)."""
+    targets = list(args.targets)
+    if args.targets_file:
+        if args.targets_file == '-':
+            lines = sys.stdin.read().splitlines()
+        else:
+            with open(args.targets_file, 'r', encoding='utf-8') as f:
+                lines = f.read().splitlines()
+        # Пустые строки и комментарии (#) пропускаются
+        targets.extend(line.strip() for line in lines if line.strip() and not line.strip().startswith('#'))
+    return targets
 
-        # Прогресс бар - ПЕРЕНОСИМ В РЯД 2, Колонки 0-3
-        self.progress_bar = ttk.Progressbar(self.frame, orient='horizontal', mode='determinate')
-        self.progress_bar.grid(row=2, column=0, columnspan=4, sticky=(tk.W, tk.E), pady=5, padx=5) # columnspan=4
 
+def _cli_launch_result(config, target_string, args, cancel_event=None):
+    """Выполняет запуск для одного адреса и возвращает результат в виде словаря для JSON."""
+    started = time.monotonic()
 
-        # Текстовое поле для вывода JSON - ПЕРЕНОСИМ В РЯД 3, Колонки 0-3
-        # Используем tk.Text вместо scrolledtext.ScrolledText
-        # Удаляем параметры width и height, т.к. размер будет определяться grid и растягиванием
-        self.json_output_text = tk.Text(self.frame, wrap=tk.WORD, state=tk.DISABLED) # wrap=tk.WORD переносит по словам
-        self.json_output_text.grid(row=3, column=0, columnspan=4, sticky=(tk.W, tk.E, tk.N, tk.S), pady=5, padx=5)
-        # Настраиваем растягивание ряда с текстовым полем
-        self.frame.rowconfigure(3, weight=1) # Ряд с текстовым полем растягивается
+    def status(message, level="INFO"):
+        # Статусы GUI в консольном режиме попадают в журнал (stderr) с адресом сервера
+        log_message("[%s] %s", target_string, message, level="DEBUG" if level == "INFO" else level)
 
+    result = {'target': target_string, 'ok': False}
+    try:
+        launch_data = run_launch(config, target_string, status, lambda value, transfer=None: None, app_type=args.app_type,
+                                 ignore_server_state=args.ignore_server_state, force_refresh=args.force_refresh,
+                                 start_backoffice_process=args.launch, cancel_event=cancel_event)
+        result['ok'] = True
+    except Exception as e:
+        launch_data = None
+        result['error'] = str(e)
+        log_message(f"[{target_string}] Ошибка: {e}", level="ERROR")
+
+    if launch_data is not None:
+        process = launch_data.get('backoffice_process')
+        result.update({
+            'launch_id': launch_data['trace'].launch_id,
+            'host': launch_data['parsed_target']['UrlOrIp'],
+            'port': launch_data.get('config_port'),
+            'scheme': launch_data.get('config_protocol'),
+            'edition': launch_data.get('edition'),
+            'version': launch_data.get('version_raw'),
+            'server_state': launch_data.get('server_state'),
+            'app_type': launch_data.get('app_type'),
+            'vendor': launch_data.get('vendor'),
+            'installer_path': launch_data.get('installer_path'),
+            'pid': process.pid if process is not None else None
+        })
+    result['elapsed_sec'] = round(time.monotonic() - started, 3)
+    return result
 
-        # Переменные для хранения информации о процессе и прогрессе
-        self.backoffice_process = None
-        self.current_step_progress = 0.0 # Прогресс внутри текущего основного шага (от 0.0 до 1.0)
-        self.progress_base = 0.0 # Начальное значение прогресса для текущего шага (0-100)
-        self.next_step_base = 0.0 # Начальное значение прогресса для следующего шага (0-100)
 
-        # Словарь для сохранения данных между шагами, которые требуют пользовательского ввода
-        self._launch_data = {}
+def _run_cli_prefetch(config, targets, args):
+    """Режим --prefetch: выводит строки JSON по серверам (kind=server) и по дистрибутивам (kind=installer)."""
+    def status(message, level="INFO"):
+        log_message(message, level="DEBUG" if level == "INFO" else level)
+
+    server_results, installer_results = prefetch_installers(config, targets, status, probe_workers=args.jobs,
+                                                            download_workers=args.download_jobs, app_type=args.app_type,
+                                                            force_refresh=args.force_refresh, background=not args.foreground)
+    for kind, results in (('server', server_results), ('installer', installer_results)):
+        for result in results:
+            sys.stdout.write(json.dumps(dict(result, kind=kind), ensure_ascii=False) + '\n')
+    sys.stdout.flush()
+    all_ok = all(result['ok'] for result in server_results + installer_results)
+    return 0 if all_ok else 1
+
+
+def _print_trace_report():
+    """Режим --trace-report: таблица длительностей шагов по всем записанным запускам."""
+    try:
+        launches, rows = launch_trace_report()
+    except OSError as e:
+        print(f"Не удалось прочитать трассы запусков '{LAUNCH_TRACE_FILE}': {e}", file=sys.stderr)
+        return 2
+    print(f"Запусков: {launches}")
+    print(f"{'Шаг':<36} {'N':>6} {'p50, мс':>10} {'p95, мс':>10} {'макс, мс':>10}")
+    for row in rows:
+        print(f"{row['step']:<36} {row['count']:>6} {row['p50_ms']:>10.1f} {row['p95_ms']:>10.1f} {row['max_ms']:>10.1f}")
+    return 0
+
+
+def run_cli(argv):
+    """Консольный режим: подготавливает (и по --launch запускает) BackOffice для списка серверов.
+       Результат по каждому адресу выводится в stdout одной строкой JSON, журнал - в stderr.
+       С --prefetch только скачивает различные дистрибутивы, нужные серверам из списка.
+       Код возврата 0, если все адреса обработаны успешно, иначе 1.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="BOlauncher --headless", description="Подготовка BackOffice для списка серверов без GUI.")
+    parser.add_argument('targets', nargs='*', help="Адреса серверов (URL или IP:порт)")
+    parser.add_argument('--targets-file', help="Файл со списком адресов, по одному в строке ('-' - стандартный ввод)")
+    parser.add_argument('--launch', action='store_true', help="Также запустить BackOffice и записать адрес сервера в его конфиг")
+    parser.add_argument('--app-type', choices=['iikoRMS', 'iikoChain', 'SyrveRMS', 'SyrveChain'],
+                        help="Тип приложения, если его нельзя определить по edition сервера")
+    parser.add_argument('--ignore-server-state', action='store_true', help="Продолжать, если сервер не в состоянии STARTED_SUCCESSFULLY")
+    parser.add_argument('--force-refresh', action='store_true', help="Не использовать кэш информации о серверах")
+    parser.add_argument('--jobs', type=int, default=4, help="Сколько адресов обрабатывать одновременно (по умолчанию 4)")
+    parser.add_argument('--prefetch', action='store_true',
+                        help="Только опросить серверы и заранее скачать различные дистрибутивы их версий")
+    parser.add_argument('--download-jobs', type=int, default=2, help="Сколько дистрибутивов скачивать одновременно при --prefetch (по умолчанию 2)")
+    parser.add_argument('--foreground', action='store_true',
+                        help="При --prefetch скачивать без лимитов фоновых передач (RateLimitKBps), как для запуска")
+    parser.add_argument('--trace-report', action='store_true',
+                        help=f"Вывести сводку p50/p95 по шагам запусков из {LAUNCH_TRACE_FILE} и выйти")
+    args = parser.parse_args(argv)
+
+    if args.trace_report:
+        return _print_trace_report()
+
+    global global_log_to_stderr
+    global_log_to_stderr = True
+    config = load_config()
+    init_logging(config)
+    init_http_session(config)
+
+    try:
+        targets = _read_cli_targets(args)
+    except OSError as e:
+        log_message(f"Не удалось прочитать список адресов: {e}", level="ERROR")
+        return 2
+    if not targets:
+        parser.error("не указано ни одного адреса")
+
+    if args.prefetch:
+        return _run_cli_prefetch(config, targets, args)
+
+    all_ok = True
+    output_lock = threading.Lock()
+    cancel_event = threading.Event() # Ctrl+C: запуски прерываются на ближайшем блоке данных
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        futures = [executor.submit(_cli_launch_result, config, target, args, cancel_event) for target in targets]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                result = future.result()
+                all_ok = all_ok and result['ok']
+                with output_lock:
+                    sys.stdout.write(json.dumps(result, ensure_ascii=False) + '\n')
+                    sys.stdout.flush()
+        except KeyboardInterrupt:
+            log_message("Прервано пользователем. Отмена запусков...", level="WARNING")
+            cancel_event.set()
+            for future in futures:
+                future.cancel()
+            return 130
+    return 0 if all_ok else 1
+
+
+# --- Канал прогресса между рабочими потоками и GUI ---
+
+_PROGRESS_FRAME_MS = 50 # Частота отрисовки прогресса (~20 кадров в секунду)
+_TRANSFER_RATE_WINDOW_SEC = 0.5 # Минимальный интервал между замерами скорости передачи
+_TRANSFER_RATE_SMOOTHING = 0.3 # Вес нового замера в сглаженной скорости
+_TRANSFER_STALE_SEC = 2.0 # Через сколько секунд без данных скорость перестает показываться
+
+
+def _format_transfer_rate(bytes_per_sec):
+    """Форматирует скорость передачи для строки статуса."""
+    if bytes_per_sec >= 1024 * 1024:
+        return f"{bytes_per_sec / (1024 * 1024):.1f} МБ/с"
+    return f"{bytes_per_sec / 1024:.0f} КБ/с"
+
+
+def _format_eta(seconds):
+    """Форматирует оставшееся время как М:СС или Ч:ММ:СС."""
+    seconds = int(round(seconds))
+    hours, rest = divmod(seconds, 3600)
+    minutes, secs = divmod(rest, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{secs:02d}"
+    return f"{minutes}:{secs:02d}"
+
+
+class ProgressChannel:
+    """Передает прогресс и статус из рабочих потоков в Tk.
+       Рабочие потоки только запоминают последнее значение, основной поток забирает его
+       одним таймером раз в _PROGRESS_FRAME_MS, поэтому частые обновления не засоряют очередь событий Tk.
+       По данным о переданных байтах считается скорость и оставшееся время, они дописываются к статусу.
+    """
+    def __init__(self, root, apply_progress, apply_status, interval_ms=_PROGRESS_FRAME_MS):
+        self._root = root
+        self._apply_progress = apply_progress # Вызывается в основном потоке: apply_progress(value)
+        self._apply_status = apply_status # Вызывается в основном потоке: apply_status(text, level)
+        self._interval_ms = interval_ms
+        self._lock = threading.Lock()
+        self._progress = None # Последнее не отрисованное значение прогресса
+        self._status = None # Последний статус (message, level)
+        self._status_dirty = False
+        self._shown_suffix = ''
+        self._transfer = None # (передано байт, всего байт, время последнего замера)
+        self._rate_sample = None # (время, передано байт) для расчета скорости
+        self._rate = None # Сглаженная скорость, байт/с
+
+    def start(self):
+        """Запускает таймер отрисовки (вызывать из основного потока)."""
+        self._root.after(self._interval_ms, self._drain)
+
+    def post_progress(self, value, transfer=None):
+        """Запоминает значение прогресса (0-100). transfer - кортеж (передано байт, всего байт) или None."""
+        with self._lock:
+            self._progress = value
+            if transfer is not None:
+                self._record_transfer(transfer[0], transfer[1])
+
+    def post_status(self, message, level="INFO"):
+        """Запоминает новый текст статуса. Сведения о текущей передаче сбрасываются."""
+        with self._lock:
+            self._status = (message, level)
+            self._status_dirty = True
+            self._transfer = None
+            self._rate_sample = None
+            self._rate = None
+
+    def _record_transfer(self, done, total):
+        now = time.monotonic()
+        if self._rate_sample is None or done < self._rate_sample[1]:
+            # Новая передача (или повтор с начала) - начинаем замер заново
+            self._rate_sample = (now, done)
+            self._rate = None
+        elif now - self._rate_sample[0] >= _TRANSFER_RATE_WINDOW_SEC:
+            current_rate = (done - self._rate_sample[1]) / (now - self._rate_sample[0])
+            if self._rate is None:
+                self._rate = current_rate
+            else:
+                self._rate += _TRANSFER_RATE_SMOOTHING * (current_rate - self._rate)
+            self._rate_sample = (now, done)
+        self._transfer = (done, total, now)
+
+    def _transfer_suffix(self):
+        # Вызывается под self._lock
+        if self._transfer is None or not self._rate:
+            return ''
+        done, total, sampled_at = self._transfer
+        if time.monotonic() - sampled_at > _TRANSFER_STALE_SEC or done >= total:
+            return ''
+        suffix = f" ({_format_transfer_rate(self._rate)}"
+        if total > 0:
+            suffix += f", осталось ~{_format_eta((total - done) / self._rate)}"
+        return suffix + ")"
+
+    def _drain(self):
+        with self._lock:
+            progress, self._progress = self._progress, None
+            status = self._status
+            suffix = self._transfer_suffix()
+            status_changed = self._status_dirty or suffix != self._shown_suffix
+            self._status_dirty = False
+            self._shown_suffix = suffix
+        try:
+            if progress is not None:
+                self._apply_progress(progress)
+            if status is not None and status_changed:
+                self._apply_status(status[0] + suffix, status[1])
+        except tk.TclError:
+            return # Окно уже закрыто
+        self._root.after(self._interval_ms, self._drain)
 
 
+# --- Класс GUI ---
+
+class _ProgressReporter:
+    """Метка статуса и прогресс бар с разбиением общего прогресса на шаги.
+       Наследник создает self.status_label, self.progress_bar и self._progress_channel.
+    """
     def update_status(self, message, level="INFO"):
         """Обновляет метку статуса GUI и выводит сообщение в лог."""
-        # Обновление GUI должно происходить в основном потоке
+        # Метка обновится в основном потоке при ближайшей отрисовке канала прогресса
+        self._progress_channel.post_status(message, level)
+        log_message(message, level=level)
+
+    def update_progress(self, value, transfer=None):
+        """Обновляет значение прогресс бара GUI (0-100).
+           transfer - (передано байт, всего байт) для показа скорости и оставшегося времени.
+        """
+        # Убедимся, что значение находится в диапазоне [0, 100]
+        safe_value = max(0, min(100, value))
+        self._progress_channel.post_progress(safe_value, transfer)
+
+    def _apply_status(self, text, level):
+        """Применяет статус к метке (только из основного потока)."""
         color = "black"
         if level == "ERROR":
             color = "red"
         elif level == "WARNING":
             color = "orange"
-        self.root.after(0, lambda: self.status_label.config(text=message, foreground=color))
-        log_message(message, level)
+        self.status_label.config(text=text, foreground=color)
 
-    def update_progress(self, value):
-        """Обновляет значение прогресс бара GUI (0-100)."""
-        # Обновление GUI должно происходить в основном потоке
-        # Убедимся, что значение находится в диапазоне [0, 100]
-        safe_value = max(0, min(100, value))
-        self.root.after(0, lambda: self.progress_bar.config(value=safe_value))
+    def _apply_progress(self, value):
+        """Применяет значение к прогресс бару (только из основного потока)."""
+        self.progress_bar.config(value=value)
 
     def reset_progress(self):
          """Сбрасывает прогресс бар на 0."""
@@ -1314,7 +5402,7 @@ class BackOfficeLauncherGUI:
         self.progress_base = base_value
         self.next_step_base = next_base_value
         self.current_step_progress = 0.0 # Сбрасываем прогресс внутри шага
-        log_message(f"DEBUG: Установлены границы прогресса шага: {self.progress_base}% - {self.next_step_base}%")
+        log_message("DEBUG: Установлены границы прогресса шага: %s%% - %s%%", self.progress_base, self.next_step_base, level="DEBUG")
 
 
     def update_progress_step(self, increment_factor=0.0):
@@ -1331,159 +5419,82 @@ class BackOfficeLauncherGUI:
         step_range = self.next_step_base - self.progress_base
         total_progress = self.progress_base + (self.current_step_progress * step_range)
         self.update_progress(total_progress)
-        log_message(f"DEBUG: Прогресс обновлен. Шаг: {self.progress_base:.1f}-{self.next_step_base:.1f}%, Внутри шага: {self.current_step_progress*100:.1f}%, Общий: {total_progress:.1f}%")
-
-
-    def start_launch(self, event=None):
-        """Запускает процесс запуска BackOffice в отдельном потоке."""
-        target_string = self.target_entry.get().strip()
-        if not target_string:
-            self.update_status("Введите URL или IP:порт.", level="WARNING")
-            return
-
-        # Отключаем ввод и кнопку на время выполнения
-        self.launch_button.config(state=tk.DISABLED)
-        self.target_entry.config(state=tk.DISABLED)
-        self.reset_progress()
-        self.update_status("Запуск процесса...")
-
-        # Очищаем данные предыдущего запуска
-        self._launch_data = {}
-        self._launch_data['target_string'] = target_string
-
-        # Используем поток, чтобы не блокировать GUI
-        self.launch_thread = threading.Thread(target=self._launch_step1_parse, args=(target_string,))
-        self.launch_thread.daemon = True # Поток завершится при закрытии приложения
-        self.launch_thread.start()
-
-    def paste_from_clipboard(self):
-        """Generates a paste event on the target entry."""
-        # Генерируем виртуальное событие <<Paste>> на поле ввода.
-        # Обработка вставки (получение из буфера, ограничение, вставка)
-        # будет выполняться в методе _on_paste, привязанном к этому событию.
-        log_message("Кнопка 'Paste' нажата. Генерация события <<Paste>>.", level="DEBUG")
-        self.target_entry.event_generate("<<Paste>>")
-
-    def start_check(self):
-        """Starts the server check process in a separate thread."""
-        target_string = self.target_entry.get().strip()
-        if not target_string:
-            self.update_status("Введите URL или IP:порт для проверки.", level="WARNING")
-            return
-
-        # Отключаем ввод и кнопки на время выполнения
-        self.launch_button.config(state=tk.DISABLED)
-        self.check_button.config(state=tk.DISABLED)
-        self.target_entry.config(state=tk.DISABLED)
-
-        # Очищаем текстовое поле
-        self.update_text_area("")
-
-        self.update_status("Выполнение проверки сервера...")
-        self.reset_progress() # Сбрасываем прогресс для проверки (хотя она короткая)
-        self.update_progress(0) # Убедимся, что прогресс на 0
-
-        # Используем поток для выполнения проверки
-        self.check_thread = threading.Thread(target=self.check_server_thread, args=(target_string,))
-        self.check_thread.daemon = True # Поток завершится при закрытии приложения
-        self.check_thread.start()
-
-    def check_server_thread(self, target_string):
-        """Performs the server check logic in a separate thread."""
-        try:
-            # Шаг проверки: Парсинг
-            self.update_status("Парсинг адреса для проверки...")
-            parsed_target = parse_target_string(target_string)
-            if parsed_target is None or not parsed_target.get('UrlOrIp'):
-                raise ValueError("Не удалось распарсить ввод или извлечь хост/IP.")
-
-            target_url_or_ip = parsed_target['UrlOrIp']
-            target_port = parsed_target['Port']
-
-            # Шаг проверки: Формирование URL и запрос
-            self.update_status(f"Запрос информации о сервере: {target_url_or_ip}:{target_port}...")
-
-            # Логика формирования probe_url такая же, как в _launch_step2_httprequest
-            probe_scheme = "http"
-            if target_url_or_ip.lower().endswith(".iiko.it") or target_url_or_ip.lower().endswith(".syrve.online"):
-                probe_scheme = "https"
+        log_message("DEBUG: Прогресс обновлен. Шаг: %.1f-%.1f%%, Внутри шага: %.1f%%, Общий: %.1f%%",
+                    self.progress_base, self.next_step_base, self.current_step_progress * 100, total_progress, level="DEBUG")
 
-            standard_http_port = 80
-            standard_https_port = 443
-            include_port_in_probe_url = True
 
-            if probe_scheme == "http" and target_port == standard_http_port:
-                 include_port_in_probe_url = False
-            elif probe_scheme == "https" and target_port == standard_https_port:
-                 include_port_in_probe_url = False
-
-            probe_url = f"{probe_scheme}://{target_url_or_ip}"
-            if include_port_in_probe_url:
-                probe_url += f":{target_port}"
-            probe_url += "/resto/getServerMonitoringInfo.jsp"
-
-            log_message(f"URL для запроса информации о сервере (проверка): {probe_url}")
-
-            http_timeout = get_config_value(self.config, 'Settings', 'HttpRequestTimeoutSec', default=15, type_cast=int)
-            server_info = None
-            try:
-                response = requests.get(probe_url, timeout=http_timeout)
-                response.raise_for_status()
-                server_info = response.json()
-            except requests.exceptions.Timeout:
-                raise ConnectionError(f"Таймаут ({http_timeout} сек) при выполнении GET-запроса к '{probe_url}'")
-            except requests.exceptions.ConnectionError as e:
-                 raise ConnectionError(f"Ошибка подключения при выполнении GET-запроса к '{probe_url}': {e}")
-            except requests.exceptions.RequestException as e:
-                raise ConnectionError(f"Ошибка HTTP запроса к '{probe_url}': {e}")
-            except Exception as e:
-                 raise ConnectionError(f"Неожиданная ошибка при запросе к '{probe_url}': {e}")
-
-            # Шаг проверки: Вывод результата
-            self.update_status("Получен ответ от сервера. Вывод JSON...")
-            log_message(f"Получен ответ от сервера: {server_info}", level="DEBUG")
+class LaunchSession(_ProgressReporter):
+    """Один запуск BackOffice из GUI: свои данные шагов, строка прогресса в окне и процесс BackOffice.
+       Шаги выполняются в рабочих потоках окна (не больше MaxConcurrentLaunches сеансов одновременно),
+       диалоги - в основном потоке.
+    """
+    def __init__(self, gui, target_string):
+        self.gui = gui
+        self.root = gui.root
+        self.config = gui.config
+        self.target_string = target_string
+        self.finished = False # Запуск завершен (успешно или с ошибкой)
+        # Флаг отмены: проверяется шагами запуска, скачиванием, распаковкой и ожиданием конфига
+        self.cancel_event = threading.Event()
+
+        # Строка сеанса: адрес, прогресс, статус и кнопка отмены (после завершения - удаления строки)
+        self.row = ttk.Frame(gui.sessions_frame)
+        self.row.pack(fill=tk.X, pady=2)
+        self.row.columnconfigure(2, weight=1) # Статус растягивается
+        ttk.Label(self.row, text=target_string, width=24).grid(row=0, column=0, sticky=tk.W, padx=5)
+        self.progress_bar = ttk.Progressbar(self.row, orient='horizontal', mode='determinate', length=120)
+        self.progress_bar.grid(row=0, column=1, padx=5)
+        self.status_label = ttk.Label(self.row, text="В очереди...", wraplength=300)
+        self.status_label.grid(row=0, column=2, sticky=tk.W, padx=5)
+        self.close_button = ttk.Button(self.row, text="Отмена", width=7, command=self.cancel)
+        self.close_button.grid(row=0, column=3, sticky=tk.E, padx=5)
 
-            # Форматируем JSON для удобного чтения
-            formatted_json = json.dumps(server_info, indent=4, ensure_ascii=False)
-            self.update_text_area(formatted_json) # Выводим в текстовое поле
+        # Переменные для хранения информации о процессе и прогрессе
+        self.backoffice_process = None
+        self.current_step_progress = 0.0 # Прогресс внутри текущего основного шага (от 0.0 до 1.0)
+        self.progress_base = 0.0 # Начальное значение прогресса для текущего шага (0-100)
+        self.next_step_base = 0.0 # Начальное значение прогресса для следующего шага (0-100)
 
-            self.update_status("Проверка завершена. Ответ сервера в поле ниже.", level="INFO")
-            self.update_progress(100) # Прогресс 100% для проверки
+        # Словарь для сохранения данных между шагами, которые требуют пользовательского ввода
+        self._launch_data = {'target_string': target_string,
+                             'trace': create_launch_trace(self.config, target_string, 'gui')}
 
-        except Exception as e:
-            # Обработка ошибок проверки
-            log_message(f"Ошибка во время проверки сервера: {e}", level="ERROR")
-            self.update_status(f"Ошибка проверки: {e}", level="ERROR")
-            self.update_progress(0) # Сбрасываем прогресс при ошибке
-            self.update_text_area(f"Ошибка при проверке сервера:\n{e}") # Выводим ошибку в текстовое поле
+        self._progress_channel = ProgressChannel(self.root, self._apply_progress, self._apply_status)
+        self._progress_channel.start()
 
+    def process_running(self):
+        """Запущен ли BackOffice этого сеанса (и еще не завершился)."""
+        return self.backoffice_process is not None and self.backoffice_process.poll() is None
 
-        finally:
-            # Включаем ввод и кнопки обратно в основном потоке
-            self.root.after(0, lambda: self.launch_button.config(state=tk.NORMAL))
-            self.root.after(0, lambda: self.check_button.config(state=tk.NORMAL))
-            self.root.after(0, lambda: self.target_entry.config(state=tk.NORMAL))
-            self.reset_progress() # Убедимся, что прогресс сброшен
+    def stop_process(self):
+        """Останавливает BackOffice этого сеанса."""
+        if self.backoffice_process is not None:
+            stop_process_by_pid(self.backoffice_process.pid)
+        self.backoffice_process = None
+        self._launch_data['backoffice_process'] = None
 
-    def update_text_area(self, text):
-        """Updates the text area safely from a thread."""
-        # Обновление GUI должно происходить в основном потоке
-        self.root.after(0, lambda: self._do_update_text_area(text))
+    def cancel(self):
+        """Отменяет запуск (кнопка 'Отмена', основной поток). Скачивание и распаковка прерываются
+           на ближайшем блоке данных, ожидания - в течение _CANCEL_CHECK_SEC, частичные файлы удаляются.
+        """
+        if self.finished or self.cancel_event.is_set():
+            return
+        log_message(f"[{self.target_string}] Запуск отменен пользователем.", level="WARNING")
+        self.cancel_event.set()
+        self.close_button.config(state=tk.DISABLED)
+        self.update_status("Отмена запуска...", level="WARNING")
 
-    def _do_update_text_area(self, text):
-        """Performs the actual text area update in the main thread."""
-        self.json_output_text.config(state=tk.NORMAL) # Включаем редактирование
-        self.json_output_text.delete('1.0', tk.END) # Очищаем
-        self.json_output_text.insert(tk.END, text) # Вставляем новый текст
-        self.json_output_text.config(state=tk.DISABLED) # Отключаем редактирование снова
-        # Прокручиваем к началу, если текст не пустой
-        if text:
-            self.json_output_text.see('1.0')
+    def _mark_finished(self):
+        """Отмечает сеанс завершенным: его строку можно убрать из окна."""
+        self.finished = True
+        self.root.after(0, lambda: self.close_button.config(text="✕", state=tk.NORMAL, command=lambda: self.gui.remove_session(self)))
 
     def _launch_step1_parse(self, target_string):
         """Шаг 1: Парсинг ввода (выполняется в потоке)."""
         try:
             self.set_progress_step_bounds(0, 5) # 0-5% на парсинг
+            self._launch_data['trace'].begin('parse')
+            _check_cancelled(self.cancel_event)
             self.update_status("Парсинг введенного адреса...")
             parsed_target = parse_target_string(target_string)
             if parsed_target is None or not parsed_target.get('UrlOrIp'): # Проверяем, что хост не пустой
@@ -1497,106 +5508,30 @@ class BackOfficeLauncherGUI:
 
         except Exception as e:
             # Перехватываем любые исключения в этом потоке и обрабатываем их
-            self.handle_error(f"Произошла ошибка во время парсинга: {e}")
-
-    def _on_paste(self, event=None):
-        """Handles the <<Paste>> event, inserting limited clipboard content."""
-        log_message("DEBUG: Событие <<Paste>> перехвачено.", level="DEBUG")
-        try:
-            # Получаем содержимое буфера обмена
-            clipboard_content = self.root.clipboard_get()
-
-            # Проверяем, является ли содержимое строкой и не пустое
-            if isinstance(clipboard_content, str) and clipboard_content.strip():
-                # Ограничиваем содержимое первыми 100 символами после удаления начальных/конечных пробелов
-                truncated_content = clipboard_content.strip()[:100]
-
-                # Очищаем поле ввода
-                self.target_entry.delete('0', tk.END)
-                log_message("DEBUG: Поле ввода очищено.", level="DEBUG")
-
-                # Вставляем ограниченное содержимое в позицию курсора
-                self.target_entry.insert(0, truncated_content)
-                log_message(f"DEBUG: Вставлено содержимое (ограничено до 100 символов): '{truncated_content}'", level="DEBUG")
-
-                # Очищаем статус после успешной вставки (если там было предупреждение)
-                self.update_status("Ожидание ввода...")
-
-            else:
-                # Если содержимое не строка, пустое или состоит только из пробелов
-                log_message("Буфер обмена пуст или содержит нетекстовые данные.", level="WARNING")
-                self.update_status("Буфер обмена пуст или содержит нетекстовые данные.", level="WARNING")
-
-        except tk.TclError:
-            # Обрабатываем случаи, когда буфер обмена пуст или содержит нетекстовые данные (если strip/[:100] не сработали)
-            # или если clipboard_get сам по себе вызвал ошибку (например, нет доступа к буферу)
-            log_message("Не удалось получить содержимое из буфера обмена (TclError при clipboard_get).", level="WARNING")
-            self.update_status("Буфер обмена пуст или содержит нетекстовые данные.", level="WARNING")
-        except Exception as e:
-            log_message(f"Неизвестная ошибка при обработке события <<Paste>>: {e}", level="ERROR")
-            self.update_status(f"Ошибка при вставке: {e}", level="ERROR")
-
-        # Важно: возвращаем 'break' чтобы остановить дальнейшую обработку события <<Paste>>
-        # Иначе стандартная привязка tk вставит полное содержимое буфера после нашего кода
-        return 'break'
-    
+            self.handle_error(f"Произошла ошибка во время парсинга: {e}")
+
     def _launch_step2_httprequest(self, parsed_target):
         """Шаг 2: Выполнение HTTP-запроса (выполняется в потоке)."""
         try:
             self.set_progress_step_bounds(5, 25) # 5-25% на HTTP запрос
+            self._launch_data['trace'].begin('probe')
+            _check_cancelled(self.cancel_event)
             target_url_or_ip = parsed_target['UrlOrIp']
             target_port = parsed_target['Port']
             self.update_status(f"Выполнение GET-запроса к {target_url_or_ip}:{target_port}...")
 
-            # Определяем URL запроса и схему
-            # Используем HTTPS только для доменов iiko.it или syrve.online
-            probe_scheme = "http"
-            if target_url_or_ip.lower().endswith(".iiko.it") or target_url_or_ip.lower().endswith(".syrve.online"):
-                probe_scheme = "https"
-                log_message(f"DEBUG: Определена схема HTTPS для домена '{target_url_or_ip}'")
-            else:
-                 log_message(f"DEBUG: Определена схема HTTP для адреса '{target_url_or_ip}'")
-
-            # Определяем, нужно ли включать порт в URL запроса
-            standard_http_port = 80
-            standard_https_port = 443
-            include_port_in_probe_url = True
+            # Свежий результат проверки (кнопка "Проверить") используется без повторного запроса
+            probe_result = fetch_server_info(self.config, parsed_target)
+            server_info = probe_result['server_info']
+            self._launch_data['probe_url'] = probe_result['probe_url']
+            self._launch_data['config_protocol'] = probe_result['scheme'] # Сохраняем схему для config файла
+            self._launch_data['config_port'] = probe_result['port'] # И порт, на котором ответил сервер
+            self._launch_data['trace'].annotate(from_cache=probe_result['from_cache'], scheme=probe_result['scheme'], port=probe_result['port'])
+            self.update_progress_step(1.0) # Шаг HTTP запроса завершен
 
-            if probe_scheme == "http" and target_port == standard_http_port:
-                 include_port_in_probe_url = False
-            elif probe_scheme == "https" and target_port == standard_https_port:
-                 include_port_in_probe_url = False
-
-            probe_url = f"{probe_scheme}://{target_url_or_ip}"
-            if include_port_in_probe_url:
-                probe_url += f":{target_port}"
-            probe_url += "/resto/getServerMonitoringInfo.jsp"
-
-            log_message(f"URL для запроса информации о сервере: {probe_url}")
-            self._launch_data['probe_url'] = probe_url
-            self._launch_data['config_protocol'] = probe_scheme # Сохраняем схему для config файла
-
-            http_timeout = get_config_value(self.config, 'Settings', 'HttpRequestTimeoutSec', default=15, type_cast=int)
-            response = None
-            try:
-                # Выполняем GET запрос
-                response = requests.get(probe_url, timeout=http_timeout)
-                response.raise_for_status() # Генерирует исключение для плохих кодов статуса (4xx или 5xx)
-                server_info = response.json() # Парсим JSON ответ
-                self.update_progress_step(1.0) # Шаг HTTP запроса завершен
-
-                log_message(f"Получен ответ от сервера на шаге запуска: {server_info}", level="DEBUG")
-                formatted_json = json.dumps(server_info, indent=4, ensure_ascii=False)
-                self.update_text_area(formatted_json)
-
-            except requests.exceptions.Timeout:
-                raise ConnectionError(f"Таймаут ({http_timeout} сек) при выполнении GET-запроса к '{probe_url}'")
-            except requests.exceptions.ConnectionError as e:
-                 raise ConnectionError(f"Ошибка подключения при выполнении GET-запроса к '{probe_url}': {e}")
-            except requests.exceptions.RequestException as e:
-                raise ConnectionError(f"Ошибка HTTP запроса к '{probe_url}': {e}")
-            except Exception as e:
-                 raise ConnectionError(f"Неожиданная ошибка при запросе к '{probe_url}': {e}")
+            log_message("Получен ответ от сервера на шаге запуска: %s", server_info, level="DEBUG")
+            formatted_json = json.dumps(server_info, indent=4, ensure_ascii=False)
+            self.gui.update_text_area(formatted_json)
 
             self._launch_data['server_info'] = server_info
 
@@ -1611,15 +5546,11 @@ class BackOfficeLauncherGUI:
         """Шаг 3: Обработка ответа и определение типа приложения (выполняется в потоке)."""
         try:
             self.set_progress_step_bounds(25, 40) # 25-40% на обработку ответа и определение типа
+            self._launch_data['trace'].begin('resolve_app_type')
+            _check_cancelled(self.cancel_event)
             self.update_status("Обработка ответа сервера...")
 
-            edition = server_info.get("edition")
-            version_raw = server_info.get("version")
-            server_state = server_info.get("serverState")
-
-            if None in [edition, version_raw, server_state]:
-                 log_message(f"Полный ответ сервера: {server_info}", level="DEBUG")
-                 raise ValueError("Ответ сервера не содержит ожидаемых ключей (edition, version, serverState).")
+            edition, version_raw, server_state = parse_server_info(server_info)
 
             self.update_status(f"Получены данные: Edition={edition}, Version={version_raw}, State={server_state}")
             log_message(f"Получены данные сервера: Edition='{edition}', Version='{version_raw}', ServerState='{server_state}'")
@@ -1640,6 +5571,7 @@ class BackOfficeLauncherGUI:
                  log_message("Требуется выбор типа приложения пользователем.")
                  # Сохраняем данные для передачи в функцию диалога
                  self._launch_data['step_after_app_type'] = '_launch_step4_check_server_state' # Куда вернуться после выбора
+                 self._launch_data['trace'].begin('user_dialog') # Время ответа пользователя не относится к шагам запуска
                  self.root.after(0, self.ask_app_type) # Вызываем диалог в основном потоке
                  return # Завершаем выполнение этого потока, ожидая выбора пользователя
 
@@ -1672,7 +5604,7 @@ class BackOfficeLauncherGUI:
         choices = [f"{vendor}RMS", f"{vendor}Chain"]
         # messagebox.askyesno возвращает True для Yes, False для No
         # Мы используем yesno для выбора между двумя опциями
-        result = messagebox.askyesno("Выбор типа приложения",
+        result = messagebox.askyesno(f"Выбор типа приложения - {self.target_string}",
                                         f"Не удалось автоматически определить тип RMS/Chain для производителя '{vendor}' по edition ('{edition}').\n"
                                         f"Выберите тип приложения:\n"
                                         f"  'Да' - {choices[0]}\n"
@@ -1708,16 +5640,16 @@ class BackOfficeLauncherGUI:
         self.set_progress_step_bounds(25, 40) # Шаг 3
         self.update_progress_step(1.0) # Шаг 3 завершен
 
-        # Теперь запускаем следующий шаг (Шаг 4) в новом потоке
-        self.launch_thread = threading.Thread(target=next_step_method, args=(self._launch_data['server_state'],))
-        self.launch_thread.daemon = True
-        self.launch_thread.start()
+        # Теперь запускаем следующий шаг (Шаг 4) в рабочем потоке
+        self.gui.run_in_pool(self, next_step_method, self._launch_data['server_state'])
 
 
     def _launch_step4_check_server_state(self, server_state):
         """Шаг 4: Проверка состояния сервера (выполняется в потоке)."""
         try:
             self.set_progress_step_bounds(40, 45) # 40-45% на проверку состояния сервера
+            self._launch_data['trace'].begin('server_state')
+            _check_cancelled(self.cancel_event)
             parsed_target = self._launch_data['parsed_target'] # Получаем parsed_target
             target_url_or_ip = parsed_target['UrlOrIp']
 
@@ -1728,6 +5660,7 @@ class BackOfficeLauncherGUI:
                 self.update_progress_step(0.5) # Прогресс 50% на этом шаге (до диалога)
                 # Сохраняем данные для передачи в функцию диалога
                 self._launch_data['step_after_server_state_confirm'] = '_launch_step5_format_version' # Куда вернуться после подтверждения
+                self._launch_data['trace'].begin('user_dialog') # Время ответа пользователя не относится к шагам запуска
                 self.root.after(0, self.ask_continue_on_server_state) # Вызываем диалог в основном потоке
                 return # Завершаем выполнение этого потока, ожидая подтверждения
 
@@ -1748,7 +5681,7 @@ class BackOfficeLauncherGUI:
         target_url_or_ip = parsed_target['UrlOrIp']
         server_state = self._launch_data['server_state']
 
-        result = messagebox.askyesno("Состояние сервера",
+        result = messagebox.askyesno(f"Состояние сервера - {self.target_string}",
                                         f"Состояние сервера '{target_url_or_ip}' не 'STARTED_SUCCESSFULLY', текущее состояние: '{server_state}'.\n"
                                         f"Продолжить запуск BackOffice?",
                                         icon='warning')
@@ -1765,10 +5698,8 @@ class BackOfficeLauncherGUI:
             self.set_progress_step_bounds(40, 45) # Шаг 4
             self.update_progress_step(1.0) # Шаг 4 завершен
 
-            # Теперь запускаем следующий шаг (Шаг 5) в новом потоке
-            self.launch_thread = threading.Thread(target=next_step_method)
-            self.launch_thread.daemon = True
-            self.launch_thread.start()
+            # Теперь запускаем следующий шаг (Шаг 5) в рабочем потоке
+            self.gui.run_in_pool(self, next_step_method)
 
         else: # Пользователь выбрал No или закрыл диалог
             log_message("Запуск отменен по запросу пользователя.", level="INFO")
@@ -1779,6 +5710,8 @@ class BackOfficeLauncherGUI:
         """Шаг 5: Форматирование версии (выполняется в потоке)."""
         try:
             self.set_progress_step_bounds(45, 50) # 45-50% на форматирование версии
+            self._launch_data['trace'].begin('format_version')
+            _check_cancelled(self.cancel_event)
             version_raw = self._launch_data['version_raw']
             self.update_status("Форматирование версии...")
             version_formatted = format_version(version_raw)
@@ -1799,6 +5732,8 @@ class BackOfficeLauncherGUI:
         """Шаг 6: Определение ожидаемого имени каталога дистрибутива (выполняется в потоке)."""
         try:
             self.set_progress_step_bounds(50, 55) # 50-55% на имя дистрибутива
+            self._launch_data['trace'].begin('installer_name')
+            _check_cancelled(self.cancel_event)
             self.update_status("Определение имени дистрибутива...")
             # Передаем объект конфигурации
             expected_installer_name = get_expected_installer_name(self.config, app_type, version_formatted)
@@ -1823,6 +5758,8 @@ class BackOfficeLauncherGUI:
         """Шаг 7: Поиск или скачивание дистрибутива (выполняется в потоке)."""
         try:
             self.set_progress_step_bounds(55, 85) # 55-85% на поиск/скачивание/распаковку (30%)
+            self._launch_data['trace'].begin('installer')
+            _check_cancelled(self.cancel_event)
 
             # Вызываем функцию поиска/скачивания, передавая колбэки для обновления GUI и объект конфига
             installer_path = find_or_download_installer(
@@ -1831,7 +5768,9 @@ class BackOfficeLauncherGUI:
                 self._launch_data['version_formatted'], # 3. version_formatted
                 vendor, # 4. vendor (уже есть в аргументах метода)
                 self.update_status, # 5. update_status
-                self.update_progress # 6. update_progress_callback
+                self.update_progress, # 6. update_progress_callback
+                self._launch_data['trace'], # 7. trace
+                self.cancel_event # 8. cancel_event
             )
 
             if installer_path is None:
@@ -1862,35 +5801,21 @@ class BackOfficeLauncherGUI:
         """Шаг 8: Определение пути AppData и очистка (выполняется в потоке)."""
         try:
             self.set_progress_step_bounds(85, 88) # 85-88% на AppData и очистку
-            # Санитизируем адрес для пути в AppData
-            sanitized_target = sanitize_for_path(target_url_or_ip)
-            log_message(f"Санитизированный адрес для пути AppData: '{sanitized_target}'")
-
-            # Определяем путь к временной папке в AppData
-            backoffice_temp_dir = get_appdata_path(vendor, app_type, sanitized_target, version_raw)
-            if backoffice_temp_dir is None:
-                 raise EnvironmentError("Не удалось определить путь временной папки кэша.")
-
-            self.update_status(f"Ожидаемый путь временной папки кэша: {backoffice_temp_dir}")
+            self._launch_data['trace'].begin('appdata')
+            _check_cancelled(self.cancel_event)
+            backoffice_temp_dir, sanitized_target = prepare_appdata_dir(target_url_or_ip, vendor, app_type, version_raw, self.update_status)
             self._launch_data['backoffice_temp_dir'] = backoffice_temp_dir
             self._launch_data['sanitized_target'] = sanitized_target
-
-            # Очищаем старый кэш в AppData, если существует
-            if os.path.exists(backoffice_temp_dir):
-                self.update_status(f"Очистка существующей временной папки кэша...")
-                log_message(f"Очистка существующей временной папки кэша: '{backoffice_temp_dir}'")
-                try:
-                    shutil.rmtree(backoffice_temp_dir, ignore_errors=True)
-                    log_message("Временная папка успешно удалена.")
-                    self.update_status("Временная папка кэша очищена.")
-                except Exception as e:
-                    log_message(f"Ошибка при удалении временной папки '{backoffice_temp_dir}': {e}", level="ERROR")
-                    self.update_status("Ошибка при удалении временной папки.", level="WARNING") # Предупреждение, не критическая ошибка
-            else:
-                log_message("Временная папка кэша не найдена. Удаление не требуется.")
-                self.update_status("Временная папка кэша не найдена.")
             self.update_progress_step(1.0) # Шаг AppData и очистки завершен
 
+            # Если конфиг подготовлен из шаблона, первый запуск и правка конфига не нужны
+            self._launch_data['trace'].begin('preseed_config')
+            _check_cancelled(self.cancel_event)
+            self._launch_data['config_preseeded'] = preseed_backoffice_config(self.config, self._launch_data, self.update_status)
+            if self._launch_data['config_preseeded']:
+                self._launch_step11_restart()
+                return
+
             # Переходим к следующему шагу
             self._launch_step9_first_run()
 
@@ -1902,51 +5827,18 @@ class BackOfficeLauncherGUI:
         """Шаг 9: Первый запуск BackOffice.exe (выполняется в потоке)."""
         try:
             self.set_progress_step_bounds(88, 90) # 88-90% на первый запуск
-            installer_path = self._launch_data['installer_path']
-            sanitized_target = self._launch_data['sanitized_target']
-
-            backoffice_exe_path = os.path.join(installer_path, "BackOffice.exe")
-            if not os.path.exists(backoffice_exe_path):
-                 raise FileNotFoundError(f"Файл BackOffice.exe не найден в каталоге дистрибутива: '{backoffice_exe_path}'.")
-
-            # Формируем аргументы для BackOffice.exe
-            backoffice_args = f"/AdditionalTmpFolder=\"{sanitized_target}\""
-            log_message(f"Первый запуск BackOffice.exe: '{backoffice_exe_path}' с аргументами: '{backoffice_args}'")
+            self._launch_data['trace'].begin('first_run')
+            _check_cancelled(self.cancel_event)
             self.update_status("Первый запуск BackOffice.exe...")
+            self.backoffice_process, backoffice_exe_path, backoffice_args = start_backoffice(
+                self.config, self._launch_data['installer_path'], self._launch_data['sanitized_target'])
+            self.update_status(f"BackOffice.exe запущен (PID: {self.backoffice_process.pid}).")
+            self.update_progress_step(1.0) # Шаг первого запуска завершен
 
-            try:
-                # Используем subprocess.Popen для асинхронного запуска и получения объекта процесса
-                # shell=True может быть опасен с пользовательским вводом, но здесь $sanitized_target уже очищен.
-                # Альтернатива без shell=True сложнее с аргументами с пробелами и кавычками.
-                # cwd устанавливает рабочий каталог.
-                # startupinfo для скрытия окна консоли в Windows
-                startupinfo = None
-                if os.name == 'nt': # Проверяем, что мы на Windows
-                    startupinfo = subprocess.STARTUPINFO()
-                    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-                    startupinfo.wShowWindow = subprocess.SW_HIDE # Скрыть окно
-
-                self.backoffice_process = subprocess.Popen(
-                    [backoffice_exe_path, backoffice_args],
-                    cwd=installer_path,
-                    shell=True, # Используем shell=True для корректной обработки аргументов
-                    startupinfo=startupinfo,
-                    creationflags=subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0 # Не создавать консольное окно на Windows
-                )
-                log_message(f"BackOffice.exe успешно запущен (первый раз, PID: {self.backoffice_process.pid}).")
-                self.update_status(f"BackOffice.exe запущен (PID: {self.backoffice_process.pid}).")
-                self.update_progress_step(1.0) # Шаг первого запуска завершен
-
-                # Сохраняем информацию о процессе и аргументах
-                self._launch_data['backoffice_process'] = self.backoffice_process
-                self._launch_data['backoffice_exe_path'] = backoffice_exe_path
-                self._launch_data['backoffice_args'] = backoffice_args
-
-            except FileNotFoundError:
-                 raise FileNotFoundError(f"Не удалось найти исполняемый файл BackOffice.exe: '{backoffice_exe_path}'. Убедитесь в правильности пути.")
-            except Exception as e:
-                 raise RuntimeError(f"Ошибка при первом запуске BackOffice.exe: {e}")
-
+            # Сохраняем информацию о процессе и аргументах
+            self._launch_data['backoffice_process'] = self.backoffice_process
+            self._launch_data['backoffice_exe_path'] = backoffice_exe_path
+            self._launch_data['backoffice_args'] = backoffice_args
 
             # Переходим к следующему шагу
             self._launch_step10_wait_edit_config()
@@ -1959,46 +5851,11 @@ class BackOfficeLauncherGUI:
         """Шаг 10: Ожидание и редактирование файла backclient.config (выполняется в потоке)."""
         try:
             self.set_progress_step_bounds(90, 98) # 90-98% на ожидание и редактирование конфига (8%)
-            backoffice_temp_dir = self._launch_data['backoffice_temp_dir']
-            parsed_target = self._launch_data['parsed_target']
-            target_url_or_ip = parsed_target['UrlOrIp']
-            target_port = parsed_target['Port']
-            config_protocol = self._launch_data['config_protocol'] # Протокол, определенный на шаге 2
-
-            config_file_path = os.path.join(backoffice_temp_dir, "config", "backclient.config.xml")
-            config_wait_timeout = get_config_value(self.config, 'Settings', 'ConfigFileWaitTimeoutSec', default=60, type_cast=int)
-            config_check_interval = get_config_value(self.config, 'Settings', 'ConfigFileCheckIntervalMs', default=100, type_cast=int)
-
-            # Ожидаем появления файла конфигурации
-            # update_progress_step_callback передается в wait_for_file, чтобы обновлять прогресс внутри этого шага
+            self._launch_data['trace'].begin('config_wait')
+            _check_cancelled(self.cancel_event)
             # Прогресс ожидания файла и содержимого внутри wait_for_file будет от 0.0 до 1.0
-            if not wait_for_file(config_file_path, config_wait_timeout, config_check_interval, self.update_status, lambda p: self.update_progress_step(p)):
-                 # Если wait_for_file вернул False, это таймаут или ошибка ожидания содержимого.
-                 # Ошибка уже была залогирована и статус обновлен внутри wait_for_file.
-                 if self._launch_data.get('backoffice_process') and self._launch_data['backoffice_process'].poll() is None: # Проверяем, запущен ли процесс
-                     self.update_status("Таймаут ожидания файла конфига. Попытка остановить BackOffice...", level="WARNING")
-                     stop_process_by_pid(self._launch_data['backoffice_process'].pid) # Останавливаем процесс
-                 raise TimeoutError(f"Таймаут ожидания файла конфигурации '{config_file_path}'.")
-
-            # Файл найден. Останавливаем процесс BackOffice перед редактированием.
-            current_process = self._launch_data.get('backoffice_process')
-            if current_process and current_process.poll() is None: # Проверяем, запущен ли процесс
-                self.update_status("Файл конфигурации найден. Остановка процесса BackOffice для редактирования...")
-                log_message(f"Остановка процесса BackOffice (PID: {current_process.pid}) для редактирования файла.")
-                # stop_process_by_pid возвращает True, если успешно или процесс не найден
-                stop_process_by_pid(current_process.pid)
-                # Даем немного времени процессу на завершение и освобождение файла
-                time.sleep(1.0)
-                self._launch_data['backoffice_process'] = None # Сбрасываем объект процесса в данных запуска
-                self.backoffice_process = None # Сбрасываем объект процесса в GUI классе
-
-
-            # Редактируем файл конфигурации
-            self.update_status("Редактирование файла конфигурации...")
-            # edit_config_file не обновляет прогресс внутри себя, просто завершает шаг
-            if not edit_config_file(config_file_path, target_url_or_ip, target_port, config_protocol, self.update_status):
-                 # Ошибка уже была залогирована и статус обновлен внутри edit_config_file
-                 raise RuntimeError(f"Не удалось отредактировать файл конфигурации '{config_file_path}'.")
+            configure_backoffice(self.config, self._launch_data, self.update_status, lambda p: self.update_progress_step(p), self.cancel_event)
+            self.backoffice_process = None # Процесс первого запуска остановлен перед редактированием
 
             self.update_progress_step(1.0) # Шаг редактирования завершен (достигает 98%)
 
@@ -2013,121 +5870,374 @@ class BackOfficeLauncherGUI:
         """Шаг 11: Перезапуск BackOffice.exe (выполняется в потоке)."""
         try:
             self.set_progress_step_bounds(98, 100) # 98-100% на перезапуск (2%)
-            installer_path = self._launch_data['installer_path']
-            backoffice_exe_path = self._launch_data['backoffice_exe_path']
-            backoffice_args = self._launch_data['backoffice_args']
-
-            self.update_status("Перезапуск BackOffice.exe...")
-            log_message(f"Перезапуск BackOffice.exe: '{backoffice_exe_path}' с аргументами: '{backoffice_args}'")
-
-            try:
-                 # Запускаем BackOffice.exe снова с теми же аргументами
-                 startupinfo = None
-                 if os.name == 'nt': # Проверяем, что мы на Windows
-                    startupinfo = subprocess.STARTUPINFO()
-                    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-                    startupinfo.wShowWindow = subprocess.SW_HIDE # Скрыть окно
-
-                 self.backoffice_process = subprocess.Popen(
-                    [backoffice_exe_path, backoffice_args],
-                    cwd=installer_path,
-                    shell=True, # Используем shell=True для корректной обработки аргументов
-                    startupinfo=startupinfo,
-                    creationflags=subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0 # Не создавать консольное окно на Windows
-                 )
-                 log_message(f"BackOffice.exe успешно перезапущен (PID: {self.backoffice_process.pid}).")
-                 self.update_status("BackOffice.exe успешно перезапущен.")
-                 self.update_progress_step(1.0) # Шаг перезапуска завершен (достигает 100%)
-
-                 self._launch_data['backoffice_process'] = self.backoffice_process # Обновляем объект процесса в данных запуска
-                 # self.backoffice_process уже обновлен выше
-
-            except FileNotFoundError:
-                 raise FileNotFoundError(f"Не удалось найти исполняемый файл BackOffice.exe для перезапуска: '{backoffice_exe_path}'.")
-            except Exception as e:
-                 raise RuntimeError(f"Ошибка при перезапуске BackOffice.exe: {e}")
+            self._launch_data['trace'].begin('start' if self._launch_data.get('config_preseeded') else 'restart')
+            _check_cancelled(self.cancel_event)
+            if self._launch_data.get('config_preseeded'):
+                self.update_status("Запуск BackOffice.exe с подготовленной конфигурацией...")
+            else:
+                self.update_status("Перезапуск BackOffice.exe...")
+            # Запускаем BackOffice.exe снова с теми же аргументами
+            self.backoffice_process, _, _ = start_backoffice(
+                self.config, self._launch_data['installer_path'], self._launch_data['sanitized_target'])
+            self.update_status("BackOffice.exe успешно запущен." if self._launch_data.get('config_preseeded') else "BackOffice.exe успешно перезапущен.")
+            self.update_progress_step(1.0) # Шаг перезапуска завершен (достигает 100%)
 
+            self._launch_data['backoffice_process'] = self.backoffice_process # Обновляем объект процесса в данных запуска
 
             # --- Завершение ---
             self.update_status("Готово! BackOffice запущен с обновленной конфигурацией.", level="INFO")
             self.update_progress(100) # Убеждаемся, что прогресс 100%
-            log_message("Скрипт успешно завершен.", level="INFO")
+            self._launch_data['trace'].finish('ok')
+            log_message(f"Запуск '{self.target_string}' успешно завершен.", level="INFO")
+            self._mark_finished()
 
         except Exception as e:
             self.handle_error(f"Произошла ошибка во время перезапуска BackOffice: {e}")
 
-        finally:
-            # Включаем ввод и кнопку обратно
-            self.root.after(0, lambda: self.launch_button.config(state=tk.NORMAL))
-            self.root.after(0, lambda: self.target_entry.config(state=tk.NORMAL))
-
 
     def handle_error(self, message):
-        """Обрабатывает ошибки: обновляет статус GUI, логирует, включает элементы GUI."""
-        log_message(message, level="ERROR")
-        # Обновление GUI в основном потоке
-        self.root.after(0, lambda: self.status_label.config(text=f"Ошибка: {message}", foreground="red"))
+        """Обрабатывает ошибку запуска: статус в строке сеанса, лог, остановка процесса этого сеанса.
+           Если запуск отменен пользователем, сеанс завершается как отмененный, а не с ошибкой.
+        """
+        if self.cancel_event.is_set():
+            log_message(f"[{self.target_string}] Запуск отменен ({message}).", level="WARNING")
+            self._launch_data['trace'].finish('cancelled', message)
+            self._progress_channel.post_status("Запуск отменен.", "WARNING")
+        else:
+            log_message(f"[{self.target_string}] {message}", level="ERROR")
+            self._launch_data['trace'].finish('error', message)
+            self._progress_channel.post_status(f"Ошибка: {message}", "ERROR")
         self.update_progress(0) # Сбрасываем прогресс при ошибке
         self.current_step_progress = 0.0
         self.progress_base = 0.0
         self.next_step_base = 0.0
-        # Включаем элементы GUI обратно
-        self.root.after(0, lambda: self.launch_button.config(state=tk.NORMAL))
-        self.root.after(0, lambda: self.target_entry.config(state=tk.NORMAL))
 
-        # Сбрасываем объект процесса BackOffice, чтобы он не пытался остановиться при закрытии окна после ошибки
-        # Проверяем наличие ключа, чтобы избежать ошибок, если _launch_data еще не полностью инициализирован
-        if '_launch_data' in self.__dict__ and 'backoffice_process' in self._launch_data and self._launch_data['backoffice_process'] is not None:
+        # Процесс первого запуска этого сеанса останавливается, процессы других сеансов не трогаем
+        if self._launch_data.get('backoffice_process') is not None:
             log_message(f"Попытка остановить процесс BackOffice PID {self._launch_data['backoffice_process'].pid} после ошибки...", level="WARNING")
             stop_process_by_pid(self._launch_data['backoffice_process'].pid)
             self._launch_data['backoffice_process'] = None # Сбрасываем в данных
-        self.backoffice_process = None # Сбрасываем в классе
+        self.backoffice_process = None # Сбрасываем в сеансе
+        self._mark_finished()
+
+
+class BackOfficeLauncherGUI(_ProgressReporter):
+    def __init__(self, root):
+        self.root = root
+        root.title("BackOffice Launcher")
+        # Высота окна с запасом под строки сеансов запуска, текстовое поле будет растягиваться
+        root.geometry("600x340") # Ширина x Высота
+        root.resizable(False, True) # Теперь окно может изменять размер
+
+        # Загружаем конфигурацию сразу при старте
+        self.config = load_config()
+        # Устанавливаем глобальную переменную для логирования отладки из загруженной конфигурации
+        init_logging(self.config) # Отладочное логирование и ротация файла журнала
+        log_message(f"Отладочное логирование включено: {global_debug_logging}", level="INFO")
+        # Общая HTTP-сессия: соединения с серверами переиспользуются между проверками и запусками
+        init_http_session(self.config)
+
+
+        self.frame = ttk.Frame(root, padding="15") # Увеличиваем отступы
+        self.frame.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
+
+        # Настраиваем растягивание столбцов и строк корневого окна
+        self.root.columnconfigure(0, weight=1)
+        self.root.rowconfigure(0, weight=1)
+
+        # Настраиваем 4 колонки внутри фрейма:
+        # Колонка 0: Метка (не растягивается)
+        # Колонка 1: Поле ввода (растягивается)
+        # Колонка 2: Кнопка (не растягивается)
+        # Колонка 3: Кнопка (не растягивается)
+        self.frame.columnconfigure(1, weight=1) # Колонка для поля ввода растягивается
+        self.frame.columnconfigure(0, weight=0) # Метка
+        self.frame.columnconfigure(2, weight=0) # Кнопка Check - левая из пары
+        self.frame.columnconfigure(3, weight=0) # Кнопка Launch/Paste - правая из пары
+
+        # Метка "Введите URL или IP:порт:" - Ряд 0, Колонка 0
+        ttk.Label(self.frame, text="Введите URL или IP:порт:").grid(row=0, column=0, sticky=tk.W, pady=5, padx=5)
+
+        # Поле ввода URL/IP - Ряд 0, Колонки 1-2 (чтобы быть шире)
+        self.target_entry = ttk.Entry(self.frame)
+        self.target_entry.grid(row=0, column=1, columnspan=2, sticky=(tk.W, tk.E), pady=5, padx=5) # columnspan=2
+        self.target_entry.focus()
+        self.target_entry.bind("<Return>", self.start_launch) # Привязываем клавишу Enter
+        # Привязываем виртуальное событие <<Paste>> к нашему обработчику
+        self.target_entry.bind("<<Paste>>", self._on_paste)
+
+
+        # Кнопка "Paste" - Ряд 0, Колонка 3
+        self.paste_button = ttk.Button(self.frame, text="Paste", command=self.paste_from_clipboard)
+        self.paste_button.grid(row=0, column=3, sticky=tk.W, pady=5, padx=5)
+
+
+        # Метка статуса - ПЕРЕНОСИМ В РЯД 1, Колонки 0-1
+        # Она должна занимать место слева от кнопок Проверить/Запустить
+        self.status_label = ttk.Label(self.frame, text="Ожидание ввода...", wraplength=400) # wraplength можно скорректировать
+        self.status_label.grid(row=1, column=0, columnspan=2, sticky=tk.W, pady=5, padx=5) # columnspan=2
+
+
+        # Кнопки действий - ПЕРЕНОСИМ В РЯД 1
+        # Кнопка "Проверить" - Ряд 1, Колонка 2
+        self.check_button = ttk.Button(self.frame, text="Проверить", command=self.start_check)
+        self.check_button.grid(row=1, column=2, sticky=tk.E, pady=5, padx=5) # sticky=tk.E для выравнивания по правому краю
+
+        # Кнопка "Запустить" - Ряд 1, Колонка 3
+        self.launch_button = ttk.Button(self.frame, text="Запустить", command=self.start_launch)
+        self.launch_button.grid(row=1, column=3, sticky=tk.E, pady=5, padx=5) # sticky=tk.E
+
+
+        # Прогресс бар - ПЕРЕНОСИМ В РЯД 2, Колонки 0-3
+        self.progress_bar = ttk.Progressbar(self.frame, orient='horizontal', mode='determinate')
+        self.progress_bar.grid(row=2, column=0, columnspan=4, sticky=(tk.W, tk.E), pady=5, padx=5) # columnspan=4
+
+
+        # Строки сеансов запуска (по строке на запуск) - РЯД 3, Колонки 0-3
+        self.sessions_frame = ttk.Frame(self.frame)
+        self.sessions_frame.grid(row=3, column=0, columnspan=4, sticky=(tk.W, tk.E))
+
+
+        # Текстовое поле для вывода JSON - РЯД 4, Колонки 0-3
+        # Используем tk.Text вместо scrolledtext.ScrolledText
+        # Удаляем параметры width и height, т.к. размер будет определяться grid и растягиванием
+        self.json_output_text = tk.Text(self.frame, wrap=tk.WORD, state=tk.DISABLED) # wrap=tk.WORD переносит по словам
+        self.json_output_text.grid(row=4, column=0, columnspan=4, sticky=(tk.W, tk.E, tk.N, tk.S), pady=5, padx=5)
+        # Настраиваем растягивание ряда с текстовым полем
+        self.frame.rowconfigure(4, weight=1) # Ряд с текстовым полем растягивается
+
+
+        # Прогресс кнопки "Проверить" (у каждого запуска свой прогресс в строке сеанса)
+        self.current_step_progress = 0.0 # Прогресс внутри текущего основного шага (от 0.0 до 1.0)
+        self.progress_base = 0.0 # Начальное значение прогресса для текущего шага (0-100)
+        self.next_step_base = 0.0 # Начальное значение прогресса для следующего шага (0-100)
+
+        # Сеансы запуска: у каждого свои данные шагов и процесс BackOffice
+        self._sessions = []
+        # Места в пуле рабочих потоков: одновременно выполняются шаги не больше MaxConcurrentLaunches сеансов
+        max_launches = max(1, get_config_value(self.config, 'Settings', 'MaxConcurrentLaunches', default=3, type_cast=int))
+        self._launch_slots = threading.BoundedSemaphore(max_launches)
+
+        # Прогресс и статус из рабочих потоков отрисовываются одним таймером, а не отдельным событием на каждое обновление
+        self._progress_channel = ProgressChannel(self.root, self._apply_progress, self._apply_status)
+        self._progress_channel.start()
+
+
+    def start_launch(self, event=None):
+        """Создает сеанс запуска BackOffice для введенного адреса и выполняет его шаги в рабочем потоке."""
+        target_string = self.target_entry.get().strip()
+        if not target_string:
+            self.update_status("Введите URL или IP:порт.", level="WARNING")
+            return
+
+        # Два одновременных запуска одного адреса делили бы одну папку кэша BackOffice
+        if any(not session.finished and session.target_string.lower() == target_string.lower() for session in self._sessions):
+            self.update_status(f"Запуск '{target_string}' уже выполняется.", level="WARNING")
+            return
+
+        session = LaunchSession(self, target_string)
+        self._sessions.append(session)
+        self.update_status(f"Запуск '{target_string}' добавлен.")
+        self.run_in_pool(session, session._launch_step1_parse, target_string)
+
+    def run_in_pool(self, session, step_method, *args):
+        """Выполняет шаги сеанса в рабочем потоке. Если заняты все места пула, сеанс ждет освобождения.
+           Сеанс, ожидающий ответа в диалоге, места в пуле не занимает.
+        """
+        def worker():
+            if not self._launch_slots.acquire(blocking=False):
+                session.update_status("Ожидание: выполняется максимальное число одновременных запусков...")
+                while not self._launch_slots.acquire(timeout=_CANCEL_CHECK_SEC):
+                    if session.cancel_event.is_set():
+                        session.handle_error("Запуск отменен до начала выполнения.")
+                        return
+            try:
+                if session.cancel_event.is_set(): # Отменен, пока ждал места в пуле или ответа в диалоге
+                    session.handle_error("Запуск отменен.")
+                    return
+                step_method(*args)
+            finally:
+                self._launch_slots.release()
+
+        # Поток завершится при закрытии приложения
+        threading.Thread(target=worker, daemon=True).start()
+
+    def remove_session(self, session):
+        """Убирает строку завершенного сеанса из окна (вызывается в основном потоке)."""
+        session.row.destroy()
+        # Сеанс с работающим BackOffice остается в списке, чтобы при закрытии окна предложить его остановить
+        if not session.process_running():
+            self._sessions.remove(session)
+
+    def paste_from_clipboard(self):
+        """Generates a paste event on the target entry."""
+        # Генерируем виртуальное событие <<Paste>> на поле ввода.
+        # Обработка вставки (получение из буфера, ограничение, вставка)
+        # будет выполняться в методе _on_paste, привязанном к этому событию.
+        log_message("Кнопка 'Paste' нажата. Генерация события <<Paste>>.", level="DEBUG")
+        self.target_entry.event_generate("<<Paste>>")
+
+    def start_check(self):
+        """Starts the server check process in a separate thread."""
+        target_string = self.target_entry.get().strip()
+        if not target_string:
+            self.update_status("Введите URL или IP:порт для проверки.", level="WARNING")
+            return
+
+        # Отключаем кнопку проверки на время выполнения (запуски сеансов проверка не блокирует)
+        self.check_button.config(state=tk.DISABLED)
+
+        # Очищаем текстовое поле
+        self.update_text_area("")
+
+        self.update_status("Выполнение проверки сервера...")
+        self.reset_progress() # Сбрасываем прогресс для проверки (хотя она короткая)
+        self.update_progress(0) # Убедимся, что прогресс на 0
+
+        # Используем поток для выполнения проверки
+        self.check_thread = threading.Thread(target=self.check_server_thread, args=(target_string,))
+        self.check_thread.daemon = True # Поток завершится при закрытии приложения
+        self.check_thread.start()
+
+    def check_server_thread(self, target_string):
+        """Performs the server check logic in a separate thread."""
+        try:
+            # Шаг проверки: Парсинг
+            self.update_status("Парсинг адреса для проверки...")
+            parsed_target = parse_target_string(target_string)
+            if parsed_target is None or not parsed_target.get('UrlOrIp'):
+                raise ValueError("Не удалось распарсить ввод или извлечь хост/IP.")
+
+            target_url_or_ip = parsed_target['UrlOrIp']
+            target_port = parsed_target['Port']
+
+            # Шаг проверки: Запрос. Проверка всегда обращается к серверу, а ее результат
+            # попадает в кэш, откуда его сразу возьмет последующий запуск.
+            self.update_status(f"Запрос информации о сервере: {target_url_or_ip}:{target_port}...")
+            server_info = fetch_server_info(self.config, parsed_target, force_refresh=True)['server_info']
+
+            # Шаг проверки: Вывод результата
+            self.update_status("Получен ответ от сервера. Вывод JSON...")
+            log_message("Получен ответ от сервера: %s", server_info, level="DEBUG")
+
+            # Форматируем JSON для удобного чтения
+            formatted_json = json.dumps(server_info, indent=4, ensure_ascii=False)
+            self.update_text_area(formatted_json) # Выводим в текстовое поле
+
+            self.update_status("Проверка завершена. Ответ сервера в поле ниже.", level="INFO")
+            self.update_progress(100) # Прогресс 100% для проверки
+
+        except Exception as e:
+            # Обработка ошибок проверки
+            log_message(f"Ошибка во время проверки сервера: {e}", level="ERROR")
+            self.update_status(f"Ошибка проверки: {e}", level="ERROR")
+            self.update_progress(0) # Сбрасываем прогресс при ошибке
+            self.update_text_area(f"Ошибка при проверке сервера:\n{e}") # Выводим ошибку в текстовое поле
+
+
+        finally:
+            # Включаем кнопку обратно в основном потоке
+            self.root.after(0, lambda: self.check_button.config(state=tk.NORMAL))
+            self.reset_progress() # Убедимся, что прогресс сброшен
+
+    def update_text_area(self, text):
+        """Updates the text area safely from a thread."""
+        # Обновление GUI должно происходить в основном потоке
+        self.root.after(0, lambda: self._do_update_text_area(text))
+
+    def _do_update_text_area(self, text):
+        """Performs the actual text area update in the main thread."""
+        self.json_output_text.config(state=tk.NORMAL) # Включаем редактирование
+        self.json_output_text.delete('1.0', tk.END) # Очищаем
+        self.json_output_text.insert(tk.END, text) # Вставляем новый текст
+        self.json_output_text.config(state=tk.DISABLED) # Отключаем редактирование снова
+        # Прокручиваем к началу, если текст не пустой
+        if text:
+            self.json_output_text.see('1.0')
+
+    def _on_paste(self, event=None):
+        """Handles the <<Paste>> event, inserting limited clipboard content."""
+        log_message("DEBUG: Событие <<Paste>> перехвачено.", level="DEBUG")
+        try:
+            # Получаем содержимое буфера обмена
+            clipboard_content = self.root.clipboard_get()
+
+            # Проверяем, является ли содержимое строкой и не пустое
+            if isinstance(clipboard_content, str) and clipboard_content.strip():
+                # Ограничиваем содержимое первыми 100 символами после удаления начальных/конечных пробелов
+                truncated_content = clipboard_content.strip()[:100]
+
+                # Очищаем поле ввода
+                self.target_entry.delete('0', tk.END)
+                log_message("DEBUG: Поле ввода очищено.", level="DEBUG")
+
+                # Вставляем ограниченное содержимое в позицию курсора
+                self.target_entry.insert(0, truncated_content)
+                log_message(f"DEBUG: Вставлено содержимое (ограничено до 100 символов): '{truncated_content}'", level="DEBUG")
+
+                # Очищаем статус после успешной вставки (если там было предупреждение)
+                self.update_status("Ожидание ввода...")
+
+            else:
+                # Если содержимое не строка, пустое или состоит только из пробелов
+                log_message("Буфер обмена пуст или содержит нетекстовые данные.", level="WARNING")
+                self.update_status("Буфер обмена пуст или содержит нетекстовые данные.", level="WARNING")
 
+        except tk.TclError:
+            # Обрабатываем случаи, когда буфер обмена пуст или содержит нетекстовые данные (если strip/[:100] не сработали)
+            # или если clipboard_get сам по себе вызвал ошибку (например, нет доступа к буферу)
+            log_message("Не удалось получить содержимое из буфера обмена (TclError при clipboard_get).", level="WARNING")
+            self.update_status("Буфер обмена пуст или содержит нетекстовые данные.", level="WARNING")
+        except Exception as e:
+            log_message(f"Неизвестная ошибка при обработке события <<Paste>>: {e}", level="ERROR")
+            self.update_status(f"Ошибка при вставке: {e}", level="ERROR")
 
+        # Важно: возвращаем 'break' чтобы остановить дальнейшую обработку события <<Paste>>
+        # Иначе стандартная привязка tk вставит полное содержимое буфера после нашего кода
+        return 'break'
+    
     def on_closing(self):
-        """Обрабатывает закрытие окна - пытается остановить BackOffice, если он запущен."""
+        """Обрабатывает закрытие окна - предлагает остановить BackOffice, запущенные сеансами."""
         log_message("Получен запрос на закрытие окна.")
-        # Проверяем, запущен ли процесс BackOffice и не завершился ли он сам
-        # Используем ссылку на процесс из _launch_data, если она есть
-        current_process = None
-        if '_launch_data' in self.__dict__ and 'backoffice_process' in self._launch_data:
-             current_process = self._launch_data['backoffice_process']
-        # else: # Запасной вариант, если _launch_data не инициализирован (например, при ошибке на ранних этапах)
-        #      current_process = self.backoffice_process # Уже не нужно, т.к. self.backoffice_process дублирует _launch_data['backoffice_process']
-
-
-        if current_process and current_process.poll() is None: # poll() возвращает код завершения или None, если процесс еще работает
-            log_message(f"Обнаружен запущенный процесс BackOffice (PID: {current_process.pid}).")
-            # Спрашиваем пользователя, нужно ли завершить процесс
-            if messagebox.askokcancel("Выход", "BackOffice запущен. Завершить его перед выходом?"):
-                log_message("Пользователь подтвердил завершение процесса BackOffice перед выходом.")
-                self.update_status("Завершение процесса BackOffice...", level="INFO")
-                stop_process_by_pid(current_process.pid)
+        # Процессы, которые сеансы запустили и которые еще не завершились сами
+        running = [session for session in self._sessions if session.process_running()]
+
+        if running:
+            log_message(f"Обнаружены запущенные процессы BackOffice (PID: {', '.join(str(session.backoffice_process.pid) for session in running)}).")
+            # Спрашиваем пользователя, нужно ли завершить процессы
+            if messagebox.askokcancel("Выход", f"Запущено экземпляров BackOffice: {len(running)}. Завершить их перед выходом?"):
+                log_message("Пользователь подтвердил завершение процессов BackOffice перед выходом.")
+                self.update_status("Завершение процессов BackOffice...", level="INFO")
+                for session in running:
+                    session.stop_process()
                 # Даем немного времени на завершение
                 time.sleep(1.0)
-                # Сбрасываем ссылки на процесс
-                self.backoffice_process = None
-                if '_launch_data' in self.__dict__ and 'backoffice_process' in self._launch_data:
-                     self._launch_data['backoffice_process'] = None
-
                 self.root.destroy() # Закрываем окно
             else:
-                log_message("Пользователь отменил завершение процесса BackOffice. Окно останется открытым.")
+                log_message("Пользователь отменил завершение процессов BackOffice. Окно останется открытым.")
                 # Пользователь отменил, окно остается открытым
                 pass
         else:
-            log_message("Процесс BackOffice не запущен. Закрытие окна.")
-            self.root.destroy() # Процесс не запущен, просто закрываем окно
+            log_message("Процессы BackOffice не запущены. Закрытие окна.")
+            self.root.destroy() # Процессы не запущены, просто закрываем окно
 
 # --- Основное выполнение ---
 if __name__ == "__main__":
 
+    # Консольный режим без GUI: BOlauncher.exe --headless <адреса> [параметры]
+    if len(sys.argv) > 1 and sys.argv[1] == "--headless":
+        sys.exit(run_cli(sys.argv[2:]))
+
     # Проверяем аргументы командной строки
     initial_target = None
     if len(sys.argv) > 1:
         initial_target = sys.argv[1]
         # Логирование аргумента произойдет после загрузки конфига и установки global_debug_logging
 
+    if tk is None:
+        print("Графический режим недоступен: в этой сборке Python нет tkinter. Используйте --headless.", file=sys.stderr)
+        sys.exit(1)
+
     root = tk.Tk()
     app = BackOfficeLauncherGUI(root)
 